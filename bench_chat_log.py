@@ -0,0 +1,81 @@
+"""
+Memory benchmark: chat_log entries as dicts (old format) vs ChatMessage.
+
+Builds USERS x MESSAGES entries in both representations and measures the
+allocated memory with tracemalloc. Runs without installing real
+telebot/requests/dotenv via sys.modules injection (as in the tests).
+
+Run: python3 bench_chat_log.py [USERS] [MESSAGES]
+"""
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+from unittest.mock import MagicMock
+
+os.environ.setdefault('BOT_TOKEN_SUPPORT', 'bench_token')
+os.environ.setdefault('ADMIN_IDS', '111')
+os.environ.setdefault('API_URL_SUPPORT', 'http://bench/api')
+os.environ.setdefault('SUPPORT_API_URL', 'http://bench/support')
+# Файлы бота — во временную папку, как в replay_updates.py: бенч не трогает /data
+_workdir = tempfile.mkdtemp(prefix="bench-")
+os.environ.update({
+    "STATE_FILE": os.path.join(_workdir, "bot_state.json"),
+    "UPDATES_STATE_FILE": os.path.join(_workdir, "processed_updates.json"),
+    "STATS_FILE": os.path.join(_workdir, "support_stats.json"),
+    "TRACE_FILE": os.path.join(_workdir, "traces.jsonl"),
+    "SEARCH_DB": os.path.join(_workdir, "search.db"),
+    "RECORD_UPDATES_FILE": "",
+})
+
+for name in ('telebot', 'telebot.types', 'dotenv', 'requests'):
+    sys.modules.setdefault(name, MagicMock())
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import main  # noqa: E402
+
+ROLES = ("user", "ai", "user", "admin")
+
+
+def build_dicts(users, messages, texts):
+    log = {}
+    for uid in range(users):
+        log[uid] = [{"role": ROLES[i % 4], "text": texts[(uid + i) % len(texts)],
+                     "time": datetime.now().strftime("%H:%M")} for i in range(messages)]
+    return log
+
+
+def build_records(users, messages, texts):
+    log = {}
+    now = int(time.time())
+    for uid in range(users):
+        log[uid] = [main.ChatMessage(ROLES[i % 4], texts[(uid + i) % len(texts)], now + i)
+                    for i in range(messages)]
+    return log
+
+
+def measure(builder, *args):
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    data = builder(*args)
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del data
+    return after - before
+
+
+if __name__ == '__main__':
+    users = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    messages = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    # Общий пул текстов — считаем накладные расходы записи, а не самих строк
+    texts = [f"сообщение пользователя номер {i}" for i in range(100)]
+
+    old = measure(build_dicts, users, messages, texts)
+    new = measure(build_records, users, messages, texts)
+    total = users * messages
+    print(f"entries:      {total}")
+    print(f"dict entries: {old / 1024 / 1024:8.2f} MiB ({old / total:6.1f} B/entry)")
+    print(f"ChatMessage:  {new / 1024 / 1024:8.2f} MiB ({new / total:6.1f} B/entry)")
+    print(f"reduction:    {(1 - new / old) * 100:8.1f} %")
@@ -0,0 +1,137 @@
+"""
+Dispatch benchmark: table-driven UpdateRouter vs the old telebot filter chain.
+
+The old layout is emulated the way telebot evaluated it: message handlers
+are checked in registration order (content_types, commands, then the
+`func=lambda` filter against an ADMIN_IDS list); callbacks walk the
+startswith if/elif ladder and re-parse call.data with split('_').
+Only handler lookup is timed — handlers themselves are not called.
+Runs without installing real telebot/requests/dotenv via sys.modules
+injection (as in the tests).
+
+Run: python3 bench_router.py [UPDATES]
+"""
+import os
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+from unittest.mock import MagicMock
+
+os.environ.setdefault('BOT_TOKEN_SUPPORT', 'bench_token')
+os.environ.setdefault('ADMIN_IDS', ','.join(str(100 + i) for i in range(8)))
+os.environ.setdefault('API_URL_SUPPORT', 'http://bench/api')
+os.environ.setdefault('SUPPORT_API_URL', 'http://bench/support')
+# Файлы бота — во временную папку, как в replay_updates.py: бенч не трогает /data
+_workdir = tempfile.mkdtemp(prefix="bench-")
+os.environ.update({
+    "STATE_FILE": os.path.join(_workdir, "bot_state.json"),
+    "UPDATES_STATE_FILE": os.path.join(_workdir, "processed_updates.json"),
+    "STATS_FILE": os.path.join(_workdir, "support_stats.json"),
+    "TRACE_FILE": os.path.join(_workdir, "traces.jsonl"),
+    "SEARCH_DB": os.path.join(_workdir, "search.db"),
+    "RECORD_UPDATES_FILE": "",
+})
+
+for name in ('telebot', 'telebot.types', 'dotenv', 'requests'):
+    sys.modules.setdefault(name, MagicMock())
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import main  # noqa: E402
+
+ADMIN_LIST = sorted(main.ADMIN_IDS)
+COMMANDS = ['help', 'info', 'squads', 'extend', 'toggle_pro', 'disable_device_limit', 'refs',
+            'maintenance', 'compensate', 'load', 'trace', 'profile', 'mem', 'stats', 'chats',
+            'search', 'export', 'reply', 'next']
+CALLBACK_PREFIXES = ['peek_page_', 'peek_', 'open_ticket_', 'view_ticket_', 'chats_', 'tickets_page_',
+                     'next_ticket', 'reply_to_', 'close_ticket_']
+
+
+def legacy_handlers():
+    """(content_types, commands, func) в порядке регистрации, как было до роутера."""
+    is_admin = lambda m: m.from_user.id in ADMIN_LIST  # noqa: E731
+    handlers = [(['text'], ['start'], None)]
+    handlers += [(['text'], [cmd], is_admin) for cmd in COMMANDS]
+    handlers += [
+        (['text'], None, lambda m: m.from_user.id not in ADMIN_LIST),
+        (['voice'], None, lambda m: m.from_user.id not in ADMIN_LIST),
+        (['photo', 'document', 'audio', 'video', 'sticker'], None, lambda m: m.from_user.id not in ADMIN_LIST),
+        (main.ROUTED_CONTENT_TYPES, None,
+         lambda m: m.reply_to_message is not None and m.from_user.id in ADMIN_LIST),
+    ]
+    return handlers
+
+
+def legacy_resolve_message(handlers, message):
+    for i, (content_types, commands, func) in enumerate(handlers):
+        if message.content_type not in content_types:
+            continue
+        if commands is not None:
+            if message.content_type != 'text' or not message.text.startswith('/'):
+                continue
+            if message.text.split()[0].split('@')[0][1:] not in commands:
+                continue
+        if func is not None and not func(message):
+            continue
+        return i
+    return None
+
+
+def legacy_resolve_callback(data):
+    if data == 'peek_done':
+        return 0, ()
+    for i, prefix in enumerate(CALLBACK_PREFIXES):
+        if data == prefix or data.startswith(prefix):
+            try:
+                return i, tuple(int(p) if p.isdigit() else p for p in data.split('_')[-2:])
+            except ValueError:
+                return i, None
+    return None, None
+
+
+def make_updates(n):
+    messages, callbacks = [], []
+    for i in range(n):
+        admin = ADMIN_LIST[i % len(ADMIN_LIST)]
+        kind = i % 6
+        if kind == 0:
+            messages.append(SimpleNamespace(from_user=SimpleNamespace(id=10_000 + i), content_type='text',
+                                            text="не работает впн", reply_to_message=None))
+        elif kind == 1:
+            messages.append(SimpleNamespace(from_user=SimpleNamespace(id=10_000 + i), content_type='photo',
+                                            text=None, reply_to_message=None))
+        elif kind == 2:
+            messages.append(SimpleNamespace(from_user=SimpleNamespace(id=admin), content_type='text',
+                                            text="/next", reply_to_message=None))
+        elif kind == 3:
+            messages.append(SimpleNamespace(from_user=SimpleNamespace(id=admin), content_type='text',
+                                            text="ответ", reply_to_message=SimpleNamespace(message_id=1)))
+        elif kind == 4:
+            callbacks.append(f"close_ticket_{10_000 + i}")
+        else:
+            callbacks.append(f"chats_tickets_{i % 100}")
+    return messages, callbacks
+
+
+def timed(fn, items):
+    start = time.perf_counter()
+    for item in items:
+        fn(item)
+    return time.perf_counter() - start
+
+
+if __name__ == '__main__':
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 300_000
+    messages, callbacks = make_updates(n)
+    handlers = legacy_handlers()
+
+    old_msg = timed(lambda m: legacy_resolve_message(handlers, m), messages)
+    new_msg = timed(main.router.resolve_message, messages)
+    old_cb = timed(legacy_resolve_callback, callbacks)
+    new_cb = timed(main.router.resolve_callback, callbacks)
+
+    print(f"messages:  {len(messages)}, callbacks: {len(callbacks)}")
+    print(f"message   legacy: {old_msg / len(messages) * 1e9:8.0f} ns/update   "
+          f"router: {new_msg / len(messages) * 1e9:8.0f} ns/update")
+    print(f"callback  legacy: {old_cb / len(callbacks) * 1e9:8.0f} ns/update   "
+          f"router: {new_cb / len(callbacks) * 1e9:8.0f} ns/update")
@@ -1,27 +1,146 @@
 import os
 import logging
+import logging.handlers
 import telebot
-from telebot import types
+from telebot import types, apihelper
 from dotenv import load_dotenv
-from collections import defaultdict
+from collections import defaultdict, OrderedDict, deque
+from contextlib import contextmanager
+from functools import wraps
 from datetime import datetime, timedelta
 import requests
 import tempfile
 import json
+import threading
+import time
+import bisect
+import re
+import math
+import random
+import uuid
+import hmac
+import hashlib
+import io
+import sys
+import tracemalloc
+import gzip
+import sqlite3
+import queue
+import html
+import fnmatch
+import copy
+import atexit
 
 # Загружаем переменные из .env файла
 load_dotenv()
 
-# Настраиваем логирование
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s [%(levelname)s] %(message)s'
-)
+# ===== ЛОГИРОВАНИЕ =====
+
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'json')  # json | text
+LOG_RATE_LIMIT = 5  # предупреждений/ошибок с одного места кода за окно
+LOG_RATE_WINDOW = 60  # сек
+
+
+class UpdateContextFilter(logging.Filter):
+    """Добавляет в запись user_id, update_id и trace_id текущего апдейта (в потоке хендлера)."""
+
+    def filter(self, record):
+        record.user_id = getattr(update_context, "user_id", None)
+        record.update_id = getattr(update_context, "key", None)
+        trace = getattr(update_context, "trace", None)
+        record.trace_id = trace["trace_id"] if trace else None
+        return True
+
+
+class RateLimitFilter(logging.Filter):
+    """Не больше LOG_RATE_LIMIT WARNING+ записей с одного места за окно.
+
+    Место — extra={"rate_key": ...} или файл:строка вызова. Число
+    отброшенных попадает в поле suppressed первой записи следующего окна.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._lock = threading.Lock()
+        self._sites = {}  # key -> [window_start, count, suppressed]
+
+    def filter(self, record):
+        if record.levelno < logging.WARNING:
+            return True
+        key = getattr(record, "rate_key", None) or (record.pathname, record.lineno)
+        now = time.monotonic()
+        with self._lock:
+            site = self._sites.get(key)
+            if site is None or now - site[0] >= LOG_RATE_WINDOW:
+                if site and site[2]:
+                    record.suppressed = site[2]
+                self._sites[key] = [now, 1, 0]
+                return True
+            site[1] += 1
+            if site[1] <= LOG_RATE_LIMIT:
+                return True
+            site[2] += 1
+            return False
+
+
+class LogQueueHandler(logging.handlers.QueueHandler):
+    """Кладёт запись в очередь; сообщение и traceback собираются здесь, JSON — в потоке listener."""
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class JsonLogFormatter(logging.Formatter):
+    FIELDS = ("user_id", "update_id", "trace_id", "suppressed")
+
+    def format(self, record):
+        entry = {
+            "ts": datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for field in self.FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False)
+
+
+def setup_logging():
+    """Корневой логгер пишет в очередь; в stderr пишет фоновый QueueListener."""
+    stream = logging.StreamHandler(sys.stderr)
+    stream.setFormatter(JsonLogFormatter() if LOG_FORMAT == 'json'
+                        else logging.Formatter('%(asctime)s [%(levelname)s] %(message)s'))
+    log_queue = queue.SimpleQueue()
+    handler = LogQueueHandler(log_queue)
+    handler.addFilter(RateLimitFilter())
+    handler.addFilter(UpdateContextFilter())
+    root = logging.getLogger()
+    root.setLevel(LOG_LEVEL)
+    root.handlers[:] = [handler]
+    listener = logging.handlers.QueueListener(log_queue, stream)
+    listener.start()
+    atexit.register(listener.stop)
+
+
+setup_logging()
 logger = logging.getLogger(__name__)
 
 # Получаем токен бота и список админов из .env
 BOT_TOKEN = os.getenv('BOT_TOKEN_SUPPORT')
-ADMIN_IDS = list(map(int, os.getenv('ADMIN_IDS').split(',')))
+ADMIN_IDS = frozenset(map(int, os.getenv('ADMIN_IDS').split(',')))
+# Супергруппа с темами: тикет = тема, одна отправка вместо рассылки по ADMIN_IDS; 0 — выключено
+ADMIN_GROUP_ID = int(os.getenv('ADMIN_GROUP_ID') or 0)
 API_URL = os.getenv('API_URL_SUPPORT')
 SUPPORT_API_URL = os.getenv('SUPPORT_API_URL', 'http://vpn-api:8080')
 PROXYAPI_KEY = os.getenv('PROXYAPI_KEY', '')
@@ -34,11 +153,283 @@ def admin_headers():
 def internal_headers():
     return {"X-Internal-Key": INTERNAL_KEY, "Content-Type": "application/json"}
 
+
+# Контекст текущего апдейта (ставится декоратором update_handler в потоке хендлера)
+update_context = threading.local()
+
+
+def idempotency_key(action: str):
+    """Ключ идемпотентности для действия в рамках текущего апдейта (или None)."""
+    key = getattr(update_context, "key", None)
+    return f"{key}:{action}" if key else None
+
+
+def with_idempotency(headers: dict, action: str):
+    key = idempotency_key(action)
+    if key:
+        headers["Idempotency-Key"] = key
+    return headers
+
+
+# ===== ТРАССИРОВКА =====
+
+TRACE_FILE = os.getenv('TRACE_FILE', '/data/traces.jsonl')
+TRACE_FILE_MAX_BYTES = 10 * 1024 * 1024
+TRACES_PER_USER = 20
+TRACE_USERS = 1000
+TRACE_QUEUE_SIZE = 10000  # трейсов в очереди на запись; сверх — отбрасываем
+_ID_IN_PATH_RE = re.compile(r"/-?\d+(?=/|$)")
+
+
+class Tracer:
+    """Трейсы апдейтов: спаны upstream- и Telegram-вызовов, экспорт в JSONL.
+
+    Трейс живёт в update_context потока хендлера; вне апдейта (таймеры,
+    поллинг) span() ничего не делает. В файл трейсы пишет фоновый поток
+    пачками, как QueueListener логов — хендлер на диск не ходит.
+    """
+
+    def __init__(self, path: str):
+        self._path = path
+        self._lock = threading.Lock()
+        self._by_user = OrderedDict()  # user_id -> deque(trace)
+        self._queue = queue.Queue(maxsize=TRACE_QUEUE_SIZE)
+        self.dropped = 0
+        threading.Thread(target=self._run, daemon=True, name="trace-writer").start()
+
+    def start(self, handler: str, user_id):
+        update_context.trace = {
+            "trace_id": uuid.uuid4().hex[:16],
+            "handler": handler,
+            "users": [user_id] if user_id else [],
+            "start": time.time(),
+            "_t0": time.perf_counter(),
+            "spans": [],
+        }
+        return update_context.trace
+
+    def finish(self):
+        trace = getattr(update_context, "trace", None)
+        update_context.trace = None
+        if trace is None:
+            return
+        trace["duration_ms"] = round((time.perf_counter() - trace.pop("_t0")) * 1000, 1)
+        with self._lock:
+            for user_id in trace["users"]:
+                traces = self._by_user.get(user_id)
+                if traces is None:
+                    traces = self._by_user[user_id] = deque(maxlen=TRACES_PER_USER)
+                    while len(self._by_user) > TRACE_USERS:
+                        self._by_user.popitem(last=False)
+                else:
+                    self._by_user.move_to_end(user_id)
+                traces.append(trace)
+        self._export(trace)
+
+    def _export(self, trace: dict):
+        try:
+            self._queue.put_nowait(trace)
+        except queue.Full:
+            self.dropped += 1
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            while True:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            self._write(batch)
+
+    def _write(self, batch):
+        try:
+            if os.path.exists(self._path) and os.path.getsize(self._path) > TRACE_FILE_MAX_BYTES:
+                os.replace(self._path, self._path + ".1")
+            with open(self._path, 'a') as f:
+                f.write("".join(json.dumps(trace, ensure_ascii=False) + "\n" for trace in batch))
+        except Exception as e:
+            logger.debug("Failed to export traces: %s", e)
+
+    def add_user(self, user_id: int):
+        """Привязывает текущий трейс ещё к одному юзеру (например, адресату ответа админа)."""
+        trace = getattr(update_context, "trace", None)
+        if trace is not None and user_id not in trace["users"]:
+            trace["users"].append(user_id)
+
+    @contextmanager
+    def span(self, name: str):
+        trace = getattr(update_context, "trace", None)
+        if trace is None:
+            yield
+            return
+        t0 = time.perf_counter()
+        record = {"name": name, "start_ms": round((t0 - trace["_t0"]) * 1000, 1)}
+        try:
+            yield
+        except Exception as e:
+            record["error"] = type(e).__name__
+            raise
+        finally:
+            record["duration_ms"] = round((time.perf_counter() - t0) * 1000, 1)
+            trace["spans"].append(record)
+
+    def recent(self, user_id: int, limit: int = 5):
+        with self._lock:
+            return list(self._by_user.get(user_id, ()))[-limit:]
+
+    @staticmethod
+    def current_id():
+        trace = getattr(update_context, "trace", None)
+        return trace["trace_id"] if trace else None
+
+
+tracer = Tracer(TRACE_FILE)
+
+
+# ===== ИНЪЕКЦИЯ СБОЕВ =====
+
+FAULTS = os.getenv('FAULTS', '')  # правила через ";", см. parse_fault_rule
+FAULT_INJECTION_ALLOWED = os.getenv('FAULT_INJECTION', '0') == '1' or bool(FAULTS)
+FAULT_DEFAULTS = {"latency": 0.0, "latency_rate": 1.0, "error": 0.0, "status": 503, "timeout": 0.0, "reset": 0.0}
+
+
+def parse_fault_rule(spec: str) -> dict:
+    """"PATTERN key=value ..." -> правило.
+
+    PATTERN — fnmatch по "METHOD:host/path" (id в пути заменены на :id) или
+    "tg.methodName", например POST:*/internal/support/chat, *proxyapi*, tg.send*. Ключи: latency=SEC (задержка), latency_rate=0..1 (доля
+    вызовов с задержкой, по умолчанию все), error=0..1 с status=CODE (503),
+    timeout=0..1, reset=0..1 (обрыв соединения).
+    """
+    pattern, *options = spec.split()
+    rule = dict(FAULT_DEFAULTS, pattern=pattern)
+    for option in options:
+        key, _, value = option.partition("=")
+        if key not in FAULT_DEFAULTS:
+            raise ValueError(f"неизвестный параметр {key!r}")
+        rule[key] = type(FAULT_DEFAULTS[key])(value)
+    return rule
+
+
+class FaultInjector:
+    """Задержки и сбои вокруг upstream- и Telegram-вызовов (для стейджинга).
+
+    Правила задаются env FAULTS или командой /faults; первое совпавшее по
+    шаблону правило решает судьбу вызова. Без правил apply() ничего не делает.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.rules = []
+        self.injected = defaultdict(int)  # (pattern, kind) -> count
+
+    def set_rules(self, rules):
+        with self._lock:
+            self.rules = list(rules)
+            self.injected.clear()
+
+    def add_rule(self, rule: dict):
+        with self._lock:
+            self.rules = [r for r in self.rules if r["pattern"] != rule["pattern"]] + [rule]
+
+    def apply(self, key: str, timeout=None):
+        """Задерживает вызов и/или подменяет его результат; None — выполнять по-настоящему."""
+        rule = next((r for r in self.rules if fnmatch.fnmatchcase(key, r["pattern"])), None)
+        if rule is None:
+            return None
+        if isinstance(timeout, tuple):
+            # telebot передаёт (connect, read) — ждём ответа столько же, сколько read
+            timeout = timeout[-1]
+        roll = random.random()
+        kind = None
+        if roll < rule["reset"]:
+            kind = "reset"
+        elif roll < rule["reset"] + rule["timeout"]:
+            kind = "timeout"
+        elif roll < rule["reset"] + rule["timeout"] + rule["error"]:
+            kind = "error"
+        delay = rule["latency"] if rule["latency"] and random.random() < rule["latency_rate"] else 0.0
+        if kind == "timeout":
+            delay = timeout or 30
+        elif timeout and delay >= timeout:
+            kind, delay = "timeout", timeout
+        with self._lock:
+            if delay and kind != "timeout":
+                self.injected[(rule["pattern"], "latency")] += 1
+            if kind:
+                self.injected[(rule["pattern"], kind)] += 1
+        if delay:
+            time.sleep(delay)
+        if kind == "reset":
+            raise requests.ConnectionError(f"injected connection reset ({key})")
+        if kind == "timeout":
+            raise requests.Timeout(f"injected timeout ({key})")
+        if kind == "error":
+            resp = requests.Response()
+            resp.status_code = rule["status"]
+            resp.reason = "Injected Fault"
+            resp.encoding = "utf-8"
+            resp._content = json.dumps({"ok": False, "error_code": rule["status"],
+                                        "description": "injected fault"}).encode()
+            resp.url = key
+            return resp
+        return None
+
+
+fault_injector = FaultInjector()
+if FAULTS:
+    fault_injector.set_rules(parse_fault_rule(spec) for spec in FAULTS.split(";") if spec.strip())
+
+
+def http_request(method: str, url: str, **kwargs):
+    """HTTP-запрос к upstream со спаном трейса и X-Request-ID для vpn-api."""
+    trace_id = tracer.current_id()
+    if trace_id and (url.startswith(SUPPORT_API_URL) or (API_URL and url.startswith(API_URL))):
+        kwargs["headers"] = dict(kwargs.get("headers") or {}, **{"X-Request-ID": trace_id})
+    host_path = url.split("://", 1)[-1]
+    slash = host_path.find("/")
+    path = _ID_IN_PATH_RE.sub("/:id", host_path[slash:] if slash != -1 else "/")
+    with tracer.span(f"{method.upper()} {path}"):
+        if fault_injector.rules:
+            host = host_path[:slash] if slash != -1 else host_path
+            injected = fault_injector.apply(f"{method.upper()}:{host}{path}", kwargs.get("timeout"))
+            if injected is not None:
+                return injected
+        return getattr(requests, method)(url, **kwargs)
+
+
+def http_get(url: str, **kwargs):
+    return http_request("get", url, **kwargs)
+
+
+def http_post(url: str, **kwargs):
+    return http_request("post", url, **kwargs)
+
+
+def http_patch(url: str, **kwargs):
+    return http_request("patch", url, **kwargs)
+
+
+def telegram_request_sender(method, request_url, params=None, files=None, timeout=None, proxies=None):
+    """Отправитель запросов Bot API для telebot — тот же запрос, но в спане трейса."""
+    name = f"tg.{request_url.rsplit('/', 1)[-1]}"
+    with tracer.span(name):
+        if fault_injector.rules:
+            injected = fault_injector.apply(name, timeout)
+            if injected is not None:
+                return injected
+        return apihelper._get_req_session().request(
+            method, request_url, params=params, files=files, timeout=timeout, proxies=proxies)
+
+
+apihelper.CUSTOM_REQUEST_SENDER = telegram_request_sender
+
+
 # Инициализируем бота
 bot = telebot.TeleBot(BOT_TOKEN)
 
 # Тикет-система (DB-backed via API)
-import threading
 AUTO_CLOSE_HOURS = 15
 REOPEN_COOLDOWN_MINUTES = 5  # Cooldown after auto-close before new ticket can be created
 auto_close_timers = {}  # user_id -> threading.Timer
@@ -48,66 +439,387 @@ user_data_cache = {}  # user_id -> username
 ticket_message_to_user = {}
 # Хранилище сообщений для пересылки: user_id -> [(chat_id, message_id), ...]
 user_conversation = defaultdict(list)
-# Текстовый лог переписки: user_id -> [{"role": "user"/"ai"/"admin", "text": "...", "time": "..."}, ...]
+
+
+class ChatMessage:
+    """Запись лога переписки: роль (интернированная строка), текст, время (epoch, сек)."""
+
+    __slots__ = ("role", "text", "ts")
+
+    def __init__(self, role: str, text: str, ts: int = 0):
+        self.role = sys.intern(role)
+        self.text = text
+        self.ts = ts
+
+    def to_row(self):
+        return [self.role, self.text, self.ts]
+
+    @classmethod
+    def from_state(cls, item):
+        """Из состояния на диске: [role, text, ts] или старый формат {"role", "text", "time": "HH:MM"}."""
+        if isinstance(item, dict):
+            # В старом формате время без даты — не восстанавливаем
+            return cls(item.get("role", "user"), item.get("text", ""), 0)
+        return cls(item[0], item[1], int(item[2]))
+
+    def __repr__(self):
+        return f"ChatMessage({self.role!r}, {self.text[:30]!r}, {self.ts})"
+
+
+# Текстовый лог переписки: user_id -> [ChatMessage, ...]
 chat_log = defaultdict(list)
 # Время последнего сообщения: user_id -> datetime
 user_last_activity = {}
 # In-memory cache of active tickets, synced with DB
 active_tickets = set()
 
+# SLA первого ответа по тарифу (мин). Платные тарифы — быстрее.
+PLAN_SLA_MINUTES = {
+    "bsfamily": 10,
+    "family": 10,
+    "bsbase": 15,
+    "base": 15,
+    "trial": 30,
+    "free": 60,
+}
+DEFAULT_SLA_MINUTES = 30
+# Поправка SLA по причине эскалации (мин): юзер без ответа ИИ ждёт меньше
+REASON_SLA_OFFSET_MINUTES = {
+    "AI недоступен": -5,
+    "Пользователь попросил оператора": 0,
+    "AI предложил связаться с оператором": 0,
+}
+TICKETS_PAGE_SIZE = 10
+
+
+class TicketQueue:
+    """Очередь активных тикетов, упорядоченная по дедлайну SLA.
+
+    Дедлайн = начало ожидания + SLA(тариф, причина), поэтому один ключ
+    учитывает и время ожидания, и приоритет. Ключи лежат в отсортированном
+    списке: голова очереди — O(1), страница — срез O(page), вставка — bisect.
+    Тикеты, на которые админ уже ответил, уходят в конец до следующего
+    сообщения пользователя.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._keys = []  # [(answered, deadline, user_id)]
+        self._entries = {}  # user_id -> {"waiting_since", "plan", "reason", "answered"}
+
+    @staticmethod
+    def _sla_seconds(entry):
+        minutes = PLAN_SLA_MINUTES.get(entry.get("plan") or "", DEFAULT_SLA_MINUTES)
+        minutes += REASON_SLA_OFFSET_MINUTES.get(entry.get("reason") or "", 0)
+        return max(minutes, 1) * 60
+
+    def _key(self, user_id, entry):
+        deadline = entry["waiting_since"] + self._sla_seconds(entry)
+        return (entry["answered"], deadline, user_id)
+
+    def _unlink(self, user_id):
+        entry = self._entries.get(user_id)
+        if entry is None:
+            return None
+        key = self._key(user_id, entry)
+        i = bisect.bisect_left(self._keys, key)
+        if i < len(self._keys) and self._keys[i] == key:
+            del self._keys[i]
+        return entry
+
+    def _link(self, user_id, entry):
+        self._entries[user_id] = entry
+        bisect.insort(self._keys, self._key(user_id, entry))
+
+    def push(self, user_id: int, reason: str = "", plan: str = "", since: float = None):
+        """Добавляет тикет (или обновляет причину/тариф у существующего)."""
+        with self._lock:
+            entry = self._unlink(user_id)
+            if entry is None:
+                entry = {"waiting_since": since or time.time(), "plan": plan,
+                         "reason": reason, "answered": False}
+            else:
+                entry["reason"] = reason or entry["reason"]
+                entry["plan"] = plan or entry["plan"]
+            self._link(user_id, entry)
+
+    def set_plan(self, user_id: int, plan: str):
+        with self._lock:
+            entry = self._unlink(user_id)
+            if entry is not None:
+                entry["plan"] = plan or ""
+                self._link(user_id, entry)
+
+    def remove(self, user_id: int):
+        with self._lock:
+            self._unlink(user_id)
+            self._entries.pop(user_id, None)
+
+    def mark_answered(self, user_id: int):
+        """Админ ответил — тикет уходит в конец очереди."""
+        with self._lock:
+            entry = self._unlink(user_id)
+            if entry is not None:
+                entry["answered"] = True
+                self._link(user_id, entry)
+
+    def touch_user(self, user_id: int):
+        """Юзер написал после ответа админа — снова ждёт, с текущего момента."""
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None or not entry["answered"]:
+                return
+            self._unlink(user_id)
+            entry["answered"] = False
+            entry["waiting_since"] = time.time()
+            self._link(user_id, entry)
+
+    def sync(self, user_ids):
+        """Приводит очередь к набору активных тикетов из БД."""
+        with self._lock:
+            for user_id in list(self._entries):
+                if user_id not in user_ids:
+                    self._unlink(user_id)
+                    del self._entries[user_id]
+            now = time.time()
+            for user_id in user_ids:
+                if user_id not in self._entries:
+                    self._link(user_id, {"waiting_since": now, "plan": "", "reason": "", "answered": False})
+
+    def next(self):
+        """user_id тикета с ближайшим дедлайном или None."""
+        with self._lock:
+            return self._keys[0][2] if self._keys else None
+
+    def page(self, page: int, size: int = TICKETS_PAGE_SIZE):
+        """Страница очереди: [(user_id, entry_copy, deadline)]."""
+        with self._lock:
+            start = page * size
+            return [(uid, dict(self._entries[uid]), deadline)
+                    for _, deadline, uid in self._keys[start:start + size]]
+
+    def breached(self, now: float = None):
+        """Список user_id с просроченным SLA (неотвеченные, дедлайн в прошлом)."""
+        now = now or time.time()
+        result = []
+        with self._lock:
+            for answered, deadline, uid in self._keys:
+                if answered or deadline > now:
+                    break
+                result.append(uid)
+        return result
+
+    def __len__(self):
+        return len(self._keys)
+
+    def to_state(self):
+        with self._lock:
+            return {str(uid): dict(e) for uid, e in self._entries.items()}
+
+    def load_state(self, data: dict):
+        with self._lock:
+            self._keys = []
+            self._entries = {}
+            for uid, e in data.items():
+                try:
+                    self._link(int(uid), {"waiting_since": float(e["waiting_since"]),
+                                          "plan": e.get("plan", ""), "reason": e.get("reason", ""),
+                                          "answered": bool(e.get("answered", False))})
+                except (KeyError, TypeError, ValueError):
+                    pass
+
+
+ticket_queue = TicketQueue()
+
+
+class TicketTopics:
+    """Темы тикетов в админской супергруппе ADMIN_GROUP_ID: индекс тема ↔ юзер.
+
+    Тема заводится на первый тикет юзера и переиспользуется при следующих
+    (закрытая переоткрывается), поэтому индекс только растёт; он лежит в
+    STATE_FILE, и ответы из темы доходят до юзера и после рестарта.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._create_lock = threading.Lock()  # одна тема на юзера при гонке хендлеров
+        self._by_topic = {}  # message_thread_id -> user_id
+        self._by_user = {}  # user_id -> [message_thread_id, closed]
+
+    def user_for(self, topic_id: int):
+        with self._lock:
+            return self._by_topic.get(topic_id)
+
+    def topic_for(self, user_id: int):
+        with self._lock:
+            entry = self._by_user.get(user_id)
+            return entry[0] if entry else None
+
+    def is_open(self, user_id: int):
+        with self._lock:
+            entry = self._by_user.get(user_id)
+            return bool(entry) and not entry[1]
+
+    def _link(self, user_id: int, topic_id: int, closed: bool = False):
+        self._by_user[user_id] = [topic_id, closed]
+        self._by_topic[topic_id] = user_id
+
+    def ensure(self, user_id: int, username: str):
+        """Открытая тема тикета юзера (создаёт/переоткрывает) или None, если Telegram отказал."""
+        with self._lock:
+            entry = self._by_user.get(user_id)
+            if entry and not entry[1]:
+                return entry[0]
+        with self._create_lock:
+            with self._lock:
+                entry = self._by_user.get(user_id)
+                if entry and not entry[1]:
+                    return entry[0]
+            if entry:
+                try:
+                    bot.reopen_forum_topic(ADMIN_GROUP_ID, entry[0])
+                    with self._lock:
+                        entry[1] = False
+                    save_state()
+                    return entry[0]
+                except Exception as e:
+                    # Тему могли удалить руками — заводим новую
+                    logger.warning("Failed to reopen topic %s for %s: %s", entry[0], user_id, e)
+            try:
+                topic = bot.create_forum_topic(ADMIN_GROUP_ID, f"{username} · {user_id}"[:128])
+            except Exception as e:
+                logger.error("Failed to create ticket topic for %s: %s", user_id, e)
+                return None
+            with self._lock:
+                self._link(user_id, topic.message_thread_id)
+        logger.info("Ticket topic %s created for user %s", topic.message_thread_id, user_id)
+        save_state()
+        return topic.message_thread_id
+
+    def close(self, user_id: int):
+        with self._lock:
+            entry = self._by_user.get(user_id)
+            if not entry or entry[1]:
+                return
+            entry[1] = True
+        save_state()
+        try:
+            bot.close_forum_topic(ADMIN_GROUP_ID, entry[0])
+        except Exception as e:
+            logger.error("Failed to close topic %s for %s: %s", entry[0], user_id, e)
+
+    def __len__(self):
+        return len(self._by_user)
+
+    def to_state(self):
+        with self._lock:
+            return {str(uid): list(entry) for uid, entry in self._by_user.items()}
+
+    def load_state(self, data: dict):
+        with self._lock:
+            self._by_topic = {}
+            self._by_user = {}
+            for uid, (topic_id, closed) in data.items():
+                self._link(int(uid), int(topic_id), bool(closed))
+
+
+ticket_topics = TicketTopics()
+
+
+def save_chat_message(user_id: int, role: str, content: str):
+    """Сохраняет сообщение в БД (для веб-админки), с ключом идемпотентности апдейта.
+
+    Кэш просмотра сбрасывается и после POST: peek, пришедший между
+    append_chat_log и сохранением, закэшировал историю без этого сообщения.
+    """
+    try:
+        http_post(f"{SUPPORT_API_URL}/admin/chats/{user_id}/save",
+                      json={"role": role, "content": content},
+                      headers=with_idempotency(admin_headers(), f"chat-save:{role}"), timeout=5)
+    except Exception:
+        pass
+    conversation_viewer.invalidate(user_id)
+
+
+def append_chat_log(user_id: int, role: str, text: str):
+    """Добавляет сообщение в лог переписки, поисковый индекс и сбрасывает кэш просмотра диалога."""
+    record = ChatMessage(role, text, int(time.time()))
+    chat_log[user_id].append(record)
+    conversation_viewer.invalidate(user_id)
+    search_index.add(user_id, record)
+
 
 def db_open_ticket(user_id: int, username: str = "", reason: str = ""):
     """Create/reopen ticket in DB."""
     try:
-        requests.post(f"{SUPPORT_API_URL}/admin/tickets/open",
-                      json={"telegram_id": user_id, "username": username, "reason": reason}, headers=admin_headers(), timeout=5)
+        http_post(f"{SUPPORT_API_URL}/admin/tickets/open",
+                      json={"telegram_id": user_id, "username": username, "reason": reason},
+                      headers=with_idempotency(admin_headers(), f"ticket-open:{user_id}"), timeout=5)
     except Exception as e:
-        logger.error(f"Failed to open ticket in DB: {e}")
+        logger.error("Failed to open ticket in DB: %s", e)
     active_tickets.add(user_id)
+    ticket_queue.push(user_id, reason=reason)
 
 
 def db_close_ticket(user_id: int):
     """Close ticket in DB."""
     try:
-        requests.post(f"{SUPPORT_API_URL}/admin/tickets/close",
+        http_post(f"{SUPPORT_API_URL}/admin/tickets/close",
                       json={"telegram_id": user_id}, headers=admin_headers(), timeout=5)
     except Exception as e:
-        logger.error(f"Failed to close ticket in DB: {e}")
+        logger.error("Failed to close ticket in DB: %s", e)
     active_tickets.discard(user_id)
+    ticket_queue.remove(user_id)
 
 
 def db_load_active_tickets():
     """Load active tickets from DB on startup."""
     try:
-        resp = requests.get(f"{SUPPORT_API_URL}/admin/tickets/active", headers=admin_headers(), timeout=5)
+        resp = http_get(f"{SUPPORT_API_URL}/admin/tickets/active", headers=admin_headers(), timeout=5)
         if resp.status_code == 200:
             data = resp.json()
             return set(t["telegram_id"] for t in data)
     except Exception as e:
-        logger.error(f"Failed to load active tickets from DB: {e}")
+        logger.error("Failed to load active tickets from DB: %s", e)
     return set()
 
 
-def sync_active_tickets():
-    """Periodically sync active tickets from DB (catches tickets opened from web/admin)."""
-    global active_tickets
+_last_ticket_sync = 0.0
+
+
+def sync_active_tickets(max_age: float = 0):
+    """Periodically sync active tickets from DB (catches tickets opened from web/admin).
+
+    max_age — пропустить синк, если последний был не раньше max_age секунд назад.
+    """
+    global active_tickets, _last_ticket_sync
+    if max_age and time.monotonic() - _last_ticket_sync < max_age:
+        return
+    _last_ticket_sync = time.monotonic()
     try:
         db_tickets = db_load_active_tickets()
         if db_tickets != active_tickets:
             added = db_tickets - active_tickets
             removed = active_tickets - db_tickets
             active_tickets = db_tickets
+            ticket_queue.sync(active_tickets)
             if added:
-                logger.info(f"[sync_tickets] Added from DB: {added}")
+                logger.info("[sync_tickets] Added from DB: %s", added)
                 # Schedule auto-close for newly discovered tickets (e.g. from website)
                 for user_id in added:
+                    profile_prefetcher.warm(user_id, "web_ticket")
+                    if user_id not in support_stats.ticket_opened_at:
+                        support_stats.ticket_opened(user_id, "web")
                     if user_id not in auto_close_timers:
                         schedule_auto_close(user_id)
-                        logger.info(f"[sync_tickets] Scheduled auto-close for {user_id}")
+                        logger.info("[sync_tickets] Scheduled auto-close for %s", user_id)
             if removed:
-                logger.info(f"[sync_tickets] Removed (closed in DB): {removed}")
+                logger.info("[sync_tickets] Removed (closed in DB): %s", removed)
+                if ADMIN_GROUP_ID:
+                    for user_id in removed:
+                        ticket_topics.close(user_id)
     except Exception as e:
-        logger.error(f"[sync_tickets] Error: {e}")
+        logger.error("[sync_tickets] Error: %s", e)
 
 
 # Маппинг планов
@@ -146,24 +858,38 @@ USER_ESCALATION_PHRASES = [
     "свяжите с человеком", "соединить с оператором",
 ]
 
-STATE_FILE = '/data/bot_state.json'
+STATE_FILE = os.getenv('STATE_FILE', '/data/bot_state.json')
 
 
 def save_state():
     """Save bot state to disk for persistence across restarts."""
+    with tracer.span("save_state"):
+        _save_state()
+
+
+last_state_bytes = 0  # размер последнего записанного STATE_FILE
+
+
+def _save_state():
+    global last_state_bytes
     try:
         state = {
             'active_tickets': list(active_tickets),
             'user_data_cache': user_data_cache,
             'ticket_message_to_user': {str(k): v for k, v in ticket_message_to_user.items()},
             'user_last_activity': {str(k): v.isoformat() for k, v in user_last_activity.items()},
-            'chat_log': {str(k): v[-50:] for k, v in chat_log.items()},  # Keep last 50 msgs per user
+            # Keep last 50 msgs per user
+            'chat_log': {str(k): [m.to_row() for m in v[-50:]] for k, v in chat_log.items()},
+            'ticket_queue': ticket_queue.to_state(),
+            'ticket_topics': ticket_topics.to_state(),
         }
+        payload = json.dumps(state)
         os.makedirs(os.path.dirname(STATE_FILE), exist_ok=True)
         with open(STATE_FILE, 'w') as f:
-            json.dump(state, f)
+            f.write(payload)
+        last_state_bytes = len(payload.encode())
     except Exception as e:
-        logger.error(f"Failed to save state: {e}")
+        logger.error("Failed to save state: %s", e)
 
 
 def load_state():
@@ -186,17 +912,512 @@ def load_state():
                     pass
             # Restore chat_log
             for k, v in state.get('chat_log', {}).items():
-                chat_log[int(k)] = v
-            logger.info(f"State loaded: {len(active_tickets)} active tickets, {len(user_data_cache)} cached users, {len(chat_log)} chat logs")
+                chat_log[int(k)] = [ChatMessage.from_state(item) for item in v]
+            ticket_queue.load_state(state.get('ticket_queue', {}))
+            ticket_topics.load_state(state.get('ticket_topics', {}))
+            logger.info("State loaded: %s active tickets, %s cached users, %s chat logs", len(active_tickets), len(user_data_cache), len(chat_log))
     except Exception as e:
-        logger.error(f"Failed to load state: {e}")
+        logger.error("Failed to load state: %s", e)
+
+
+# ===== ДЕДУПЛИКАЦИЯ АПДЕЙТОВ =====
+
+UPDATES_STATE_FILE = os.getenv('UPDATES_STATE_FILE', '/data/processed_updates.json')
+UPDATES_WINDOW = 4096
+
+
+class UpdateTracker:
+    """Обработанные update_id: всё ниже base уже обработано, окно выше — битовая маска.
+
+    Состояние — два числа, пишется на диск после каждой пачки апдейтов и
+    после каждого хендлера, поэтому повторная доставка после рестарта
+    отбрасывается до хендлеров. Апдейты, чей хендлер ещё работает (start →
+    done), на диск не попадают: после падения посреди хендлера Telegram
+    доставит их снова.
+    """
+
+    def __init__(self, path: str, window: int = UPDATES_WINDOW):
+        self._lock = threading.Lock()
+        self._save_lock = threading.Lock()
+        self._path = path
+        self._window = window
+        self.base = 0
+        self.bits = 0
+        self.duplicates = 0
+        self._running = {}  # update_key -> update_id, хендлер ещё не закончил
+        self._held = set()  # update_key, которые хендлер отложил (альбом в буфере) — done() их не закрывает
+
+    def claim(self, update_id: int) -> bool:
+        """Помечает апдейт обработанным; False — он уже был."""
+        with self._lock:
+            if update_id < self.base:
+                self.duplicates += 1
+                return False
+            offset = update_id - self.base
+            if offset >= self._window:
+                new_base = update_id - self._window + 1
+                self.bits >>= new_base - self.base
+                self.base = new_base
+                offset = update_id - self.base
+            if (self.bits >> offset) & 1:
+                self.duplicates += 1
+                return False
+            self.bits |= 1 << offset
+            return True
+
+    def start(self, key: str, update_id: int):
+        """Апдейт ушёл в хендлер; сохраняется обработанным только после done(key)."""
+        with self._lock:
+            self._running[key] = update_id
+
+    def done(self, key: str):
+        with self._lock:
+            if key in self._held or self._running.pop(key, None) is None:
+                return
+        self.save()
+
+    def hold(self, key: str):
+        """Хендлер вернулся, но апдейт ещё не обработан; закрывает его release()."""
+        with self._lock:
+            if key in self._running:
+                self._held.add(key)
+
+    def release(self, keys):
+        with self._lock:
+            self._held.difference_update(keys)
+            finished = [key for key in keys if self._running.pop(key, None) is not None]
+        if finished:
+            self.save()
+
+    def save(self):
+        try:
+            with self._lock:
+                bits = self.bits
+                for update_id in self._running.values():
+                    if update_id >= self.base:
+                        bits &= ~(1 << (update_id - self.base))
+                data = {"base": self.base, "bits": format(bits, "x")}
+            with self._save_lock:
+                os.makedirs(os.path.dirname(self._path), exist_ok=True)
+                tmp_path = self._path + ".tmp"
+                with open(tmp_path, 'w') as f:
+                    json.dump(data, f)
+                os.replace(tmp_path, self._path)
+        except Exception as e:
+            logger.error("Failed to save processed updates: %s", e)
+
+    def load(self):
+        try:
+            if os.path.exists(self._path):
+                with open(self._path, 'r') as f:
+                    data = json.load(f)
+                with self._lock:
+                    self.base = int(data.get("base", 0))
+                    self.bits = int(data.get("bits", "0"), 16)
+        except Exception as e:
+            logger.error("Failed to load processed updates: %s", e)
+
+
+update_tracker = UpdateTracker(UPDATES_STATE_FILE)
+
+
+# ===== ЗАПИСЬ АПДЕЙТОВ =====
+
+RECORD_UPDATES_FILE = os.getenv('RECORD_UPDATES_FILE', '')  # пусто — запись выключена
+RECORD_UPDATES_SALT = os.getenv('RECORD_UPDATES_SALT', '') or BOT_TOKEN or ''
+RECORDED_UPDATE_FIELDS = ("message", "edited_message", "callback_query")
+# Структурные поля, которые пишутся как есть; любые другие строки и числа обезличиваются
+_ANON_SAFE_KEYS = {"message_id", "message_thread_id", "date", "edit_date", "forward_date", "type", "is_bot",
+                   "is_topic_message", "is_automatic_forward", "has_protected_content", "language_code",
+                   "offset", "length", "duration", "width", "height", "file_size", "mime_type"}
+_ANON_TEXT_KEYS = {"text", "caption"}
+_ANON_CALLBACK_KEYS = {"data", "callback_data"}
+_LONG_NUMBER_RE = re.compile(r"-?\d{5,}")
+_WORD_RE = re.compile(r"\S+")
+
+
+class UpdateRecorder:
+    """Пишет сырые апдейты в JSONL для replay_updates.py, обезличивая их.
+
+    Работает по allowlist: как есть остаются только структурные поля
+    (_ANON_SAFE_KEYS) и bool. Остальные целые заменяются стабильным HMAC
+    (тот же юзер в from, contact и forward_origin получает один ID), строки —
+    хэшем, дробные (координаты) — нулём. В тексте слова становятся хэш-
+    токенами той же длины, но команды и словарь эскалаций/FAQ сохраняются,
+    а в callback_data меняются только длинные числа — при воспроизведении
+    срабатывают те же ветки.
+    """
+
+    def __init__(self, path: str, salt: str):
+        self._path = path
+        self._salt = salt.encode()
+        self._lock = threading.Lock()
+        self._vocabulary = None
+        self._header_written = False
+        self.recorded = 0
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self._path)
+
+    def _digest(self, value: str) -> bytes:
+        return hmac.new(self._salt, value.encode(), hashlib.sha256).digest()
+
+    def anon_id(self, value: int) -> int:
+        anon = 10 ** 9 + int.from_bytes(self._digest(str(abs(value)))[:4], "big") % 10 ** 9
+        return -anon if value < 0 else anon
+
+    def anon_string(self, value: str) -> str:
+        return self._digest(value).hex()[:max(len(value), 8)]
+
+    def _anon_word(self, word: str) -> str:
+        if word.startswith('/') or word.lower().strip(".,!?") in self._vocabulary:
+            return word
+        if _LONG_NUMBER_RE.fullmatch(word):
+            return str(self.anon_id(int(word)))
+        return self._digest(word).hex()[:len(word)].ljust(len(word), "0")
+
+    def anon_text(self, text: str) -> str:
+        if self._vocabulary is None:
+            words = set()
+            for phrase in USER_ESCALATION_PHRASES:
+                words.update(phrase.split())
+            for entry in faq_engine.entries:
+                for question in entry.get("questions", []):
+                    words.update(question.lower().split())
+            self._vocabulary = words
+        return _WORD_RE.sub(lambda m: self._anon_word(m.group()), text)
+
+    def anonymize(self, value, key=None):
+        if isinstance(value, dict):
+            return {k: self.anonymize(item, k) for k, item in value.items()}
+        if isinstance(value, list):
+            return [self.anonymize(item, key) for item in value]
+        if value is None or isinstance(value, bool) or key in _ANON_SAFE_KEYS:
+            return value
+        if isinstance(value, str):
+            if key in _ANON_TEXT_KEYS:
+                return self.anon_text(value)
+            if key in _ANON_CALLBACK_KEYS:
+                return _LONG_NUMBER_RE.sub(lambda m: str(self.anon_id(int(m.group()))), value)
+            return self.anon_string(value)
+        if isinstance(value, int):
+            return self.anon_id(value)
+        if isinstance(value, float):
+            return 0.0
+        return None
+
+    def record(self, updates):
+        lines = []
+        for update in updates:
+            raw = {"update_id": update.update_id}
+            for field in RECORDED_UPDATE_FIELDS:
+                data = getattr(getattr(update, field, None), "json", None)
+                if isinstance(data, str):
+                    data = json.loads(data)
+                if isinstance(data, dict):
+                    raw[field] = self.anonymize(data, field)
+            if len(raw) > 1:
+                lines.append(json.dumps({"ts": round(time.time(), 3), "update": raw}, ensure_ascii=False))
+        if not lines:
+            return
+        try:
+            with self._lock:
+                with open(self._path, 'a') as f:
+                    if not self._header_written:
+                        f.write(json.dumps({"admins": sorted(self.anon_id(a) for a in ADMIN_IDS)}) + "\n")
+                        self._header_written = True
+                    f.write("\n".join(lines) + "\n")
+                self.recorded += len(lines)
+        except Exception as e:
+            logger.error("Failed to record updates: %s", e)
+
+
+update_recorder = UpdateRecorder(RECORD_UPDATES_FILE, RECORD_UPDATES_SALT)
+_process_new_updates = bot.process_new_updates
+
+
+def process_new_updates_once(updates):
+    """Пропускает в хендлеры только ещё не обработанные апдейты.
+
+    Хендлеры telebot выполняет в своём пуле, поэтому обработанным апдейт
+    становится из хендлера (update_tracker.done); апдейты без хендлера
+    сохраняются сразу.
+    """
+    fresh = [u for u in updates if update_tracker.claim(u.update_id)]
+    if len(fresh) != len(updates):
+        logger.info("Skipped %s redelivered updates", len(updates) - len(fresh))
+    if fresh:
+        for u in fresh:
+            if u.callback_query:
+                update_tracker.start(update_key(u.callback_query), u.update_id)
+            elif u.message and u.message.content_type in ROUTED_CONTENT_TYPES:
+                update_tracker.start(update_key(u.message), u.update_id)
+        update_tracker.save()
+        if update_recorder.enabled:
+            update_recorder.record(fresh)
+        _process_new_updates(fresh)
+
+
+bot.process_new_updates = process_new_updates_once
+
+
+# ===== ПРОФИЛИРОВАНИЕ =====
+
+SLOW_UPDATE_MS = float(os.getenv('SLOW_UPDATE_MS', '3000'))
+PROFILE_MAX_SECONDS = 300
+PROFILE_INTERVAL = 0.01  # сек между сэмплами стеков
+
+
+class HandlerStats:
+    """Суммарное wall/CPU-время по хендлерам."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = {}  # name -> [count, wall_ms, cpu_ms, max_wall_ms, slow]
+
+    def record(self, name: str, wall_ms: float, cpu_ms: float, slow: bool):
+        with self._lock:
+            st = self._stats.setdefault(name, [0, 0.0, 0.0, 0.0, 0])
+            st[0] += 1
+            st[1] += wall_ms
+            st[2] += cpu_ms
+            st[3] = max(st[3], wall_ms)
+            st[4] += slow
+
+    def snapshot(self):
+        with self._lock:
+            return {name: list(st) for name, st in self._stats.items()}
+
+
+handler_stats = HandlerStats()
+
+
+def log_slow_update(trace: dict, wall_ms: float, cpu_ms: float):
+    """Пишет в лог разбивку медленного апдейта по спанам."""
+    lines = [f"Slow update: {trace['handler']} {wall_ms:.0f} ms wall, {cpu_ms:.0f} ms CPU "
+             f"(trace {trace['trace_id']}, users {trace['users']})"]
+    for sp in sorted(trace["spans"], key=lambda x: -x["duration_ms"]):
+        error = f" error={sp['error']}" if "error" in sp else ""
+        lines.append(f"    {sp['duration_ms']:>8.1f} ms  +{sp['start_ms']:.0f}  {sp['name']}{error}")
+    untraced = wall_ms - sum(sp["duration_ms"] for sp in trace["spans"])
+    lines.append(f"    {untraced:>8.1f} ms  (вне спанов)")
+    logger.warning("\n".join(lines))
+
+
+class SamplingProfiler:
+    """Сэмплирующий профайлер: снимает стеки всех потоков, отдаёт collapsed stacks."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.running = False
+
+    def start(self, seconds: float, on_done):
+        """Запускает сэмплирование в фоне; on_done(folded_text, samples) по окончании."""
+        with self._lock:
+            if self.running:
+                return False
+            self.running = True
+        threading.Thread(target=self._run, args=(seconds, on_done), daemon=True, name="profiler").start()
+        return True
+
+    def _run(self, seconds: float, on_done):
+        counts = defaultdict(int)
+        samples = 0
+        me = threading.get_ident()
+        names = {}
+        deadline = time.monotonic() + seconds
+        try:
+            while time.monotonic() < deadline:
+                for t in threading.enumerate():
+                    names[t.ident] = t.name
+                for ident, frame in sys._current_frames().items():
+                    if ident == me:
+                        continue
+                    stack = []
+                    while frame is not None:
+                        code = frame.f_code
+                        stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                        frame = frame.f_back
+                    stack.append(names.get(ident, str(ident)))
+                    counts[";".join(reversed(stack))] += 1
+                samples += 1
+                time.sleep(PROFILE_INTERVAL)
+            folded = "\n".join(f"{stack} {n}" for stack, n in sorted(counts.items(), key=lambda x: -x[1]))
+            on_done(folded, samples)
+        except Exception as e:
+            logger.error("Profiler error: %s", e)
+        finally:
+            with self._lock:
+                self.running = False
+
+
+profiler = SamplingProfiler()
+
+
+def update_key(update) -> str:
+    """Ключ апдейта: чат + message_id для сообщения, id колбэка."""
+    if hasattr(update, "message_id"):
+        return f"{update.chat.id}:{update.message_id}"
+    return f"cb:{update.id}"
+
+
+def update_handler(handler):
+    """Обёртка хендлера: трейс, wall/CPU-время, ключ идемпотентности и отметка апдейта обработанным."""
+    @wraps(handler)
+    def wrapper(update):
+        update_context.key = update_key(update)
+        update_context.user_id = getattr(update.from_user, "id", None)
+        trace = tracer.start(handler.__name__, getattr(update.from_user, "id", None))
+        wall0, cpu0 = time.perf_counter(), time.thread_time()
+        try:
+            return handler(update)
+        finally:
+            wall_ms = (time.perf_counter() - wall0) * 1000
+            cpu_ms = (time.thread_time() - cpu0) * 1000
+            slow = wall_ms >= SLOW_UPDATE_MS
+            handler_stats.record(handler.__name__, wall_ms, cpu_ms, slow)
+            if slow:
+                log_slow_update(trace, wall_ms, cpu_ms)
+            tracer.finish()
+            update_tracker.done(update_context.key)
+            update_context.key = None
+            update_context.user_id = None
+    return wrapper
+
+
+# ===== РОУТИНГ АПДЕЙТОВ =====
+
+ROUTED_CONTENT_TYPES = ['text', 'photo', 'document', 'audio', 'video', 'voice', 'sticker']
+
+
+class UpdateRouter:
+    """Диспетчер апдейтов по таблицам вместо цепочки func-фильтров telebot.
+
+    Сообщение классифицируется один раз (роль, команда, content_type, reply),
+    хендлер берётся из dict: команды — по (имя, роль), остальное — по
+    (роль, content_type, reply). Сообщения в админской супергруппе идут в
+    отдельную таблицу по content_type, и только от админов. Колбэки ищутся
+    по самому длинному префиксу callback_data, аргументы после префикса
+    разбираются по заданным типам.
+    """
+
+    def __init__(self, admin_ids, admin_chat_id=0):
+        self._admin_ids = admin_ids
+        self._admin_chat_id = admin_chat_id
+        self._commands = {}   # (command, role) -> handler
+        self._messages = {}   # (role, content_type, is_reply) -> handler
+        self._group = {}      # content_type -> handler для сообщений в админской группе
+        self._callbacks = {}  # prefix -> (handler, arg_types)
+
+    def role(self, user):
+        return "admin" if user.id in self._admin_ids else "user"
+
+    def command(self, name, role="admin"):
+        """role="any" — команда доступна всем."""
+        def decorator(fn):
+            self._commands[(name, role)] = fn
+            return fn
+        return decorator
+
+    def message(self, content_types, role="user", reply=None):
+        """reply=None — независимо от того, ответ ли это на другое сообщение."""
+        def decorator(fn):
+            for content_type in content_types:
+                for is_reply in ((False, True) if reply is None else (reply,)):
+                    self._messages.setdefault((role, content_type, is_reply), fn)
+            return fn
+        return decorator
+
+    def group_message(self, content_types):
+        """Сообщения админов в супергруппе admin_chat_id (кроме команд)."""
+        def decorator(fn):
+            for content_type in content_types:
+                self._group.setdefault(content_type, fn)
+            return fn
+        return decorator
+
+    def callback(self, prefix, *arg_types):
+        """prefix без аргументов матчится точно, с аргументами — как префикс "name_"."""
+        def decorator(fn):
+            self._callbacks[prefix] = (fn, arg_types)
+            return fn
+        return decorator
+
+    def resolve_message(self, message):
+        role = self.role(message.from_user)
+        in_admin_group = self._admin_chat_id and message.chat.id == self._admin_chat_id
+        if in_admin_group and role != "admin":
+            return None
+        if message.content_type == 'text' and message.text.startswith('/'):
+            name = message.text.split(maxsplit=1)[0][1:].split('@', 1)[0]
+            handler = self._commands.get((name, role)) or self._commands.get((name, "any"))
+            if handler:
+                return handler
+        if in_admin_group:
+            return self._group.get(message.content_type)
+        return self._messages.get((role, message.content_type, message.reply_to_message is not None))
+
+    def resolve_callback(self, data):
+        """(handler, args); args=None — префикс найден, но payload не разобрался."""
+        route = self._callbacks.get(data)
+        if route:
+            return route[0], ()
+        end = len(data)
+        while True:
+            end = data.rfind('_', 0, end)
+            if end < 0:
+                return None, None
+            route = self._callbacks.get(data[:end + 1])
+            if route:
+                break
+        handler, arg_types = route
+        parts = data[end + 1:].split('_', len(arg_types) - 1) if arg_types else []
+        if len(parts) != len(arg_types):
+            return handler, None
+        try:
+            return handler, tuple([t(part) for t, part in zip(arg_types, parts)])
+        except ValueError:
+            return handler, None
+
+    def dispatch_message(self, message):
+        handler = self.resolve_message(message)
+        if handler:
+            handler(message)
+
+    def dispatch_callback(self, call):
+        if self.role(call.from_user) != "admin":
+            bot.answer_callback_query(call.id)
+            return
+        handler, args = self.resolve_callback(call.data or "")
+        if handler is None:
+            bot.answer_callback_query(call.id)
+            return
+        if args is None:
+            bot.answer_callback_query(call.id, text="Ошибка")
+            return
+        handler(call, *args)
+
+
+router = UpdateRouter(ADMIN_IDS, ADMIN_GROUP_ID)
+
+
+@bot.message_handler(content_types=ROUTED_CONTENT_TYPES)
+def route_message(message):
+    try:
+        router.dispatch_message(message)
+    finally:
+        # Сообщение могло не найти хендлер (или тот не обёрнут update_handler)
+        update_tracker.done(update_key(message))
 
 
 # Load persisted state
+update_tracker.load()
 load_state()
 # Sync active tickets from DB
 active_tickets = db_load_active_tickets()
-logger.info(f"Loaded {len(active_tickets)} active tickets from DB")
+ticket_queue.sync(active_tickets)
+logger.info("Loaded %s active tickets from DB", len(active_tickets))
 
 
 def format_subscription_end(sub_end_str):
@@ -214,27 +1435,426 @@ def get_squad_name(uuid):
     return SQUAD_NAMES.get(uuid, uuid)
 
 
+# ===== СТАТИСТИКА =====
+
+STATS_FILE = os.getenv('STATS_FILE', '/data/support_stats.json')
+STATS_RETENTION_HOURS = 31 * 24
+CONVERSATION_GAP = 3600  # сек тишины, после которых диалог с ИИ считается новым
+STATS_PERIODS = {"1h": 1, "24h": 24, "7d": 7 * 24, "30d": 30 * 24}
+ESCALATION_REASON_KEYS = (
+    ("Пользователь попросил оператора", "esc_user_phrase"),
+    ("AI предложил связаться с оператором", "esc_ai_trigger"),
+    ("AI недоступен", "esc_ai_unavailable"),
+)
+
+
+class LatencyHistogram:
+    """Лог-гистограмма (шаг ×1.2 от 10 мс): сливается сложением, даёт перцентили."""
+
+    BASE = 0.01
+    FACTOR = math.log(1.2)
+    MAX_BIN = 150
+
+    def __init__(self, bins=None):
+        self.bins = bins or {}  # bin -> count
+
+    def add(self, seconds: float):
+        b = 0 if seconds <= self.BASE else min(int(math.log(seconds / self.BASE) / self.FACTOR) + 1, self.MAX_BIN)
+        self.bins[b] = self.bins.get(b, 0) + 1
+
+    def merge(self, other):
+        for b, n in other.bins.items():
+            self.bins[b] = self.bins.get(b, 0) + n
+
+    @property
+    def count(self):
+        return sum(self.bins.values())
+
+    def percentile(self, p: float):
+        """Верхняя граница бина, в который попадает p-й перцентиль (сек), или None."""
+        total = self.count
+        if not total:
+            return None
+        rank = total * p / 100
+        seen = 0
+        for b in sorted(self.bins):
+            seen += self.bins[b]
+            if seen >= rank:
+                return self.BASE * math.exp(self.FACTOR * b)
+        return None
+
+
+class SupportStats:
+    """Почасовые счётчики и гистограммы; /stats сливает часы за период.
+
+    Обновляются хендлерами по событиям, историю не пересканируют.
+    Пишутся в STATS_FILE при смене часа и на событиях тикетов.
+    """
+
+    HISTOGRAMS = ("ai_latency", "first_response", "ticket_duration")
+
+    def __init__(self, path: str):
+        self._path = path
+        self._lock = threading.Lock()
+        self._hours = OrderedDict()  # epoch hour -> {"counters": {}, "hist": {name: LatencyHistogram}}
+        self._conv_last_seen = {}  # user_id -> ts последнего ответа бота
+        self.ticket_opened_at = {}  # user_id -> ts открытия тикета
+        self.awaiting_first_response = set()
+
+    def _bucket(self, now: float):
+        hour = int(now // 3600)
+        bucket = self._hours.get(hour)
+        if bucket is None:
+            bucket = self._hours[hour] = {"counters": defaultdict(int),
+                                          "hist": {name: LatencyHistogram() for name in self.HISTOGRAMS}}
+            while self._hours and next(iter(self._hours)) <= hour - STATS_RETENTION_HOURS:
+                self._hours.popitem(last=False)
+            if len(self._hours) > 1:
+                threading.Thread(target=self.save, daemon=True).start()
+        return bucket
+
+    def incr(self, name: str, n: int = 1):
+        with self._lock:
+            self._bucket(time.time())["counters"][name] += n
+
+    def observe(self, name: str, seconds: float):
+        with self._lock:
+            self._bucket(time.time())["hist"][name].add(seconds)
+
+    def bot_answered(self, user_id: int):
+        """Ответ ИИ/FAQ юзеру; первый после паузы CONVERSATION_GAP — новый диалог."""
+        now = time.time()
+        with self._lock:
+            last = self._conv_last_seen.get(user_id)
+            self._conv_last_seen[user_id] = now
+            bucket = self._bucket(now)
+            bucket["counters"]["bot_answers"] += 1
+            if last is None or now - last > CONVERSATION_GAP:
+                bucket["counters"]["conversations"] += 1
+            if len(self._conv_last_seen) > 50000:
+                for uid in [u for u, ts in self._conv_last_seen.items() if now - ts > CONVERSATION_GAP]:
+                    del self._conv_last_seen[uid]
+
+    def ticket_opened(self, user_id: int, reason: str):
+        now = time.time()
+        key = next((k for prefix, k in ESCALATION_REASON_KEYS if reason.startswith(prefix)), "esc_other")
+        with self._lock:
+            bucket = self._bucket(now)
+            bucket["counters"]["tickets_opened"] += 1
+            bucket["counters"][key] += 1
+            last = self._conv_last_seen.get(user_id)
+            if last is not None and now - last <= CONVERSATION_GAP:
+                bucket["counters"]["escalated_conversations"] += 1
+            self.ticket_opened_at[user_id] = now
+            self.awaiting_first_response.add(user_id)
+        self.save()
+
+    def admin_replied(self, user_id: int):
+        with self._lock:
+            if user_id not in self.awaiting_first_response:
+                return
+            self.awaiting_first_response.discard(user_id)
+            opened = self.ticket_opened_at.get(user_id)
+            if opened:
+                self._bucket(time.time())["hist"]["first_response"].add(time.time() - opened)
+        self.save()
+
+    def ticket_closed(self, user_id: int, auto: bool):
+        now = time.time()
+        with self._lock:
+            bucket = self._bucket(now)
+            bucket["counters"]["tickets_closed"] += 1
+            if auto:
+                bucket["counters"]["tickets_auto_closed"] += 1
+            opened = self.ticket_opened_at.pop(user_id, None)
+            self.awaiting_first_response.discard(user_id)
+            if opened:
+                bucket["hist"]["ticket_duration"].add(now - opened)
+        self.save()
+
+    def summary(self, hours: int):
+        """Слияние последних hours часов: (counters, {name: LatencyHistogram})."""
+        since = int(time.time() // 3600) - hours + 1
+        counters = defaultdict(int)
+        hists = {name: LatencyHistogram() for name in self.HISTOGRAMS}
+        with self._lock:
+            for hour, bucket in self._hours.items():
+                if hour < since:
+                    continue
+                for k, v in bucket["counters"].items():
+                    counters[k] += v
+                for name, h in bucket["hist"].items():
+                    hists[name].merge(h)
+        return counters, hists
+
+    def save(self):
+        try:
+            with self._lock:
+                data = {
+                    "hours": {str(h): {"counters": dict(b["counters"]),
+                                       "hist": {n: h_.bins for n, h_ in b["hist"].items()}}
+                              for h, b in self._hours.items()},
+                    "ticket_opened_at": {str(k): v for k, v in self.ticket_opened_at.items()},
+                    "awaiting_first_response": list(self.awaiting_first_response),
+                }
+                payload = json.dumps(data)
+            os.makedirs(os.path.dirname(self._path), exist_ok=True)
+            tmp_path = self._path + ".tmp"
+            with open(tmp_path, 'w') as f:
+                f.write(payload)
+            os.replace(tmp_path, self._path)
+        except Exception as e:
+            logger.debug("Failed to save stats: %s", e)
+
+    def load(self):
+        try:
+            if not os.path.exists(self._path):
+                return
+            with open(self._path) as f:
+                data = json.load(f)
+            with self._lock:
+                for h, b in sorted(data.get("hours", {}).items(), key=lambda x: int(x[0])):
+                    self._hours[int(h)] = {
+                        "counters": defaultdict(int, b.get("counters", {})),
+                        "hist": {n: LatencyHistogram({int(k): v for k, v in b.get("hist", {}).get(n, {}).items()})
+                                 for n in self.HISTOGRAMS},
+                    }
+                self.ticket_opened_at = {int(k): v for k, v in data.get("ticket_opened_at", {}).items()}
+                self.awaiting_first_response = set(data.get("awaiting_first_response", []))
+        except Exception as e:
+            logger.error("Failed to load stats: %s", e)
+
+
+support_stats = SupportStats(STATS_FILE)
+support_stats.load()
+
+
+AI_CIRCUIT_FAILURES = 3  # подряд неудачных вызовов до размыкания
+AI_CIRCUIT_COOLDOWN = 60  # сек до пробного запроса
+
+
+class CircuitBreaker:
+    """Размыкатель: после N ошибок подряд не ходим в upstream cooldown секунд."""
+
+    def __init__(self, failures: int, cooldown: float):
+        self._lock = threading.Lock()
+        self._threshold = failures
+        self._cooldown = cooldown
+        self._failures = 0
+        self._opened_at = None
+        self._probing = False
+
+    @property
+    def is_open(self) -> bool:
+        with self._lock:
+            return self._opened_at is not None
+
+    def allow(self) -> bool:
+        """Можно ли делать запрос (в полуоткрытом состоянии — один пробный)."""
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if self._probing or time.monotonic() - self._opened_at < self._cooldown:
+                return False
+            self._probing = True
+            return True
+
+    def record(self, ok: bool):
+        with self._lock:
+            self._probing = False
+            if ok:
+                self._failures = 0
+                self._opened_at = None
+                return
+            self._failures += 1
+            if self._failures >= self._threshold:
+                if self._opened_at is None:
+                    logger.warning("AI circuit opened after %s failures", self._failures)
+                self._opened_at = time.monotonic()
+
+
+ai_circuit = CircuitBreaker(AI_CIRCUIT_FAILURES, AI_CIRCUIT_COOLDOWN)
+
+
+AI_TIMEOUT_MIN = 8  # сек, нижняя граница адаптивного таймаута попытки
+AI_TIMEOUT_MAX = 30  # сек, и потолок попытки, и общий дедлайн вызова
+AI_TIMEOUT_P99_FACTOR = 2
+AI_HEDGE_MIN_DELAY = 1.5  # сек, раньше хедж не отправляем
+AI_LATENCY_WINDOW = 200  # последних успешных попыток для перцентилей
+AI_LATENCY_MIN_SAMPLES = 20  # пока меньше — таймаут максимальный и без хеджа
+AI_MAX_ATTEMPTS = 3  # основная + хедж/повторы
+AI_RETRY_BUDGET_RATIO = 0.1  # хеджей и повторов — не больше 10% от вызовов
+AI_RETRY_BUDGET_MAX = 10
+AI_RETRY_BACKOFF = 0.5  # сек, база экспоненциального джиттера
+
+
+class AiUnavailable(Exception):
+    def __init__(self, outcome: str, detail: str):
+        super().__init__(f"{outcome}: {detail}")
+        self.outcome = outcome
+
+
+class AiClient:
+    """Клиент AI-чата: адаптивный таймаут, хедж после p95 и повторы в рамках бюджета.
+
+    Все попытки одного вызова идут с одним Idempotency-Key, так что сервер
+    отвечает на хедж тем же результатом. Бюджет пополняется на
+    AI_RETRY_BUDGET_RATIO с каждого вызова и тратится по 1 на хедж или
+    повтор — при сбое upstream лишняя нагрузка не растёт лавиной.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._latencies = deque(maxlen=AI_LATENCY_WINDOW)
+        self._budget = float(AI_RETRY_BUDGET_MAX)
+        self.attempts = defaultdict(int)  # (kind, outcome) -> count
+        self.counters = defaultdict(int)
+
+    def _percentile(self, p: float):
+        with self._lock:
+            if len(self._latencies) < AI_LATENCY_MIN_SAMPLES:
+                return None
+            ordered = sorted(self._latencies)
+        return ordered[min(int(len(ordered) * p / 100), len(ordered) - 1)]
+
+    def attempt_timeout(self) -> float:
+        p99 = self._percentile(99)
+        if p99 is None:
+            return AI_TIMEOUT_MAX
+        return min(max(p99 * AI_TIMEOUT_P99_FACTOR, AI_TIMEOUT_MIN), AI_TIMEOUT_MAX)
+
+    def hedge_delay(self):
+        """Через сколько секунд отправлять хедж (None — данных мало, не хеджируем)."""
+        p95 = self._percentile(95)
+        return None if p95 is None else max(p95, AI_HEDGE_MIN_DELAY)
+
+    @property
+    def budget(self) -> float:
+        with self._lock:
+            return self._budget
+
+    def _spend(self, kind: str) -> bool:
+        with self._lock:
+            if self._budget < 1:
+                self.counters[f"{kind}_denied"] += 1
+                return False
+            self._budget -= 1
+            self.counters[kind] += 1
+            return True
+
+    def _attempt(self, kind, payload, headers, timeout, trace, results):
+        # Попытка в своём потоке — спаны пишем в трейс вызвавшего апдейта
+        update_context.trace = trace
+        started = time.monotonic()
+        try:
+            resp = http_post(f"{SUPPORT_API_URL}/internal/support/chat",
+                             json=payload, headers=headers, timeout=timeout)
+            if resp.status_code == 200:
+                outcome, value = "ok", resp.json().get("response")
+            else:
+                outcome = "http_4xx" if resp.status_code < 500 else "http_5xx"
+                value = f"{resp.status_code} {resp.text[:200]}"
+        except requests.Timeout:
+            outcome, value = "timeout", f"timeout after {timeout:.1f}s"
+        except Exception as e:
+            outcome, value = "error", str(e)
+        finally:
+            update_context.trace = None
+        latency = time.monotonic() - started
+        with self._lock:
+            self.attempts[(kind, outcome)] += 1
+            if outcome == "ok":
+                self._latencies.append(latency)
+        results.put((kind, outcome, value))
+
+    def chat(self, telegram_id: int, message: str):
+        """Ответ AI; AiUnavailable, если ни одна попытка не удалась до AI_TIMEOUT_MAX."""
+        payload = {"telegram_id": telegram_id, "message": message}
+        headers = internal_headers()
+        # Ключ на логический вызов: вопрос юзера и [SYSTEM]-уведомление из
+        # одного апдейта не должны схлопнуться на сервере в один ответ
+        call_hash = hashlib.sha256(f"{telegram_id}:{message}".encode()).hexdigest()[:16]
+        headers["Idempotency-Key"] = idempotency_key(f"ai_chat:{call_hash}") or f"ai:{uuid.uuid4().hex}"
+        trace = getattr(update_context, "trace", None)
+        timeout = self.attempt_timeout()
+        hedge_delay = self.hedge_delay()
+        with self._lock:
+            self._budget = min(self._budget + AI_RETRY_BUDGET_RATIO, AI_RETRY_BUDGET_MAX)
+            self.counters["calls"] += 1
+
+        started = time.monotonic()
+        deadline = started + AI_TIMEOUT_MAX
+        hedge_at = started + hedge_delay if hedge_delay is not None and hedge_delay < timeout else None
+        results = queue.Queue()
+        attempts = pending = 0
+        last_error = None
+
+        def launch(kind):
+            nonlocal attempts, pending
+            attempts += 1
+            pending += 1
+            attempt_timeout = max(min(timeout, deadline - time.monotonic()), 0.1)
+            threading.Thread(target=self._attempt, args=(kind, payload, headers, attempt_timeout, trace, results),
+                             daemon=True, name="ai-attempt").start()
+
+        launch("primary")
+        while pending:
+            now = time.monotonic()
+            wait_until = min(deadline, hedge_at) if hedge_at else deadline
+            try:
+                kind, outcome, value = results.get(timeout=max(wait_until - now, 0))
+            except queue.Empty:
+                if hedge_at is None or time.monotonic() >= deadline:
+                    break
+                hedge_at = None
+                if attempts < AI_MAX_ATTEMPTS and not ai_circuit.is_open and self._spend("hedge"):
+                    launch("hedge")
+                continue
+            pending -= 1
+            if outcome == "ok":
+                if kind != "primary":
+                    with self._lock:
+                        self.counters[f"{kind}_wins"] += 1
+                return value
+            last_error = (outcome, value)
+            logger.warning("AI attempt %s (%s) for user %s failed: %s %s", attempts, kind, telegram_id, outcome, value)
+            if outcome == "http_4xx":
+                break
+            if pending or attempts >= AI_MAX_ATTEMPTS or ai_circuit.is_open:
+                continue
+            backoff = random.uniform(0, AI_RETRY_BACKOFF * 2 ** attempts)
+            if time.monotonic() + backoff + AI_TIMEOUT_MIN > deadline or not self._spend("retry"):
+                break
+            time.sleep(backoff)
+            hedge_at = None
+            launch("retry")
+
+        if last_error is None:
+            last_error = ("timeout", f"no answer in {AI_TIMEOUT_MAX}s")
+        raise AiUnavailable(*last_error)
+
+
+ai_client = AiClient()
+
+
 def get_ai_response(telegram_id: int, message: str):
     """Call vpn-api AI support endpoint. Returns response text or None on failure."""
-    try:
-        resp = requests.post(
-            f"{SUPPORT_API_URL}/internal/support/chat",
-            json={"telegram_id": telegram_id, "message": message},
-            headers=internal_headers(),
-            timeout=30
-        )
-        if resp.status_code == 200:
-            data = resp.json()
-            return data.get("response")
-        else:
-            logger.error(f"AI API error: {resp.status_code} {resp.text[:200]}")
-            return None
-    except requests.Timeout:
-        logger.error(f"AI API timeout for user {telegram_id}")
+    if not ai_circuit.allow():
+        logger.warning("AI circuit open, skipping AI call for user %s", telegram_id)
         return None
-    except Exception as e:
-        logger.error(f"AI API exception for user {telegram_id}: {e}")
+    started = time.monotonic()
+    try:
+        text = ai_client.chat(telegram_id, message)
+    except AiUnavailable as e:
+        logger.error("AI API failed for user %s: %s", telegram_id, e)
+        ai_circuit.record(e.outcome == "http_4xx")
+        support_stats.incr("ai_errors")
         return None
+    ai_circuit.record(True)
+    # [SYSTEM]-уведомления юзер не ждёт — в задержку ответов их не считаем
+    if not message.startswith("[SYSTEM]"):
+        support_stats.observe("ai_latency", time.monotonic() - started)
+    return text
 
 
 def transcribe_voice(file_path: str) -> str:
@@ -243,7 +1863,7 @@ def transcribe_voice(file_path: str) -> str:
         return None
     try:
         with open(file_path, 'rb') as f:
-            resp = requests.post(
+            resp = http_post(
                 "https://openai.api.proxyapi.ru/v1/audio/transcriptions",
                 headers={"Authorization": f"Bearer {PROXYAPI_KEY}"},
                 files={"file": ("voice.ogg", f, "audio/ogg")},
@@ -253,10 +1873,10 @@ def transcribe_voice(file_path: str) -> str:
         if resp.status_code == 200:
             return resp.json().get("text", "")
         else:
-            logger.error(f"Whisper API error: {resp.status_code} {resp.text[:200]}")
+            logger.error("Whisper API error: %s %s", resp.status_code, resp.text[:200])
             return None
     except Exception as e:
-        logger.error(f"Whisper transcription error: {e}")
+        logger.error("Whisper transcription error: %s", e)
         return None
 
 
@@ -272,49 +1892,376 @@ def check_ai_escalation(ai_text: str) -> bool:
     return any(trigger in lower for trigger in ESCALATION_TRIGGERS)
 
 
-def create_admin_ticket(user_id: int, username: str, reason: str = ""):
-    """Создаёт тикет для админа с инфо о юзере и кнопкой 'Открыть'."""
-    db_open_ticket(user_id, username, reason)
-    save_state()
+PROFILE_PREFETCH_TTL = 300  # сек, сколько прогретый профиль считается свежим
+PROFILE_PREFETCH_RETRY = 60  # сек — после неудачной загрузки профиль юзера не перезапрашиваем
+PROFILE_PREFETCH_USERS = 500
+PROFILE_PREFETCH_WORKERS = 2
+PROFILE_FETCH_TIMEOUT = 5  # сек на каждый из двух запросов профиля
+REPEAT_ANSWER_WINDOW = 300  # второй ответ ИИ за это время — эскалация вероятна
+USER_ESCALATION_HINTS = ("оператор", "человек", "живой", "менеджер", "поддержк", "жалоб")
 
-    # Получаем информацию о пользователе
-    user_info_text = ""
+
+def escalation_likely(text: str) -> bool:
+    """Слова рядом с фразами эскалации, но не сама фраза — повод прогреть профиль."""
+    lower = text.lower()
+    return any(hint in lower for hint in USER_ESCALATION_HINTS)
+
+
+def fetch_user_profile(user_id: int):
+    """/info юзера с добавленным email; None, если /info недоступен."""
     try:
-        resp = requests.get(f"{API_URL}/{user_id}/info")
-        if resp.status_code == 200:
-            user = resp.json()
-            plan = PLAN_NAMES.get(user.get("plan", ""), user.get("plan", "—"))
-            sub_end = format_subscription_end(user.get("subscription_end", "—"))
-            is_active = "Активна" if user.get("is_active") == 1 else "Неактивна"
-            is_pro = "Да" if user.get("is_pro") else "Нет"
-            auto_renew = "Да" if user.get("auto_renew") else "Нет"
-            device_limit = user.get("device_limit", "—")
-            card = user.get("card_last4")
-            card_text = f"•••• {card}" if card else "Нет"
+        resp = http_get(f"{API_URL}/{user_id}/info", timeout=PROFILE_FETCH_TIMEOUT)
+        if resp.status_code != 200:
+            return None
+        user = resp.json()
+    except Exception as e:
+        logger.error("Failed to get user info for %s: %s", user_id, e)
+        return None
 
-            # Get email
-            user_email = "—"
+    user["email"] = "—"
+    try:
+        email_resp = http_get(f"{SUPPORT_API_URL}/internal/user-email/{user_id}", headers=internal_headers(),
+                              timeout=PROFILE_FETCH_TIMEOUT)
+        if email_resp.status_code == 200:
+            user["email"] = email_resp.json().get("email") or "—"
+    except Exception:
+        pass
+    return user
+
+
+class ProfilePrefetcher:
+    """Фоновый прогрев профиля (/info + email), пока эскалация только вероятна.
+
+    create_admin_ticket берёт профиль отсюда без запросов в upstream; если
+    его ещё нет, карточка уходит сразу, а данные дописываются по готовности.
+    Загрузки идут не больше чем в PROFILE_PREFETCH_WORKERS потоках; неудачная
+    загрузка запоминается, и PROFILE_PREFETCH_RETRY секунд профиль юзера не
+    перезапрашивается (пока ИИ лежит, warm зовётся на каждое сообщение).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._profiles = OrderedDict()  # user_id -> (fetched_at, profile | None — загрузка не удалась)
+        self._inflight = {}  # user_id -> [on_ready]
+        self._pending = deque()  # user_id в очереди на загрузку
+        self._workers = 0
+        self._last_answer = {}  # user_id -> monotonic ts предыдущего ответа ИИ
+        self.stats = defaultdict(int)
+
+    def _fresh(self, user_id: int):
+        cached = self._profiles.get(user_id)
+        if cached and time.monotonic() - cached[0] < PROFILE_PREFETCH_TTL:
+            return cached[1]
+        return None
+
+    def _failed_recently(self, user_id: int) -> bool:
+        cached = self._profiles.get(user_id)
+        return bool(cached) and cached[1] is None and time.monotonic() - cached[0] < PROFILE_PREFETCH_RETRY
+
+    def get(self, user_id: int):
+        """Свежий профиль или None."""
+        with self._lock:
+            profile = self._fresh(user_id)
+            self.stats["hits" if profile is not None else "misses"] += 1
+            return profile
+
+    def warm(self, user_id: int, reason: str, on_ready=None):
+        """Ставит загрузку в очередь, если профиля нет и она ещё не идёт; on_ready(profile | None)."""
+        start_worker = False
+        with self._lock:
+            profile = self._fresh(user_id)
+            failed = profile is None and self._failed_recently(user_id)
+            if failed:
+                self.stats["skipped_recent"] += 1
+            elif profile is None:
+                if user_id in self._inflight:
+                    if on_ready:
+                        self._inflight[user_id].append(on_ready)
+                    return
+                self._inflight[user_id] = [on_ready] if on_ready else []
+                self._pending.append(user_id)
+                self.stats[f"warm_{reason}"] += 1
+                if self._workers < PROFILE_PREFETCH_WORKERS:
+                    self._workers += 1
+                    start_worker = True
+        if profile is not None or failed:
+            if on_ready:
+                on_ready(profile)
+            return
+        logger.debug("Prefetching profile for %s (%s)", user_id, reason)
+        if start_worker:
+            threading.Thread(target=self._work, daemon=True, name="profile-prefetch").start()
+
+    def _work(self):
+        """Поток пула: разбирает очередь и завершается, когда она пуста."""
+        while True:
+            with self._lock:
+                if not self._pending:
+                    self._workers -= 1
+                    return
+                user_id = self._pending.popleft()
+            self._run(user_id)
+
+    def note_ai_answer(self, user_id: int):
+        now = time.monotonic()
+        with self._lock:
+            last = self._last_answer.get(user_id)
+            self._last_answer[user_id] = now
+            if len(self._last_answer) > 50000:
+                for uid in [u for u, ts in self._last_answer.items() if now - ts > REPEAT_ANSWER_WINDOW]:
+                    del self._last_answer[uid]
+        if last is not None and now - last < REPEAT_ANSWER_WINDOW:
+            self.warm(user_id, "repeat_answer")
+
+    def _run(self, user_id: int):
+        try:
+            profile = fetch_user_profile(user_id)
+        except Exception as e:
+            logger.error("Profile prefetch failed for %s: %s", user_id, e)
+            profile = None
+        with self._lock:
+            callbacks = self._inflight.pop(user_id, [])
+            self._profiles[user_id] = (time.monotonic(), profile)
+            self._profiles.move_to_end(user_id)
+            while len(self._profiles) > PROFILE_PREFETCH_USERS:
+                self._profiles.popitem(last=False)
+        for on_ready in callbacks:
             try:
-                email_resp = requests.get(f"{SUPPORT_API_URL}/internal/user-email/{user_id}", headers=internal_headers())
-                if email_resp.status_code == 200:
-                    user_email = email_resp.json().get("email") or "—"
-            except Exception:
-                pass
+                on_ready(profile)
+            except Exception as e:
+                logger.error("Profile prefetch callback failed for %s: %s", user_id, e)
+
+
+profile_prefetcher = ProfilePrefetcher()
+
+
+# ===== ДАЙДЖЕСТ ДЛЯ АДМИНОВ =====
+
+ADMIN_DIGEST_ENTER = int(os.getenv('ADMIN_DIGEST_ENTER', '30'))  # уведомлений в минуту; 0 — выключено
+ADMIN_DIGEST_EXIT = int(os.getenv('ADMIN_DIGEST_EXIT', '10'))
+ADMIN_DIGEST_WINDOW = 60  # сек — окно, по которому считается поток уведомлений
+ADMIN_DIGEST_INTERVAL = int(os.getenv('ADMIN_DIGEST_INTERVAL', '30'))  # сек между обновлениями дайджеста
+ADMIN_DIGEST_REPOST = 600  # сек — старое сообщение дайджеста уехало вверх, шлём новое
+ADMIN_DIGEST_SHOW = 10  # тикетов в тексте и кнопок peek
+ADMIN_DIGEST_FINAL_RETRIES = 3  # повторов финальной сводки, если Telegram просит подождать
+# Сводку нельзя отредактировать — шлём новую; на прочих ошибках (429, сеть) ждём следующего тика
+DIGEST_REPOST_ERRORS = ("message to edit not found", "message can't be edited")
+
+
+class AdminDigest:
+    """Адаптивная сводка вместо поштучных уведомлений админам.
+
+    Каждое уведомление (новый тикет, сообщение в открытом тикете) проходит
+    через absorb(). Пока их меньше enter за окно, absorb() возвращает False
+    и вызывающий шлёт как раньше. Выше порога уведомления копятся здесь, а
+    фоновый поток раз в interval редактирует у каждого админа одно
+    сообщение-сводку. Когда поток падает ниже leave, сводка дописывается
+    последний раз и доставка возвращается к реальному времени.
+    """
+
+    def __init__(self, enter: int, leave: int, window: float, interval: float):
+        self._enter = enter
+        self._leave = leave
+        self._window = window
+        self._interval = interval
+        self._lock = threading.Lock()
+        self._events = deque()  # monotonic ts уведомлений за окно
+        self.active = False
+        self._started_at = None
+        self._tickets = OrderedDict()  # user_id -> {"username", "new", "count", "last"}
+        self._totals = defaultdict(int)
+        self._dirty = False
+        self._messages = {}  # admin_id -> (message_id, sent_at)
+        self.counters = defaultdict(int)
+
+    def _prune(self, now: float):
+        while self._events and now - self._events[0] > self._window:
+            self._events.popleft()
+
+    def rate(self) -> int:
+        """Уведомлений за последнее окно."""
+        with self._lock:
+            self._prune(time.monotonic())
+            return len(self._events)
+
+    def absorb(self, kind: str, user_id: int, username: str, preview: str = "") -> bool:
+        """Учитывает уведомление; True — оно ушло в дайджест и слать его не нужно."""
+        if self._enter <= 0:
+            return False
+        now = time.monotonic()
+        with self._lock:
+            self._events.append(now)
+            self._prune(now)
+            entering = not self.active and len(self._events) >= self._enter
+            if entering:
+                self.active = True
+                self._started_at = datetime.now()
+                self._tickets.clear()
+                self._totals.clear()
+                self._messages = {}
+                self.counters["episodes"] += 1
+            elif not self.active:
+                return False
+            ticket = self._tickets.pop(user_id, None) or {"username": username, "new": False, "count": 0, "last": ""}
+            self._tickets[user_id] = ticket
+            if kind == "ticket":
+                ticket["new"] = True
+                ticket["reason"] = preview
+                self._totals["tickets"] += 1
+            else:
+                ticket["count"] += 1
+                self._totals["messages"] += 1
+            if preview:
+                ticket["last"] = preview
+            self._dirty = True
+            self.counters[f"absorbed_{kind}"] += 1
+        if entering:
+            logger.warning("Admin notifications switched to digest mode (%s in %ss)", len(self._events), self._window)
+            self.flush()
+            threading.Thread(target=self._run, daemon=True, name="admin-digest").start()
+        return True
+
+    def _run(self):
+        while True:
+            time.sleep(self._interval)
+            if not self.tick():
+                return
 
-            user_info_text = (
-                f"\n<b>Email:</b> {user_email}"
-                f"\n<b>Тариф:</b> {plan}"
-                f"\n<b>Статус:</b> {is_active}"
-                f"\n<b>PRO:</b> {is_pro}"
-                f"\n<b>Окончание:</b> {sub_end}"
-                f"\n<b>Автопродление:</b> {auto_renew}"
-                f"\n<b>Карта:</b> {card_text}"
-                f"\n<b>Устройств:</b> {device_limit}"
-            )
-    except Exception as e:
-        logger.error(f"Failed to get user info for ticket: {e}")
+    def tick(self) -> bool:
+        """Обновляет сводку; False — нагрузка спала и дайджест выключен."""
+        with self._lock:
+            if not self.active:
+                return False
+            self._prune(time.monotonic())
+            leaving = len(self._events) < self._leave
+            if leaving:
+                self.active = False
+        if leaving:
+            logger.warning("Admin notifications back to real time")
+        self.flush(final=leaving)
+        if leaving:
+            self._send_absorbed_cards()
+        return not leaving
+
+    def _send_absorbed_cards(self):
+        """Карточки тикетов, открытых в эпизоде и ещё не закрытых: без них админу нечем ответить."""
+        with self._lock:
+            pending = [(user_id, ticket["username"], ticket.get("reason", ""))
+                       for user_id, ticket in self._tickets.items() if ticket["new"]]
+        pending = [entry for entry in pending if entry[0] in active_tickets]
+        for user_id, username, reason in pending:
+            send_ticket_cards(user_id, username, reason, profile_prefetcher.get(user_id))
+        self.counters["cards_after_episode"] += len(pending)
+
+    def render(self, final: bool = False):
+        """(text, markup) сводки по текущему эпизоду."""
+        with self._lock:
+            tickets = list(self._tickets.items())[::-1]
+            totals = dict(self._totals)
+            started = self._started_at.strftime('%H:%M') if self._started_at else "—"
+        lines = [
+            f"📋 <b>СВОДКА ОБРАЩЕНИЙ</b> с {started}",
+            "━━━━━━━━━━━━━━━━━━━━",
+            f"<b>Новых тикетов:</b> {totals.get('tickets', 0)}",
+            f"<b>Сообщений в тикетах:</b> {totals.get('messages', 0)}",
+            f"<b>Активных тикетов:</b> {len(active_tickets)}",
+            "",
+        ]
+        markup = types.InlineKeyboardMarkup()
+        for user_id, ticket in tickets[:ADMIN_DIGEST_SHOW]:
+            username = html.escape(ticket["username"])
+            mark = "🆕 " if ticket["new"] else ""
+            line = f"{mark}@{username} (<code>{user_id}</code>)"
+            if ticket["count"]:
+                line += f" · {ticket['count']} сообщ."
+            if ticket["last"]:
+                line += f"\n   <i>{html.escape(ticket['last'][:80])}</i>"
+            lines.append(line)
+            markup.add(types.InlineKeyboardButton(text=f"👁 @{ticket['username']}", callback_data=f"peek_{user_id}"))
+        if len(tickets) > ADMIN_DIGEST_SHOW:
+            lines.append(f"… и ещё {len(tickets) - ADMIN_DIGEST_SHOW} — /next или /chats tickets")
+        lines.append("")
+        if final:
+            lines.append("✅ Нагрузка спала — уведомления снова приходят сразу.")
+        else:
+            lines.append(f"⚠️ Много обращений: уведомления собираются в сводку, "
+                         f"обновление каждые {self._interval:g} с.")
+        return "\n".join(lines), markup
+
+    def flush(self, final: bool = False):
+        """Редактирует сводку у каждого админа или шлёт новую, если старой нет/она устарела.
+
+        Не доставленная из-за временной ошибки сводка обновится на следующем тике;
+        финальную (следующего тика не будет) повторяем здесь же.
+        """
+        with self._lock:
+            if not self._dirty and not final:
+                return
+            self._dirty = False
+        text, markup = self.render(final)
+        pending = [admin_id for admin_id in ADMIN_IDS if not self._deliver(admin_id, text, markup)]
+        for _ in range(ADMIN_DIGEST_FINAL_RETRIES if final else 0):
+            if not pending:
+                break
+            time.sleep(self._interval)
+            pending = [admin_id for admin_id in pending if not self._deliver(admin_id, text, markup)]
+        if pending and not final:
+            with self._lock:
+                self._dirty = True
+
+    def _deliver(self, admin_id: int, text: str, markup) -> bool:
+        """Сводка одному админу; False — временная ошибка, повторить позже."""
+        now = time.monotonic()
+        current = self._messages.get(admin_id)
+        if current and now - current[1] < ADMIN_DIGEST_REPOST:
+            try:
+                bot.edit_message_text(text, admin_id, current[0], reply_markup=markup, parse_mode="HTML")
+                self.counters["edits"] += 1
+                return True
+            except Exception as e:
+                error = str(e).lower()
+                if "message is not modified" in error:
+                    return True
+                if not any(marker in error for marker in DIGEST_REPOST_ERRORS):
+                    logger.warning("Digest edit failed for admin %s: %s", admin_id, e,
+                                   extra={"rate_key": "admin_digest"})
+                    self.counters["edit_errors"] += 1
+                    return False
+                logger.debug("Digest message gone for admin %s: %s", admin_id, e)
+        try:
+            sent = bot.send_message(admin_id, text, reply_markup=markup, parse_mode="HTML")
+            self._messages[admin_id] = (sent.message_id, now)
+            self.counters["sends"] += 1
+            return True
+        except Exception as e:
+            logger.error("Error sending digest to admin %s: %s", admin_id, e, extra={"rate_key": "admin_digest"})
+            return False
 
-    msg_count = len(user_conversation.get(user_id, []))
+
+admin_digest = AdminDigest(ADMIN_DIGEST_ENTER, ADMIN_DIGEST_EXIT, ADMIN_DIGEST_WINDOW, ADMIN_DIGEST_INTERVAL)
+
+
+def render_ticket_card(user_id: int, username: str, reason: str, msg_count: int, user=None) -> str:
+    user_info_text = ""
+    if user is not None:
+        plan = PLAN_NAMES.get(user.get("plan", ""), user.get("plan", "—"))
+        sub_end = format_subscription_end(user.get("subscription_end", "—"))
+        is_active = "Активна" if user.get("is_active") == 1 else "Неактивна"
+        is_pro = "Да" if user.get("is_pro") else "Нет"
+        auto_renew = "Да" if user.get("auto_renew") else "Нет"
+        device_limit = user.get("device_limit", "—")
+        card = user.get("card_last4")
+        card_text = f"•••• {card}" if card else "Нет"
+        user_info_text = (
+            f"\n<b>Email:</b> {user.get('email', '—')}"
+            f"\n<b>Тариф:</b> {plan}"
+            f"\n<b>Статус:</b> {is_active}"
+            f"\n<b>PRO:</b> {is_pro}"
+            f"\n<b>Окончание:</b> {sub_end}"
+            f"\n<b>Автопродление:</b> {auto_renew}"
+            f"\n<b>Карта:</b> {card_text}"
+            f"\n<b>Устройств:</b> {device_limit}"
+        )
 
     ticket_text = (
         f"🎫 <b>НОВЫЙ ТИКЕТ</b>\n"
@@ -325,10 +2272,12 @@ def create_admin_ticket(user_id: int, username: str, reason: str = ""):
         f"<b>Сообщений в диалоге:</b> {msg_count}\n"
         f"━━━━━━━━━━━━━━━━━━━━"
     )
-
     if reason:
         ticket_text += f"\n<b>Причина:</b> {reason}"
+    return ticket_text
 
+
+def ticket_card_markup(user_id: int):
     markup = types.InlineKeyboardMarkup(row_width=2)
     markup.add(
         types.InlineKeyboardButton(
@@ -340,7 +2289,15 @@ def create_admin_ticket(user_id: int, username: str, reason: str = ""):
             callback_data=f"close_ticket_{user_id}"
         )
     )
+    return markup
+
 
+def send_ticket_cards(user_id: int, username: str, reason: str, user):
+    """Шлёт карточку тикета каждому админу в личку; возвращает [(chat_id, message_id)]."""
+    msg_count = len(user_conversation.get(user_id, []))
+    ticket_text = render_ticket_card(user_id, username, reason, msg_count, user)
+    markup = ticket_card_markup(user_id)
+    cards = []
     for admin_id in ADMIN_IDS:
         try:
             sent = bot.send_message(
@@ -349,46 +2306,182 @@ def create_admin_ticket(user_id: int, username: str, reason: str = ""):
                 parse_mode="HTML"
             )
             ticket_message_to_user[sent.message_id] = user_id
-            logger.info(f"Ticket sent to admin {admin_id} for user {user_id}")
+            cards.append((admin_id, sent.message_id))
+            logger.info("Ticket sent to admin %s for user %s", admin_id, user_id)
         except Exception as e:
-            logger.error(f"Error sending ticket to admin {admin_id}: {e}")
+            logger.error("Error sending ticket to admin %s: %s", admin_id, e)
+    return cards
 
 
-def peek_conversation(admin_chat_id: int, user_id: int):
-    """Просмотр переписки юзера — загружает из БД через API."""
-    username = user_data_cache.get(user_id, f"id{user_id}")
+def create_admin_ticket(user_id: int, username: str, reason: str = ""):
+    """Создаёт тикет для админа с инфо о юзере и кнопкой 'Открыть'."""
+    db_open_ticket(user_id, username, reason)
+    save_state()
 
-    # Load from DB via API
-    try:
-        resp = requests.get(f"{SUPPORT_API_URL}/admin/chats/{user_id}", headers=admin_headers(), timeout=10)
-        if resp.status_code == 200:
-            data = resp.json()
-            db_messages = data.get("messages", [])
-        else:
-            db_messages = []
-    except Exception as e:
-        logger.error(f"Failed to load chat from API for {user_id}: {e}")
-        db_messages = []
-
-    # Fallback to in-memory if DB is empty
-    if not db_messages:
-        log = chat_log.get(user_id, [])
-        if not log:
-            bot.send_message(admin_chat_id, "Нет сохранённых сообщений.")
+    # Профиль берём прогретым; если его нет — не ждём upstream, допишем в карточку позже
+    user = profile_prefetcher.get(user_id)
+    if user is not None:
+        ticket_queue.set_plan(user_id, user.get("plan", ""))
+    msg_count = len(user_conversation.get(user_id, []))
+    markup = ticket_card_markup(user_id)
+
+    cards = []  # (chat_id, message_id)
+    topic = ticket_topics.ensure(user_id, username) if ADMIN_GROUP_ID else None
+    if topic:
+        try:
+            sent = bot.send_message(ADMIN_GROUP_ID, render_ticket_card(user_id, username, reason, msg_count, user),
+                                    reply_markup=markup, parse_mode="HTML", message_thread_id=topic)
+            cards.append((ADMIN_GROUP_ID, sent.message_id))
+            logger.info("Ticket card posted to topic %s for user %s", topic, user_id)
+        except Exception as e:
+            logger.error("Error posting ticket card to topic %s: %s", topic, e)
+    # Под нагрузкой карточку заменяет строка в сводке (карточка придёт в конце эпизода)
+    elif not admin_digest.absorb("ticket", user_id, username, reason):
+        cards = send_ticket_cards(user_id, username, reason, user)
+
+    if user is not None:
+        return
+
+    def fill_cards(profile):
+        if profile is None:
             return
-        db_messages = [{"role": e["role"], "content": e["text"], "created_at": e.get("time", "")} for e in log[-30:]]
+        ticket_queue.set_plan(user_id, profile.get("plan", ""))
+        text = render_ticket_card(user_id, username, reason, msg_count, profile)
+        for chat_id, message_id in cards:
+            try:
+                bot.edit_message_text(text, chat_id, message_id, reply_markup=markup, parse_mode="HTML")
+            except Exception as e:
+                logger.error("Error filling ticket card in chat %s: %s", chat_id, e)
 
-    import re as re_mod
+    profile_prefetcher.warm(user_id, "ticket", on_ready=fill_cards)
 
-    # Build renderable items: either text lines or photo file_ids
-    items = []  # list of {"type": "text", "line": str} or {"type": "photo", "file_id": str, "caption": str, "label": str}
-    for entry in db_messages[-30:]:
-        role = entry.get("role", "user")
-        text = entry.get("content", entry.get("text", ""))
 
-        # Skip [SYSTEM] messages
-        if text and text.startswith("[SYSTEM]"):
-            continue
+PEEK_PAGE_SIZE = 30
+PEEK_CACHE_TTL = 60  # сек — подхватываем сообщения, сохранённые из веб-админки
+PEEK_CACHE_USERS = 200
+PHOTO_RE = re.compile(r'\[photo:([^\]]+)\]\s*')
+
+
+class ConversationViewer:
+    """Кэш переписок для peek: история и отрендеренные страницы по user_id.
+
+    Загрузка single-flight: если несколько админов одновременно открывают
+    один диалог, в API уходит один GET, остальные ждут его результат.
+    Кэш юзера сбрасывается при каждом новом сообщении (append_chat_log).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._history = OrderedDict()  # user_id -> (fetched_at, messages)
+        self._pages = {}  # user_id -> {end: blocks}
+        self._inflight = {}  # user_id -> threading.Event
+        self._version = defaultdict(int)
+
+    def invalidate(self, user_id: int):
+        with self._lock:
+            self._history.pop(user_id, None)
+            self._pages.pop(user_id, None)
+            self._version[user_id] += 1
+
+    def _fetch(self, user_id: int):
+        try:
+            resp = http_get(f"{SUPPORT_API_URL}/admin/chats/{user_id}", headers=admin_headers(), timeout=10)
+            if resp.status_code == 200:
+                db_messages = resp.json().get("messages", [])
+            else:
+                db_messages = []
+        except Exception as e:
+            logger.error("Failed to load chat from API for %s: %s", user_id, e)
+            db_messages = []
+
+        # Fallback to in-memory if DB is empty
+        if not db_messages:
+            db_messages = [{"role": m.role, "content": m.text,
+                            "created_at": datetime.fromtimestamp(m.ts).isoformat() if m.ts else ""}
+                           for m in chat_log.get(user_id, [])]
+
+        # Skip [SYSTEM] messages — cursors index only visible entries
+        return [m for m in db_messages
+                if not (m.get("content", m.get("text", "")) or "").startswith("[SYSTEM]")]
+
+    def history(self, user_id: int):
+        """Видимые сообщения диалога (из кэша или одним запросом к API)."""
+        while True:
+            with self._lock:
+                cached = self._history.get(user_id)
+                if cached and time.monotonic() - cached[0] < PEEK_CACHE_TTL:
+                    self._history.move_to_end(user_id)
+                    return cached[1]
+                event = self._inflight.get(user_id)
+                if event is None:
+                    event = threading.Event()
+                    self._inflight[user_id] = event
+                    version = self._version[user_id]
+                    break
+            # Кто-то уже грузит этот диалог — ждём и перечитываем кэш
+            if not event.wait(15):
+                return self._fetch(user_id)
+
+        try:
+            messages = self._fetch(user_id)
+            with self._lock:
+                if self._version[user_id] == version:
+                    self._history[user_id] = (time.monotonic(), messages)
+                    self._pages.pop(user_id, None)
+                    while len(self._history) > PEEK_CACHE_USERS:
+                        old_id, _ = self._history.popitem(last=False)
+                        self._pages.pop(old_id, None)
+            return messages
+        finally:
+            with self._lock:
+                self._inflight.pop(user_id, None)
+            event.set()
+
+    def page(self, user_id: int, end: int = None):
+        """Страница диалога, заканчивающаяся перед индексом end (None — последняя).
+
+        Возвращает (blocks, start, end, total); blocks — список
+        ("text", str) и ("photos", [(file_id, caption)]).
+        """
+        messages = self.history(user_id)
+        total = len(messages)
+        end = total if end is None else min(max(end, 0), total)
+        start = max(end - PEEK_PAGE_SIZE, 0)
+        with self._lock:
+            blocks = self._pages.get(user_id, {}).get(end)
+        if blocks is None:
+            blocks = render_conversation_blocks(user_id, messages[start:end])
+            with self._lock:
+                if user_id in self._history:
+                    self._pages.setdefault(user_id, {})[end] = blocks
+        return blocks, start, end, total
+
+
+conversation_viewer = ConversationViewer()
+
+
+def render_conversation_blocks(user_id: int, messages: list):
+    """Рендерит сообщения в блоки: текст (до 4000 символов) и группы фото (до 10)."""
+    username = user_data_cache.get(user_id, f"id{user_id}")
+    blocks = []
+    current_text = ""
+    photos = []
+
+    def flush_text():
+        nonlocal current_text
+        if current_text.strip():
+            blocks.append(("text", current_text))
+        current_text = ""
+
+    def flush_photos():
+        nonlocal photos
+        for i in range(0, len(photos), 10):
+            blocks.append(("photos", photos[i:i + 10]))
+        photos = []
+
+    for entry in messages:
+        role = entry.get("role", "user")
+        text = entry.get("content", entry.get("text", "")) or ""
 
         if role == "user":
             icon, name = "👤", f"@{username}"
@@ -410,49 +2503,91 @@ def peek_conversation(admin_chat_id: int, user_id: int):
 
         label = f"{icon} <b>{name}</b> [{time_str}]"
 
-        # Photo message
-        if text and text.startswith("[photo:"):
-            match = re_mod.match(r'\[photo:([^\]]+)\]\s*(.*)', text)
-            if match:
-                items.append({"type": "photo", "file_id": match.group(1).strip(),
-                              "caption": match.group(2).strip(), "label": label})
-                continue
+        # Photo message (альбом — несколько маркеров [photo:...] в одной записи)
+        file_ids = PHOTO_RE.findall(text) if text.startswith("[photo:") else []
+        if file_ids:
+            flush_text()
+            caption = PHOTO_RE.sub("", text).strip()
+            for i, file_id in enumerate(file_ids):
+                photo_label = label if len(file_ids) == 1 else f"{label} {i + 1}/{len(file_ids)}"
+                photos.append((file_id.strip(), f"{photo_label}:\n📷 {caption}" if caption and i == 0 else photo_label))
+            continue
+
+        flush_photos()
+        line = f"{label}:\n{text}"
+        if len(current_text) + len(line) + 2 > 4000:
+            flush_text()
+        current_text += line + "\n\n"
 
-        items.append({"type": "text", "line": f"{label}:\n{text}"})
+    flush_photos()
+    flush_text()
+    return blocks
 
-    header = f"💬 <b>Диалог с @{username} (ID: <code>{user_id}</code>):</b>\n\n"
 
-    # Send items: batch text lines, send photos inline
+def send_conversation_photos(admin_chat_id: int, photos: list, thread_id: int = None):
+    """Отправляет группу фото одним альбомом; при ошибке — текстовая заглушка."""
+    try:
+        if len(photos) == 1:
+            bot.send_photo(admin_chat_id, photos[0][0], caption=photos[0][1], parse_mode="HTML",
+                           message_thread_id=thread_id)
+        else:
+            bot.send_media_group(admin_chat_id, [
+                types.InputMediaPhoto(file_id, caption=caption, parse_mode="HTML")
+                for file_id, caption in photos
+            ], message_thread_id=thread_id)
+    except Exception as e:
+        logger.error("Error sending photos: %s", e)
+        return "".join(f"{caption}:\n📷 Фото (недоступно)\n\n" for _, caption in photos)
+    return ""
+
+
+def peek_conversation(admin_chat_id: int, user_id: int, end: int = None, thread_id: int = None):
+    """Просмотр переписки юзера постранично (end — курсор, None — последние сообщения).
+
+    thread_id — тема группы, откуда запросили переписку: ответ уходит туда же, а не в General.
+    """
+    username = user_data_cache.get(user_id, f"id{user_id}")
+    blocks, start, end, total = conversation_viewer.page(user_id, end)
+
+    if not total:
+        bot.send_message(admin_chat_id, "Нет сохранённых сообщений.", message_thread_id=thread_id)
+        return
+
+    header = (f"💬 <b>Диалог с @{username} (ID: <code>{user_id}</code>):</b>\n"
+              f"<i>Сообщения {start + 1}–{end} из {total}</i>\n\n")
+
+    # Все блоки, кроме последнего текстового, отправляем сразу;
+    # последний текст уходит вместе с клавиатурой
     current_text = header
-    for item in items:
-        if item["type"] == "photo":
-            # Flush accumulated text first
+    for kind, payload in blocks:
+        if kind == "photos":
             if current_text.strip():
                 try:
-                    bot.send_message(admin_chat_id, current_text, parse_mode="HTML")
+                    bot.send_message(admin_chat_id, current_text, parse_mode="HTML", message_thread_id=thread_id)
                 except Exception as e:
-                    logger.error(f"Error sending peek text: {e}")
+                    logger.error("Error sending peek text: %s", e)
                 current_text = ""
-            # Send the photo
-            try:
-                cap = f"{item['label']}:\n📷 {item['caption']}" if item['caption'] else item['label']
-                bot.send_photo(admin_chat_id, item["file_id"], caption=cap, parse_mode="HTML")
-            except Exception as e:
-                logger.error(f"Error sending photo: {e}")
-                current_text += f"{item['label']}:\n📷 Фото (недоступно)\n\n"
+            current_text += send_conversation_photos(admin_chat_id, payload, thread_id)
         else:
-            line = item["line"]
-            if len(current_text) + len(line) + 2 > 4000:
+            if len(current_text) + len(payload) > 4000:
                 try:
-                    bot.send_message(admin_chat_id, current_text, parse_mode="HTML")
+                    bot.send_message(admin_chat_id, current_text, parse_mode="HTML", message_thread_id=thread_id)
                 except Exception as e:
-                    logger.error(f"Error sending peek text: {e}")
+                    logger.error("Error sending peek text: %s", e)
                 current_text = ""
-            current_text += line + "\n\n"
+            current_text += payload
 
     full_text = current_text if current_text.strip() else header
 
     markup = types.InlineKeyboardMarkup(row_width=2)
+    nav = []
+    if start > 0:
+        nav.append(types.InlineKeyboardButton(text="⬅️ Раньше", callback_data=f"peek_page_{user_id}_{start}"))
+    if end < total:
+        nav.append(types.InlineKeyboardButton(text="Новее ➡️",
+                                              callback_data=f"peek_page_{user_id}_{end + PEEK_PAGE_SIZE}"))
+    if nav:
+        markup.row(*nav)
     markup.add(types.InlineKeyboardButton(
         text="💬 Ответить пользователю",
         callback_data=f"reply_to_{user_id}"
@@ -472,15 +2607,21 @@ def peek_conversation(admin_chat_id: int, user_id: int):
         admin_chat_id,
         full_text,
         reply_markup=markup,
-        parse_mode="HTML"
+        parse_mode="HTML",
+        message_thread_id=thread_id
     )
     ticket_message_to_user[sent.message_id] = user_id
 
 
-def open_ticket_conversation(admin_chat_id: int, user_id: int):
+def open_ticket_conversation(admin_chat_id: int, user_id: int, thread_id: int = None):
     """Показывает переписку из БД и предлагает ответить."""
     # Use peek_conversation to show the chat from DB
-    peek_conversation(admin_chat_id, user_id)
+    peek_conversation(admin_chat_id, user_id, thread_id=thread_id)
+
+
+def topic_thread(message):
+    """Тема группы, в которой сообщение (None — личка или General)."""
+    return message.message_thread_id if message.is_topic_message else None
 
 
 def schedule_auto_close(user_id: int):
@@ -491,7 +2632,7 @@ def schedule_auto_close(user_id: int):
         old_timer.cancel()
 
     def auto_close():
-        logger.info(f"Auto-closing ticket for user {user_id} after {AUTO_CLOSE_HOURS}h")
+        logger.info("Auto-closing ticket for user %s after %sh", user_id, AUTO_CLOSE_HOURS)
         close_ticket(None, user_id, auto=True)
 
     timer = threading.Timer(AUTO_CLOSE_HOURS * 3600, auto_close)
@@ -508,11 +2649,12 @@ def handle_escalation(chat_id: int, user_id: int, reason: str = ""):
     if user_id in recently_closed:
         closed_at = recently_closed[user_id]
         if (datetime.now() - closed_at).total_seconds() < REOPEN_COOLDOWN_MINUTES * 60:
-            logger.info(f"Skipping escalation for {user_id} — cooldown after recent close")
+            logger.info("Skipping escalation for %s — cooldown after recent close", user_id)
             return
         del recently_closed[user_id]
     username = user_data_cache.get(user_id, f"id{user_id}")
     create_admin_ticket(user_id, username, reason)
+    support_stats.ticket_opened(user_id, reason)
     schedule_auto_close(user_id)
     bot.send_message(
         chat_id,
@@ -522,78 +2664,524 @@ def handle_escalation(chat_id: int, user_id: int, reason: str = ""):
     )
     # Notify AI about escalation so it has context when ticket is closed
     get_ai_response(user_id, "[SYSTEM] Пользователь был переведён на оператора. Диалог с ИИ приостановлен до закрытия тикета.")
-    logger.info(f"Escalation triggered for user {user_id}")
+    logger.info("Escalation triggered for user %s", user_id)
+
+
+# ===== ОГРАНИЧЕНИЕ НАГРУЗКИ =====
+
+USER_RATE_PER_MIN = float(os.getenv('USER_RATE_PER_MIN', '12'))
+USER_RATE_BURST = float(os.getenv('USER_RATE_BURST', '5'))
+AI_MAX_CONCURRENCY = int(os.getenv('AI_MAX_CONCURRENCY', '8'))
+AI_MAX_WAITING = int(os.getenv('AI_MAX_WAITING', '16'))
+AI_QUEUE_TIMEOUT = 20  # сек ожидания свободного слота AI
+SHED_NOTICE_INTERVAL = 30  # сек — не чаще одного "подождите" на юзера
+
+SHED_REPLIES = {
+    "rate_limited": "⏳ Вы отправляете сообщения слишком часто. Мы всё сохранили — "
+                    "пожалуйста, подождите немного, прежде чем писать снова.",
+    "ai_busy": "⏳ Сейчас очень много обращений. Ваше сообщение сохранено — "
+               "пожалуйста, повторите вопрос через минуту.",
+}
+
+
+class AdmissionControl:
+    """Допуск входящих сообщений: token bucket на юзера и лимит одновременных вызовов AI."""
+
+    def __init__(self, rate_per_min: float, burst: float, ai_concurrency: int, ai_max_waiting: int):
+        self._lock = threading.Lock()
+        self._rate = rate_per_min / 60.0
+        self._burst = burst
+        self._buckets = {}  # user_id -> [tokens, updated_at]
+        self._last_notice = {}  # user_id -> monotonic time
+        self._ai_slots = threading.BoundedSemaphore(ai_concurrency)
+        self._ai_max_waiting = ai_max_waiting
+        self.ai_in_flight = 0
+        self.ai_waiting = 0
+        self.counters = defaultdict(int)
+
+    def allow(self, user_id: int) -> bool:
+        """Списывает токен из бакета юзера; False — сообщение нужно сбросить."""
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(user_id)
+            if bucket is None:
+                if len(self._buckets) > 10000:
+                    self._evict_idle(now)
+                bucket = self._buckets[user_id] = [self._burst, now]
+            bucket[0] = min(self._burst, bucket[0] + (now - bucket[1]) * self._rate)
+            bucket[1] = now
+            if bucket[0] >= 1:
+                bucket[0] -= 1
+                self.counters["admitted"] += 1
+                return True
+            return False
+
+    def _evict_idle(self, now: float):
+        """Удаляет бакеты, которые уже успели наполниться (юзер давно молчит)."""
+        full_after = self._burst / self._rate if self._rate else 0
+        for uid in [uid for uid, (_, ts) in self._buckets.items() if now - ts >= full_after]:
+            del self._buckets[uid]
+            self._last_notice.pop(uid, None)
+
+    def should_notify(self, user_id: int) -> bool:
+        now = time.monotonic()
+        with self._lock:
+            if now - self._last_notice.get(user_id, 0) < SHED_NOTICE_INTERVAL:
+                return False
+            self._last_notice[user_id] = now
+            return True
+
+    @contextmanager
+    def ai_slot(self):
+        """Занимает слот AI; отдаёт False, если очередь переполнена или слот не дождались."""
+        with self._lock:
+            if self.ai_waiting >= self._ai_max_waiting:
+                acquired = None
+            else:
+                self.ai_waiting += 1
+                acquired = False
+        if acquired is not None:
+            acquired = self._ai_slots.acquire(timeout=AI_QUEUE_TIMEOUT)
+            with self._lock:
+                self.ai_waiting -= 1
+                if acquired:
+                    self.ai_in_flight += 1
+        try:
+            yield bool(acquired)
+        finally:
+            if acquired:
+                with self._lock:
+                    self.ai_in_flight -= 1
+                self._ai_slots.release()
+
+
+admission = AdmissionControl(USER_RATE_PER_MIN, USER_RATE_BURST, AI_MAX_CONCURRENCY, AI_MAX_WAITING)
+
+
+def shed_user_message(chat_id: int, user_id: int, reason: str):
+    """Сбрасывает обработку сообщения (без AI): считает и вежливо просит подождать."""
+    admission.counters[f"shed_{reason}"] += 1
+    logger.warning("Shedding message from %s: %s", user_id, reason)
+    if admission.should_notify(user_id):
+        try:
+            bot.send_message(chat_id, SHED_REPLIES[reason])
+        except Exception as e:
+            logger.error("Error sending shed notice to %s: %s", user_id, e)
+
+
+# ===== FAQ (ОФЛАЙН-ОТВЕТЫ) =====
+
+FAQ_FILE = os.getenv('FAQ_FILE', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'faq.json'))
+FAQ_CONFIDENCE = float(os.getenv('FAQ_CONFIDENCE', '0.75'))  # отвечаем сразу, без AI
+FAQ_FALLBACK_CONFIDENCE = float(os.getenv('FAQ_FALLBACK_CONFIDENCE', '0.6'))  # когда AI недоступен
+FAQ_MIN_TERMS = 2  # "нет" или "работает" в одно слово — не вопрос из FAQ
+FAQ_FALLBACK_FOOTER = "\n\nЕсли это не решило проблему — напишите «позовите оператора»."
+FAQ_STOPWORDS = {
+    "а", "и", "в", "во", "на", "с", "со", "к", "по", "за", "из", "у", "о", "об", "от", "до",
+    "то", "же", "ли", "бы", "мне", "меня", "я", "мой", "моя", "мои", "мою", "моей", "это", "для", "ещё", "еще",
+    "пожалуйста", "здравствуйте", "привет", "добрый", "день", "вечер", "подскажите", "скажите",
+    "что", "делать", "хочу", "можно", "чтобы",
+}
+FAQ_SYNONYMS = {"vpn": "впн", "pro": "про", "trial": "триал"}
+FAQ_TOKEN_RE = re.compile(r"[a-zа-я0-9]+")
+
+
+def faq_tokens(text: str):
+    """Токены для FAQ: нижний регистр, без стоп-слов, грубый стемминг (первые 5 букв)."""
+    tokens = []
+    for word in FAQ_TOKEN_RE.findall(text.lower().replace("ё", "е")):
+        if word in FAQ_STOPWORDS:
+            continue
+        word = FAQ_SYNONYMS.get(word, word)
+        tokens.append(word[:5])
+    return tokens
+
+
+class FaqEngine:
+    """BM25-индекс по вариантам вопросов из FAQ_FILE.
+
+    Ранжирование — BM25, уверенность — доля общего idf-веса терминов
+    запроса и вопроса (F1 по покрытию), от 0 до 1.
+    """
+
+    K1 = 1.5
+    B = 0.75
+
+    def __init__(self, entries: list):
+        self.entries = entries
+        self._docs = []  # [(entry_index, {term: tf}, length)]
+        self._postings = defaultdict(list)  # term -> [doc_index]
+        for i, entry in enumerate(entries):
+            for question in entry.get("questions", []):
+                tf = defaultdict(int)
+                tokens = faq_tokens(question)
+                for t in tokens:
+                    tf[t] += 1
+                doc_index = len(self._docs)
+                self._docs.append((i, dict(tf), len(tokens)))
+                for t in tf:
+                    self._postings[t].append(doc_index)
+        n = len(self._docs) or 1
+        self._avg_len = sum(d[2] for d in self._docs) / n if self._docs else 1
+        self._idf = {t: math.log(1 + (n - len(p) + 0.5) / (len(p) + 0.5)) for t, p in self._postings.items()}
+        self._max_idf = math.log(1 + (n + 0.5) / 0.5)
+
+    @classmethod
+    def from_file(cls, path: str):
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                entries = json.load(f)
+            logger.info("FAQ loaded: %s entries from %s", len(entries), path)
+            return cls(entries)
+        except FileNotFoundError:
+            return cls([])
+        except Exception as e:
+            logger.error("Failed to load FAQ from %s: %s", path, e)
+            return cls([])
+
+    def match(self, text: str):
+        """Лучший ответ: {"id", "answer", "confidence"} или None."""
+        query = set(faq_tokens(text))
+        if not query or not self._docs:
+            return None
+        scores = defaultdict(float)
+        for t in query:
+            idf = self._idf.get(t)
+            if idf is None:
+                continue
+            for doc_index in self._postings[t]:
+                _, tf, length = self._docs[doc_index]
+                f = tf[t]
+                scores[doc_index] += idf * f * (self.K1 + 1) / (
+                    f + self.K1 * (1 - self.B + self.B * length / self._avg_len))
+        if not scores:
+            return None
+        best = max(scores, key=scores.get)
+        entry_index, tf, _ = self._docs[best]
+
+        def weight(terms):
+            return sum(self._idf.get(t, self._max_idf) for t in terms)
+
+        common = weight(query & tf.keys())
+        confidence = 2 * common / (weight(query) + weight(tf.keys()))
+        entry = self.entries[entry_index]
+        return {"id": entry.get("id", str(entry_index)), "answer": entry["answer"], "confidence": confidence,
+                "terms": len(query & tf.keys()), "personal": bool(entry.get("personal"))}
+
+
+def faq_confident(faq, threshold: float) -> bool:
+    """Совпадение достаточно уверенное: не ниже threshold и минимум FAQ_MIN_TERMS общих терминов."""
+    return bool(faq) and faq["confidence"] >= threshold and faq["terms"] >= FAQ_MIN_TERMS
+
+
+faq_engine = FaqEngine.from_file(FAQ_FILE)
+faq_stats = defaultdict(int)
+
+
+# ===== КЭШ ОТВЕТОВ AI =====
+
+AI_CACHE_ENABLED = os.getenv('AI_CACHE_ENABLED', '0') == '1'
+AI_CACHE_TTL = int(os.getenv('AI_CACHE_TTL', '3600'))
+AI_CACHE_SIZE = int(os.getenv('AI_CACHE_SIZE', '500'))
+
+
+def normalize_question(text: str) -> str:
+    """Нормализованный текст вопроса: регистр, ё, пунктуация и пробелы не важны."""
+    return " ".join(FAQ_TOKEN_RE.findall(text.lower().replace("ё", "е")))
+
+
+class AiResponseCache:
+    """LRU-кэш ответов AI на первые вопросы юзеров, с TTL.
+
+    Ключ общий для всех юзеров, поэтому кэшируются только вопросы, которые
+    FAQ относит к темам без персональных данных (нет "personal" у записи),
+    и только у юзеров без истории. Сбрасывается при переключении /maintenance.
+    """
+
+    def __init__(self, enabled: bool, ttl: int, size: int):
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._ttl = ttl
+        self._size = size
+        self._items = OrderedDict()  # key -> (stored_at, text, latency)
+        self.stats = defaultdict(float)
+
+    def key_for(self, user_id: int, text: str, faq=None):
+        """Ключ кэша или None: кэш выключен, у юзера есть история или ответ может зависеть от юзера.
+
+        faq — результат faq_engine.match(text): AI получает telegram_id и может
+        учесть подписку, так что общий ответ допустим только для общих тем.
+        """
+        if not self.enabled:
+            return None
+        if len(chat_log.get(user_id, [])) > 1:
+            self.stats["bypass"] += 1
+            return None
+        if not faq_confident(faq, FAQ_FALLBACK_CONFIDENCE) or faq["personal"]:
+            self.stats["personal"] += 1
+            return None
+        return normalize_question(text) or None
+
+    def get(self, key: str):
+        with self._lock:
+            item = self._items.get(key)
+            if item is None or time.monotonic() - item[0] > self._ttl:
+                if item is not None:
+                    del self._items[key]
+                self.stats["misses"] += 1
+                return None
+            self._items.move_to_end(key)
+            self.stats["hits"] += 1
+            self.stats["saved_seconds"] += item[2]
+            return item[1]
+
+    def put(self, key: str, text: str, latency: float):
+        with self._lock:
+            self._items[key] = (time.monotonic(), text, latency)
+            self._items.move_to_end(key)
+            while len(self._items) > self._size:
+                self._items.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.stats["invalidations"] += 1
+
+    def __len__(self):
+        return len(self._items)
+
+
+ai_cache = AiResponseCache(AI_CACHE_ENABLED, AI_CACHE_TTL, AI_CACHE_SIZE)
+
+
+# ===== ИНДИКАТОР НАБОРА =====
+
+CHAT_ACTION_REFRESH = 4  # сек; Telegram гасит индикатор примерно через 5 с
+CHAT_ACTION_TICK = 0.5  # сек на слот колеса
+CHAT_ACTION_MAX = 120  # сек — дольше индикатор не держим, даже если запрос завис
+
+
+class ChatActionKeepalive:
+    """Держит "печатает…" в чатах, где идёт долгий запрос, одним колесом таймеров.
+
+    Колесо из CHAT_ACTION_REFRESH / CHAT_ACTION_TICK слотов: поток раз в тик
+    обходит очередной слот и заново шлёт действие его чатам, так что полный
+    оборот колеса и есть период обновления. Чат живёт в своём слоте, пока
+    открыт хотя бы один keep() для него; вложенные keep() повторно действие
+    не шлют. Отправки, не уложившиеся в тик, пропускаются до следующего
+    оборота, чтобы медленный Telegram не сдвигал всё колесо.
+    """
+
+    def __init__(self, refresh: float, tick: float, max_age: float):
+        self._tick = tick
+        self._max_age = max_age
+        self._slots = [set() for _ in range(max(int(refresh / tick), 1))]
+        self._chats = {}  # chat_id -> [action, refs, slot, started_at]
+        self._cursor = 0
+        self._cond = threading.Condition()
+        self._thread = None
+        self.counters = defaultdict(int)
+
+    @contextmanager
+    def keep(self, chat_id: int, action: str = 'typing'):
+        """Показывает action в чате до выхода из блока — ответ отправлен или запрос упал."""
+        if self._register(chat_id, action):
+            self._send(chat_id, action)
+        try:
+            yield
+        finally:
+            self._unregister(chat_id)
+
+    def _register(self, chat_id: int, action: str) -> bool:
+        """Добавляет чат в колесо; True — действие нужно отправить сразу."""
+        with self._cond:
+            entry = self._chats.get(chat_id)
+            if entry is not None:
+                entry[1] += 1
+                if entry[0] == action:
+                    return False
+                entry[0] = action
+                return True
+            # Слот перед курсором — первый повтор через полный оборот колеса
+            slot = (self._cursor - 1) % len(self._slots)
+            self._chats[chat_id] = [action, 1, slot, time.monotonic()]
+            self._slots[slot].add(chat_id)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True, name="chat-action")
+                self._thread.start()
+            self._cond.notify()
+            return True
+
+    def _unregister(self, chat_id: int):
+        with self._cond:
+            entry = self._chats.get(chat_id)
+            if entry is None:
+                return
+            entry[1] -= 1
+            if entry[1] <= 0:
+                self._drop(chat_id)
+
+    def _drop(self, chat_id: int):
+        entry = self._chats.pop(chat_id)
+        self._slots[entry[2]].discard(chat_id)
+
+    def _send(self, chat_id: int, action: str):
+        try:
+            bot.send_chat_action(chat_id, action)
+            self.counters["sent"] += 1
+        except Exception as e:
+            self.counters["errors"] += 1
+            logger.debug("send_chat_action failed for %s: %s", chat_id, e, extra={"rate_key": "chat_action"})
+
+    def _run(self):
+        while True:
+            now = time.monotonic()
+            due = []
+            with self._cond:
+                while not self._chats:
+                    self._cond.wait()
+                slot = self._slots[self._cursor]
+                self._cursor = (self._cursor + 1) % len(self._slots)
+                for chat_id in list(slot):
+                    action, _, _, started_at = self._chats[chat_id]
+                    if now - started_at > self._max_age:
+                        self.counters["expired"] += 1
+                        self._drop(chat_id)
+                    else:
+                        due.append((chat_id, action))
+            # Порядок случайный, чтобы при пропусках не отставали одни и те же чаты
+            random.shuffle(due)
+            deadline = now + self._tick
+            for i, (chat_id, action) in enumerate(due):
+                if time.monotonic() > deadline:
+                    self.counters["skipped"] += len(due) - i
+                    break
+                self._send(chat_id, action)
+            time.sleep(max(deadline - time.monotonic(), 0))
+
+    def __len__(self):
+        return len(self._chats)
+
+
+chat_actions = ChatActionKeepalive(CHAT_ACTION_REFRESH, CHAT_ACTION_TICK, CHAT_ACTION_MAX)
+
+
+def split_message(text: str, limit: int = 4096):
+    """Разбивает длинный текст на части по переносам строк, не разрывая слова."""
+    if len(text) <= limit:
+        return [text]
+    chunks = []
+    remaining = text
+    while remaining:
+        if len(remaining) <= limit:
+            chunks.append(remaining)
+            break
+        # Ищем последний перенос строки в пределах лимита
+        cut = remaining[:limit].rfind('\n')
+        if cut == -1:
+            cut = remaining[:limit].rfind(' ')
+        if cut == -1:
+            cut = limit
+        chunks.append(remaining[:cut])
+        remaining = remaining[cut:].lstrip()
+    return chunks
+
+
+def deliver_bot_answer(chat_id: int, user_id: int, text: str):
+    """Отправляет ответ бота (AI/FAQ) юзеру и записывает его в лог и БД."""
+    try:
+        for chunk in split_message(text):
+            sent = bot.send_message(chat_id, chunk)
+            user_conversation[user_id].append((chat_id, sent.message_id))
+        append_chat_log(user_id, "ai", text)
+        support_stats.bot_answered(user_id)
+        profile_prefetcher.note_ai_answer(user_id)
+        # Сохраняем ответ AI в БД (для веб-админки)
+        save_chat_message(user_id, "ai", text)
+    except Exception as e:
+        logger.error("Error sending AI response to %s: %s", chat_id, e)
 
 
 def process_ai_response(chat_id: int, user_id: int, user_text: str):
     """Отправляет текст в AI, обрабатывает ответ и эскалацию."""
-    bot.send_chat_action(chat_id, 'typing')
+    faq = faq_engine.match(user_text)
+    faq_stats["lookups"] += 1
+    if faq_confident(faq, FAQ_CONFIDENCE):
+        faq_stats["prefilter_hits"] += 1
+        logger.info("FAQ answer '%s' for user %s (confidence %.2f)", faq['id'], user_id, faq['confidence'])
+        # Вопрос и ответ уже в chat_log и БД (/admin/chats/{id}/save) — AI не зовём
+        deliver_bot_answer(chat_id, user_id, faq["answer"])
+        return
+
+    cache_key = ai_cache.key_for(user_id, user_text, faq)
+    cached = ai_cache.get(cache_key) if cache_key else None
+    if cached:
+        logger.info("AI cache hit for user %s", user_id)
+        deliver_bot_answer(chat_id, user_id, cached)
+        return
 
-    ai_text = get_ai_response(user_id, user_text)
+    # Эскалация вероятна — грузим профиль, пока ждём ИИ
+    if ai_circuit.is_open:
+        profile_prefetcher.warm(user_id, "ai_unavailable")
+    elif escalation_likely(user_text):
+        profile_prefetcher.warm(user_id, "phrase")
+
+    with chat_actions.keep(chat_id, 'typing'), admission.ai_slot() as acquired:
+        started = time.monotonic()
+        ai_text = get_ai_response(user_id, user_text) if acquired else None
+        latency = time.monotonic() - started
+    if not acquired:
+        # FAQ и кэш проверены до слота; сбрасываем только то, что без AI не ответить
+        if faq_confident(faq, FAQ_FALLBACK_CONFIDENCE):
+            faq_stats["busy_hits"] += 1
+            logger.warning("AI busy for user %s, answered from FAQ '%s'", user_id, faq['id'])
+            deliver_bot_answer(chat_id, user_id, faq["answer"] + FAQ_FALLBACK_FOOTER)
+        else:
+            shed_user_message(chat_id, user_id, "ai_busy")
+        return
     if ai_text:
-        # Разбиваем длинные сообщения на части (лимит Telegram: 4096)
-        try:
-            chunks = []
-            if len(ai_text) <= 4096:
-                chunks = [ai_text]
-            else:
-                # Разбиваем по переносам строк, не разрывая слова
-                remaining = ai_text
-                while remaining:
-                    if len(remaining) <= 4096:
-                        chunks.append(remaining)
-                        break
-                    # Ищем последний перенос строки в пределах лимита
-                    cut = remaining[:4096].rfind('\n')
-                    if cut == -1:
-                        cut = remaining[:4096].rfind(' ')
-                    if cut == -1:
-                        cut = 4096
-                    chunks.append(remaining[:cut])
-                    remaining = remaining[cut:].lstrip()
-
-            for chunk in chunks:
-                sent = bot.send_message(chat_id, chunk)
-                user_conversation[user_id].append((chat_id, sent.message_id))
-            chat_log[user_id].append({"role": "ai", "text": ai_text, "time": datetime.now().strftime("%H:%M")})
-            # Сохраняем ответ AI в БД (для веб-админки)
-            try:
-                requests.post(f"{SUPPORT_API_URL}/admin/chats/{user_id}/save",
-                              json={"role": "ai", "content": ai_text}, headers=admin_headers(), timeout=5)
-            except Exception:
-                pass
-        except Exception as e:
-            logger.error(f"Error sending AI response to {chat_id}: {e}")
+        # Ответы с эскалацией не кэшируем — они запускают тикет
+        if cache_key and not check_ai_escalation(ai_text):
+            ai_cache.put(cache_key, ai_text, latency)
+        deliver_bot_answer(chat_id, user_id, ai_text)
 
         # Проверяем, решил ли AI эскалировать
         if check_ai_escalation(ai_text):
             handle_escalation(chat_id, user_id, reason="AI предложил связаться с оператором")
+    elif faq_confident(faq, FAQ_FALLBACK_CONFIDENCE):
+        # AI недоступен, но вопрос похож на типовой — отвечаем из FAQ
+        faq_stats["fallback_hits"] += 1
+        logger.warning("AI unavailable for user %s, answered from FAQ '%s'", user_id, faq['id'])
+        deliver_bot_answer(chat_id, user_id, faq["answer"] + FAQ_FALLBACK_FOOTER)
     else:
         # AI недоступен — автоматическая эскалация
-        logger.warning(f"AI unavailable for user {user_id}, escalating")
+        faq_stats["fallback_misses"] += 1
+        logger.warning("AI unavailable for user %s, escalating", user_id)
         bot.send_message(chat_id, "ИИ-ассистент временно недоступен.")
         handle_escalation(chat_id, user_id, reason="AI недоступен")
 
 
 # ===== КОМАНДЫ =====
 
-@bot.message_handler(commands=['start'])
+@router.command('start', role="any")
+@update_handler
 def send_welcome(message):
     if message.from_user.id in ADMIN_IDS:
-        logger.info(f"Admin {message.from_user.id} started the bot")
+        logger.info("Admin %s started the bot", message.from_user.id)
         bot.send_message(message.chat.id,
                          "Вы админ. Используйте /help для списка команд.")
     else:
-        logger.info(f"User {message.from_user.id} started the bot")
+        logger.info("User %s started the bot", message.from_user.id)
         bot.reply_to(message,
                      "Здравствуйте! Это бот техподдержки SvoiVPN.\n\n"
                      "Напишите Ваш вопрос — ИИ-ассистент ответит мгновенно.\n"
                      "Если нужен живой оператор — просто напишите \"позовите оператора\".")
 
 
-@bot.message_handler(commands=['help'], func=lambda message: message.from_user.id in ADMIN_IDS)
+@router.command('help')
+@update_handler
 def handle_help(message):
-    logger.info(f"Admin {message.from_user.id} requested /help")
+    logger.info("Admin %s requested /help", message.from_user.id)
     help_text = """
 <b>🛠 Список административных команд:</b>
 
@@ -631,11 +3219,33 @@ def handle_help(message):
    <b>/maintenance off</b> — Выключить режим техработ
 
 <b>💬 Мониторинг:</b>
-9. <b>/chats</b> — Просмотр всех диалогов юзеров с ИИ
+9. <b>/chats [tickets|active]</b> — Просмотр диалогов юзеров с ИИ (постранично)
    Можно читать переписку и при необходимости вмешаться
 
+<b>📊 Статистика:</b>
+<b>/stats [1h|24h|7d|30d]</b> — Решено ИИ / эскалации, время ответа оператора, задержка ИИ
+
+<b>📈 Нагрузка:</b>
+<b>/load</b> — Счётчики принятых и сброшенных сообщений, загрузка AI, попадания FAQ
+
+<b>/trace TG_ID</b> — Последние трейсы обработки сообщений юзера (тайминги API и Telegram)
+
+<b>/profile</b> — Время обработки по хендлерам (wall/CPU)
+<b>/profile N</b> — Сэмплирующий профайлер на N секунд, результат файлом
+
+<b>/mem</b> — Память: RSS, размеры структур, размер состояния
+<b>/mem trace on|off</b> — tracemalloc; <b>/mem diff</b> — рост с прошлого /mem
+
+<b>/faults</b> — Инъекция задержек и сбоев upstream (только стейджинг, FAULT_INJECTION=1)
+<b>/faults add PATTERN latency=10 error=0.2 status=502 timeout=0.1 reset=0.05</b>
+<b>/faults clear</b> — Убрать все правила
+
+<b>/search QUERY</b> — Поиск по перепискам (с кнопками просмотра диалога)
+<b>/export [FROM [TO]] [TG_ID]</b> — Выгрузка переписок в .jsonl.gz (даты YYYY-MM-DD)
+
 <b>🎫 Тикеты:</b>
-10. <b>/reply</b> — Показать активные тикеты (эскалации)
+10. <b>/reply</b> — Очередь активных тикетов (сначала просроченные по SLA)
+   <b>/next</b> — Открыть следующий тикет из очереди
 11. Ответьте (reply) на сообщение тикета, чтобы отправить ответ пользователю
 12. Используйте кнопку «Закрыть тикет» для завершения
 
@@ -644,7 +3254,8 @@ def handle_help(message):
     bot.send_message(chat_id=message.chat.id, text=help_text, parse_mode="HTML")
 
 
-@bot.message_handler(commands=['info'], func=lambda message: message.from_user.id in ADMIN_IDS)
+@router.command('info')
+@update_handler
 def handle_info(message):
     try:
         parts = message.text.split()
@@ -656,9 +3267,9 @@ def handle_info(message):
         if not (tg_id.isdigit() or (tg_id.startswith('-') and tg_id[1:].isdigit())):
             raise ValueError("Telegram ID должен содержать только цифры")
 
-        logger.info(f"Admin {message.from_user.id} requested /info for {tg_id}")
+        logger.info("Admin %s requested /info for %s", message.from_user.id, tg_id)
 
-        response = requests.get(f"{API_URL}/{tg_id}/info")
+        response = http_get(f"{API_URL}/{tg_id}/info")
 
         if response.status_code == 200:
             user = response.json()
@@ -679,7 +3290,7 @@ def handle_info(message):
             # Get email if exists
             user_email = "—"
             try:
-                email_resp = requests.get(f"{SUPPORT_API_URL}/internal/user-email/{tg_id}", headers=internal_headers())
+                email_resp = http_get(f"{SUPPORT_API_URL}/internal/user-email/{tg_id}", headers=internal_headers())
                 if email_resp.status_code == 200:
                     user_email = email_resp.json().get("email", "—")
             except Exception:
@@ -739,11 +3350,12 @@ def handle_info(message):
     except ValueError as e:
         bot.reply_to(message, f"❌ Ошибка: {str(e)}")
     except Exception as e:
-        logger.error(f"Error in /info: {e}")
+        logger.error("Error in /info: %s", e)
         bot.reply_to(message, f"⚠️ Произошла ошибка: {str(e)}")
 
 
-@bot.message_handler(commands=['squads'], func=lambda message: message.from_user.id in ADMIN_IDS)
+@router.command('squads')
+@update_handler
 def handle_squads(message):
     try:
         parts = message.text.split()
@@ -755,9 +3367,9 @@ def handle_squads(message):
         if not (tg_id.isdigit() or (tg_id.startswith('-') and tg_id[1:].isdigit())):
             raise ValueError("Telegram ID должен содержать только цифры")
 
-        logger.info(f"Admin {message.from_user.id} requested /squads for {tg_id}")
+        logger.info("Admin %s requested /squads for %s", message.from_user.id, tg_id)
 
-        response = requests.get(f"{API_URL}/{tg_id}/squads")
+        response = http_get(f"{API_URL}/{tg_id}/squads")
 
         if response.status_code == 200:
             data = response.json()
@@ -780,11 +3392,12 @@ def handle_squads(message):
     except ValueError as e:
         bot.reply_to(message, f"❌ Ошибка: {str(e)}")
     except Exception as e:
-        logger.error(f"Error in /squads: {e}")
+        logger.error("Error in /squads: %s", e)
         bot.reply_to(message, f"⚠️ Произошла ошибка: {str(e)}")
 
 
-@bot.message_handler(commands=['extend'], func=lambda message: message.from_user.id in ADMIN_IDS)
+@router.command('extend')
+@update_handler
 def handle_extend(message):
     try:
         parts = message.text.split()
@@ -818,9 +3431,9 @@ def handle_extend(message):
         if days == 0:
             raise ValueError("Количество дней не может быть 0")
 
-        logger.info(f"Admin {message.from_user.id} extending {tg_id}: plan={plan}, days={days}")
+        logger.info("Admin %s extending %s: plan=%s, days=%s", message.from_user.id, tg_id, plan, days)
 
-        response = requests.patch(
+        response = http_patch(
             f"{API_URL}/{tg_id}/extend",
             json={"days": days, "plan": plan}
         )
@@ -833,7 +3446,7 @@ def handle_extend(message):
 
             # Log admin extension to payments ledger (fire-and-forget)
             try:
-                requests.post(
+                http_post(
                     f"{SUPPORT_API_URL}/internal/payments",
                     json={
                         "telegram_id": int(tg_id),
@@ -846,7 +3459,7 @@ def handle_extend(message):
                     timeout=3,
                 )
             except Exception as e:
-                logger.warning(f"log_payment for admin extend failed: {e}")
+                logger.warning("log_payment for admin extend failed: %s", e)
 
             if days > 0:
                 title = "✅ Подписка продлена"
@@ -868,11 +3481,12 @@ def handle_extend(message):
     except ValueError as e:
         bot.reply_to(message, f"❌ Ошибка: {str(e)}")
     except Exception as e:
-        logger.error(f"Error in /extend: {e}")
+        logger.error("Error in /extend: %s", e)
         bot.reply_to(message, f"⚠️ Произошла ошибка: {str(e)}")
 
 
-@bot.message_handler(commands=['toggle_pro'], func=lambda message: message.from_user.id in ADMIN_IDS)
+@router.command('toggle_pro')
+@update_handler
 def handle_toggle_pro(message):
     try:
         parts = message.text.split()
@@ -894,9 +3508,9 @@ def handle_toggle_pro(message):
             return
 
         enable = action == "on"
-        logger.info(f"Admin {message.from_user.id} toggle PRO for {tg_id}: enable={enable}")
+        logger.info("Admin %s toggle PRO for %s: enable=%s", message.from_user.id, tg_id, enable)
 
-        response = requests.patch(
+        response = http_patch(
             f"{API_URL}/{tg_id}/pro",
             json={"is_pro": enable}
         )
@@ -914,11 +3528,12 @@ def handle_toggle_pro(message):
     except ValueError as e:
         bot.reply_to(message, f"❌ Ошибка: {str(e)}")
     except Exception as e:
-        logger.error(f"Error in /toggle_pro: {e}")
+        logger.error("Error in /toggle_pro: %s", e)
         bot.reply_to(message, f"⚠️ Произошла ошибка: {str(e)}")
 
 
-@bot.message_handler(commands=['disable_device_limit'], func=lambda message: message.from_user.id in ADMIN_IDS)
+@router.command('disable_device_limit')
+@update_handler
 def handle_disable_device_limit(message):
     try:
         parts = message.text.split()
@@ -930,9 +3545,9 @@ def handle_disable_device_limit(message):
         if not (tg_id.isdigit() or (tg_id.startswith('-') and tg_id[1:].isdigit())):
             raise ValueError("Telegram ID должен содержать только цифры")
 
-        logger.info(f"Admin {message.from_user.id} disabling device limit for {tg_id}")
+        logger.info("Admin %s disabling device limit for %s", message.from_user.id, tg_id)
 
-        response = requests.post(
+        response = http_post(
             f"{API_URL}/{tg_id}/disable_device",
             headers={"Content-Type": "application/json"}
         )
@@ -945,7 +3560,7 @@ def handle_disable_device_limit(message):
     except ValueError as e:
         bot.reply_to(message, f"❌ Ошибка: {str(e)}")
     except Exception as e:
-        logger.error(f"Error in /disable_device_limit: {e}")
+        logger.error("Error in /disable_device_limit: %s", e)
         bot.reply_to(message, f"⚠️ Произошла ошибка: {str(e)}")
 
 
@@ -964,7 +3579,7 @@ def format_sub_end_date(sub_end_str):
 def send_user_referrals(message, tg_id: str):
     """Показать детальный список рефералов конкретного юзера: /refs TG_ID."""
     try:
-        resp = requests.get(
+        resp = http_get(
             f"{SUPPORT_API_URL}/admin/users/{tg_id}/referrals",
             headers=admin_headers(),
             timeout=10
@@ -1023,11 +3638,12 @@ def send_user_referrals(message, tg_id: str):
         if current.strip():
             bot.send_message(message.chat.id, current, parse_mode="HTML")
     except Exception as e:
-        logger.error(f"Error in /refs TG_ID: {e}")
+        logger.error("Error in /refs TG_ID: %s", e)
         bot.reply_to(message, f"⚠️ Ошибка: {e}")
 
 
-@bot.message_handler(commands=['refs'], func=lambda message: message.from_user.id in ADMIN_IDS)
+@router.command('refs')
+@update_handler
 def handle_refs(message):
     """Топ рефералов: /refs [N] или детали юзера: /refs TG_ID."""
     try:
@@ -1045,7 +3661,7 @@ def handle_refs(message):
             except ValueError:
                 pass
 
-        resp = requests.get(
+        resp = http_get(
             f"{SUPPORT_API_URL}/admin/referral/top",
             headers=admin_headers(),
             timeout=10
@@ -1080,11 +3696,12 @@ def handle_refs(message):
 
         bot.send_message(message.chat.id, "\n".join(lines), parse_mode="HTML")
     except Exception as e:
-        logger.error(f"Error in /refs: {e}")
+        logger.error("Error in /refs: %s", e)
         bot.reply_to(message, f"⚠️ Ошибка: {e}")
 
 
-@bot.message_handler(commands=['maintenance'], func=lambda message: message.from_user.id in ADMIN_IDS)
+@router.command('maintenance')
+@update_handler
 def handle_maintenance(message):
     """Переключить режим тех. работ: /maintenance on|off"""
     try:
@@ -1094,23 +3711,26 @@ def handle_maintenance(message):
             return
 
         enabled = parts[1] == 'on'
-        resp = requests.post(
+        resp = http_post(
             f"{SUPPORT_API_URL}/internal/support/maintenance",
             json={"enabled": enabled},
             headers=internal_headers(),
             timeout=10
         )
         if resp.status_code == 200:
+            # Закэшированные ответы AI зависят от режима тех. работ
+            ai_cache.clear()
             status = "🔴 ВКЛ" if enabled else "🟢 ВЫКЛ"
             bot.reply_to(message, f"Режим тех. работ: {status}\nИИ будет {'сообщать юзерам о техработах' if enabled else 'работать в обычном режиме'}.")
         else:
             bot.reply_to(message, f"Ошибка: {resp.status_code}")
     except Exception as e:
-        logger.error(f"Error in /maintenance: {e}")
+        logger.error("Error in /maintenance: %s", e)
         bot.reply_to(message, f"Ошибка: {e}")
 
 
-@bot.message_handler(commands=['compensate'], func=lambda message: message.from_user.id in ADMIN_IDS)
+@router.command('compensate')
+@update_handler
 def handle_compensate(message):
     try:
         parts = message.text.split()
@@ -1122,10 +3742,10 @@ def handle_compensate(message):
         if days <= 0:
             raise ValueError("Количество дней должно быть больше 0")
 
-        logger.info(f"Admin {message.from_user.id} starting compensation: {days} days")
+        logger.info("Admin %s starting compensation: %s days", message.from_user.id, days)
 
         # Получаем список активных юзеров
-        response = requests.get(f"{API_URL.rsplit('/', 1)[0]}/users/active")
+        response = http_get(f"{API_URL.rsplit('/', 1)[0]}/users/active")
         if response.status_code != 200:
             bot.reply_to(message, f"❌ Не удалось получить список пользователей: {response.text}")
             return
@@ -1143,45 +3763,402 @@ def handle_compensate(message):
         failed = 0
         skipped = 0
 
-        for user in users:
-            tg_id = user.get("telegram_id")
-            plan = user.get("plan", "")
+        for user in users:
+            tg_id = user.get("telegram_id")
+            plan = user.get("plan", "")
+
+            if plan in ("trial", "free", ""):
+                skipped += 1
+                continue
+
+            try:
+                r = http_patch(
+                    f"{API_URL}/{tg_id}/extend",
+                    json={"days": days, "plan": plan}
+                )
+                if r.status_code == 200:
+                    success += 1
+                else:
+                    failed += 1
+                    logger.warning("Compensate failed for %s: %s %s", tg_id, r.status_code, r.text)
+            except Exception as e:
+                failed += 1
+                logger.error("Compensate error for %s: %s", tg_id, e)
+
+        result_text = (
+            f"✅ Компенсация завершена!\n\n"
+            f"<b>Дней:</b> {days}\n"
+            f"<b>Всего активных:</b> {total}\n"
+            f"<b>Успешно:</b> {success}\n"
+            f"<b>Пропущено (trial/free):</b> {skipped}\n"
+            f"<b>Ошибки:</b> {failed}"
+        )
+
+        logger.info("Compensation done: %s success, %s skipped, %s failed", success, skipped, failed)
+        bot.edit_message_text(result_text, message.chat.id, status_msg.message_id, parse_mode="HTML")
+
+    except ValueError as e:
+        bot.reply_to(message, f"❌ Ошибка: {str(e)}")
+    except Exception as e:
+        logger.error("Error in /compensate: %s", e)
+        bot.reply_to(message, f"⚠️ Произошла ошибка: {str(e)}")
+
+
+@router.command('load')
+@update_handler
+def handle_load(message):
+    """Счётчики нагрузки: допуск сообщений, AI, FAQ и кэш ответов."""
+    c = admission.counters
+    text = (
+        f"<b>📈 Нагрузка</b>\n\n"
+        f"<b>Принято сообщений:</b> {c['admitted']}\n"
+        f"<b>Сброшено (лимит юзера):</b> {c['shed_rate_limited']}\n"
+        f"<b>Сброшено (AI перегружен):</b> {c['shed_ai_busy']}\n"
+        f"<b>AI в работе:</b> {admission.ai_in_flight}/{AI_MAX_CONCURRENCY}\n"
+        f"<b>AI в очереди:</b> {admission.ai_waiting}/{AI_MAX_WAITING}\n"
+        f"<b>AI circuit:</b> {'🔴 разомкнут' if ai_circuit.is_open else '🟢 замкнут'}\n\n"
+        f"<b>📚 FAQ</b> ({len(faq_engine.entries)} ответов)\n"
+        f"<b>Ответов вместо AI:</b> {faq_stats['prefilter_hits']} из {faq_stats['lookups']} "
+        f"({faq_stats['prefilter_hits'] / max(faq_stats['lookups'], 1):.0%})\n"
+        f"<b>Фоллбэк при недоступном AI:</b> {faq_stats['fallback_hits']} "
+        f"(промахов: {faq_stats['fallback_misses']})\n"
+        f"<b>Из FAQ при перегрузке AI:</b> {faq_stats['busy_hits']}"
+    )
+    if ai_cache.enabled:
+        st = ai_cache.stats
+        lookups = st["hits"] + st["misses"]
+        text += (
+            f"\n\n<b>🗄 Кэш ответов AI</b> ({len(ai_cache)}/{AI_CACHE_SIZE})\n"
+            f"<b>Попаданий:</b> {int(st['hits'])} из {int(lookups)} ({st['hits'] / max(lookups, 1):.0%})\n"
+            f"<b>Пропущено (есть история):</b> {int(st['bypass'])}\n"
+            f"<b>Сэкономлено времени AI:</b> {st['saved_seconds']:.1f} с"
+        )
+    ac = ai_client.counters
+    outcomes = ", ".join(f"{kind}/{outcome} {n}" for (kind, outcome), n in sorted(ai_client.attempts.items())) or "—"
+    hedge_delay = ai_client.hedge_delay()
+    text += (
+        f"\n\n<b>🤖 AI-клиент</b>\n"
+        f"<b>Таймаут попытки:</b> {ai_client.attempt_timeout():.1f} с, "
+        f"<b>хедж через:</b> {f'{hedge_delay:.1f} с' if hedge_delay is not None else '—'}\n"
+        f"<b>Бюджет повторов:</b> {ai_client.budget:.1f}/{AI_RETRY_BUDGET_MAX} "
+        f"(отказано: {ac['hedge_denied'] + ac['retry_denied']})\n"
+        f"<b>Хеджей:</b> {ac['hedge']} (выиграли {ac['hedge_wins']}), "
+        f"<b>повторов:</b> {ac['retry']} (успешных {ac['retry_wins']})\n"
+        f"<b>Попытки:</b> {outcomes}"
+    )
+    pf = profile_prefetcher.stats
+    warms = ", ".join(f"{k[5:]} {v}" for k, v in sorted(pf.items()) if k.startswith("warm_")) or "—"
+    text += (
+        f"\n\n<b>👤 Прогрев профилей</b>\n"
+        f"<b>Тикетов с готовым профилем:</b> {pf['hits']} из {pf['hits'] + pf['misses']}\n"
+        f"<b>Прогревы:</b> {warms}"
+    )
+    dg = admin_digest.counters
+    text += (
+        f"\n\n<b>📋 Уведомления админам</b>\n"
+        f"<b>Режим:</b> {'сводка' if admin_digest.active else 'сразу'}, "
+        f"<b>за {ADMIN_DIGEST_WINDOW} с:</b> {admin_digest.rate()} (порог {ADMIN_DIGEST_ENTER}/{ADMIN_DIGEST_EXIT})\n"
+        f"<b>Эпизодов сводки:</b> {dg['episodes']}, <b>в сводку ушло:</b> "
+        f"{dg['absorbed_ticket']} тикетов, {dg['absorbed_message']} сообщ."
+    )
+    ca = chat_actions.counters
+    text += (
+        f"\n\n<b>⌨️ Индикатор набора</b>\n"
+        f"<b>Чатов сейчас:</b> {len(chat_actions)}, <b>отправлено:</b> {ca['sent']} "
+        f"(ошибок: {ca['errors']}, истекло: {ca['expired']})"
+    )
+    bot.reply_to(message, text, parse_mode="HTML")
+
+
+@router.command('trace')
+@update_handler
+def handle_trace(message):
+    """Последние трейсы апдейтов юзера: /trace TG_ID."""
+    parts = message.text.split()
+    if len(parts) != 2 or not parts[1].lstrip('-').isdigit():
+        bot.reply_to(message, "Использование: /trace TG_ID\nПример: /trace 123456789")
+        return
+
+    traces = tracer.recent(int(parts[1]))
+    if not traces:
+        bot.reply_to(message, f"Нет трейсов для {parts[1]}.")
+        return
+
+    blocks = []
+    for trace in reversed(traces):
+        started = datetime.fromtimestamp(trace["start"]).strftime("%d.%m %H:%M:%S")
+        lines = [f"<b>{started}</b> {trace['handler']} — <b>{trace['duration_ms']:.0f} мс</b> "
+                 f"<code>{trace['trace_id']}</code>"]
+        for sp in trace["spans"]:
+            error = f" ❌ {sp['error']}" if "error" in sp else ""
+            lines.append(f"  +{sp['start_ms']:.0f} {sp['name']}: {sp['duration_ms']:.0f} мс{error}")
+        blocks.append("\n".join(lines))
+
+    text = f"🔍 <b>Трейсы {parts[1]}:</b>\n\n"
+    for block in blocks:
+        if len(text) + len(block) > 4000:
+            break
+        text += block + "\n\n"
+    bot.reply_to(message, text, parse_mode="HTML")
+
+
+@router.command('profile')
+@update_handler
+def handle_profile(message):
+    """/profile — время по хендлерам; /profile N — сэмплирование N секунд, результат файлом."""
+    parts = message.text.split()
+    if len(parts) == 1:
+        stats = handler_stats.snapshot()
+        if not stats:
+            bot.reply_to(message, "Пока нет данных.")
+            return
+        lines = ["<b>⏱ Хендлеры</b> (вызовы · ср. wall · ср. CPU · макс · медленных)\n", "<pre>"]
+        for name, (count, wall, cpu, max_wall, slow) in sorted(stats.items(), key=lambda x: -x[1][1]):
+            lines.append(f"{name[:28]:<28} {count:>6} {wall / count:>7.0f} {cpu / count:>6.0f} "
+                         f"{max_wall:>7.0f} {slow:>4}")
+        lines.append("</pre>")
+        lines.append(f"Порог медленного апдейта: {SLOW_UPDATE_MS:.0f} мс")
+        bot.reply_to(message, "\n".join(lines), parse_mode="HTML")
+        return
+
+    try:
+        seconds = int(parts[1])
+    except ValueError:
+        bot.reply_to(message, "Использование: /profile [SECONDS]\nПример: /profile 30")
+        return
+    seconds = min(max(seconds, 1), PROFILE_MAX_SECONDS)
+    chat_id = message.chat.id
+
+    def on_done(folded, samples):
+        if not folded:
+            bot.send_message(chat_id, "Профайлер не собрал ни одного сэмпла.")
+            return
+        doc = io.BytesIO(folded.encode())
+        doc.name = f"profile_{datetime.now().strftime('%Y%m%d_%H%M%S')}.folded"
+        bot.send_document(chat_id, doc, caption=f"🔥 {seconds} с, {samples} сэмплов (collapsed stacks для flamegraph)")
+
+    if not profiler.start(seconds, on_done):
+        bot.reply_to(message, "Профайлер уже запущен.")
+        return
+    logger.info("Admin %s started profiler for %ss", message.from_user.id, seconds)
+    bot.reply_to(message, f"🔥 Профайлер запущен на {seconds} с.")
+
+
+MEM_SIZE_SAMPLE = 2000  # элементов, по которым оценивается размер большой структуры
+_mem_snapshot = None  # снимок tracemalloc с прошлого /mem для диффа
+
+
+def read_rss_bytes():
+    """RSS процесса из /proc (Linux) или пиковый RSS из getrusage."""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except Exception:
+        pass
+    try:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    except Exception:
+        return 0
+
+
+def deep_sizeof(obj, seen=None):
+    """Размер объекта со всем содержимым (без общих объектов, посчитанных ранее)."""
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(deep_sizeof(k, seen) + deep_sizeof(v, seen) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset, deque)):
+        size += sum(deep_sizeof(x, seen) for x in obj)
+    elif hasattr(obj, '__slots__'):
+        size += sum(deep_sizeof(getattr(obj, a), seen) for a in obj.__slots__ if hasattr(obj, a))
+    elif hasattr(obj, '__dict__'):
+        size += deep_sizeof(obj.__dict__, seen)
+    return size
+
+
+def approx_deep_size(container):
+    """Оценка размера словаря/списка: по выборке элементов, экстраполяцией на все."""
+    items = list(container.items()) if isinstance(container, dict) else list(container)
+    n = len(items)
+    if n <= MEM_SIZE_SAMPLE:
+        return deep_sizeof(container)
+    step = n // MEM_SIZE_SAMPLE
+    seen = set()
+    sampled = sum(deep_sizeof(x, seen) for x in items[::step][:MEM_SIZE_SAMPLE])
+    return sys.getsizeof(container) + sampled * n // MEM_SIZE_SAMPLE
+
+
+def format_bytes(n: float) -> str:
+    sign = "-" if n < 0 else ""  # отрицательный рост в /mem diff
+    n = abs(n)
+    for unit in ("Б", "КБ", "МБ"):
+        if n < 1024:
+            return f"{sign}{n:.0f} {unit}"
+        n /= 1024
+    return f"{sign}{n:.1f} ГБ"
+
+
+def memory_structures():
+    """Основные структуры в памяти: имя -> (объект, число записей)."""
+    return {
+        "chat_log": (chat_log, sum(len(v) for v in list(chat_log.values()))),
+        "user_conversation": (user_conversation, sum(len(v) for v in list(user_conversation.values()))),
+        "ticket_message_to_user": (ticket_message_to_user, len(ticket_message_to_user)),
+        "user_data_cache": (user_data_cache, len(user_data_cache)),
+        "user_last_activity": (user_last_activity, len(user_last_activity)),
+        "recently_closed": (recently_closed, len(recently_closed)),
+        "peek cache": (conversation_viewer._history, len(conversation_viewer._history)),
+        "traces": (tracer._by_user, sum(len(v) for v in list(tracer._by_user.values()))),
+        "rate buckets": (admission._buckets, len(admission._buckets)),
+        "AI cache": (ai_cache._items, len(ai_cache)),
+    }
+
+
+@router.command('faults')
+@update_handler
+def handle_faults(message):
+    """/faults — правила инъекции сбоев; /faults add PATTERN k=v ...; /faults clear."""
+    if not FAULT_INJECTION_ALLOWED:
+        bot.reply_to(message, "Инъекция сбоев выключена (FAULT_INJECTION=1 только на стейджинге).")
+        return
+    parts = message.text.split(maxsplit=2)
+    action = parts[1] if len(parts) > 1 else ""
+    if action == "add" and len(parts) > 2:
+        try:
+            rule = parse_fault_rule(parts[2])
+        except ValueError as e:
+            bot.reply_to(message, f"Ошибка в правиле: {e}\n\n{parse_fault_rule.__doc__}")
+            return
+        fault_injector.add_rule(rule)
+        logger.warning("Admin %s added fault rule: %s", message.from_user.id, parts[2])
+    elif action == "clear":
+        fault_injector.set_rules([])
+        logger.warning("Admin %s cleared fault rules", message.from_user.id)
+    elif action:
+        bot.reply_to(message, "Использование: /faults [add PATTERN k=v ... | clear]")
+        return
+
+    if not fault_injector.rules:
+        bot.reply_to(message, "Правил инъекции нет.")
+        return
+    lines = ["<b>💥 Инъекция сбоев</b>\n"]
+    for rule in fault_injector.rules:
+        options = " ".join(f"{k}={rule[k]}" for k, default in FAULT_DEFAULTS.items() if rule[k] != default)
+        counts = ", ".join(f"{kind} {n}" for (pattern, kind), n in sorted(fault_injector.injected.items())
+                           if pattern == rule["pattern"]) or "—"
+        lines.append(f"<code>{html.escape(rule['pattern'])}</code> {options}\n  сработало: {counts}")
+    bot.reply_to(message, "\n".join(lines), parse_mode="HTML")
+
+
+@router.command('mem')
+@update_handler
+def handle_mem(message):
+    """/mem — память бота; /mem trace on|off — tracemalloc; /mem diff — изменения с прошлого /mem."""
+    global _mem_snapshot
+    parts = message.text.split()
+    if len(parts) == 3 and parts[1] == "trace" and parts[2] in ("on", "off"):
+        if parts[2] == "on":
+            tracemalloc.start(10)
+        else:
+            tracemalloc.stop()
+            _mem_snapshot = None
+        bot.reply_to(message, f"tracemalloc: {'🟢 включён' if parts[2] == 'on' else '⚪ выключен'}")
+        return
+
+    lines = [f"<b>🧠 Память</b>\n\n<b>RSS:</b> {format_bytes(read_rss_bytes())}",
+             f"<b>Последний save_state:</b> {format_bytes(last_state_bytes)}\n",
+             "<pre>"]
+    for name, (obj, entries) in memory_structures().items():
+        try:
+            size = approx_deep_size(obj)
+        except Exception:
+            size = 0
+        lines.append(f"{name:<24} {entries:>8} {format_bytes(size):>10}")
+    lines.append("</pre>")
+
+    if tracemalloc.is_tracing():
+        snapshot = tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+        ))
+        if len(parts) == 2 and parts[1] == "diff" and _mem_snapshot is not None:
+            lines.append("\n<b>Рост с прошлого /mem:</b>")
+            stats = snapshot.compare_to(_mem_snapshot, 'lineno')[:10]
+            for st in stats:
+                frame = st.traceback[0]
+                lines.append(f"<code>{os.path.basename(frame.filename)}:{frame.lineno}</code> "
+                             f"{format_bytes(st.size_diff)} ({st.count_diff:+d})")
+        else:
+            lines.append("\n<b>Топ мест выделения:</b>")
+            for st in snapshot.statistics('lineno')[:10]:
+                frame = st.traceback[0]
+                lines.append(f"<code>{os.path.basename(frame.filename)}:{frame.lineno}</code> "
+                             f"{format_bytes(st.size)} ({st.count})")
+        _mem_snapshot = snapshot
+    else:
+        lines.append("\ntracemalloc выключен: <code>/mem trace on</code>")
+
+    bot.reply_to(message, "\n".join(lines), parse_mode="HTML")
 
-            if plan in ("trial", "free", ""):
-                skipped += 1
-                continue
 
-            try:
-                r = requests.patch(
-                    f"{API_URL}/{tg_id}/extend",
-                    json={"days": days, "plan": plan}
-                )
-                if r.status_code == 200:
-                    success += 1
-                else:
-                    failed += 1
-                    logger.warning(f"Compensate failed for {tg_id}: {r.status_code} {r.text}")
-            except Exception as e:
-                failed += 1
-                logger.error(f"Compensate error for {tg_id}: {e}")
+def format_duration(seconds) -> str:
+    if seconds is None:
+        return "—"
+    if seconds < 60:
+        return f"{seconds:.1f} с"
+    if seconds < 3600:
+        return f"{seconds / 60:.0f} мин"
+    return f"{seconds / 3600:.1f} ч"
 
-        result_text = (
-            f"✅ Компенсация завершена!\n\n"
-            f"<b>Дней:</b> {days}\n"
-            f"<b>Всего активных:</b> {total}\n"
-            f"<b>Успешно:</b> {success}\n"
-            f"<b>Пропущено (trial/free):</b> {skipped}\n"
-            f"<b>Ошибки:</b> {failed}"
-        )
 
-        logger.info(f"Compensation done: {success} success, {skipped} skipped, {failed} failed")
-        bot.edit_message_text(result_text, message.chat.id, status_msg.message_id, parse_mode="HTML")
+@router.command('stats')
+@update_handler
+def handle_stats(message):
+    """Статистика поддержки: /stats [1h|24h|7d|30d]."""
+    parts = message.text.split()
+    period = parts[1] if len(parts) > 1 else "24h"
+    if period not in STATS_PERIODS:
+        bot.reply_to(message, f"Использование: /stats [{'|'.join(STATS_PERIODS)}]")
+        return
 
-    except ValueError as e:
-        bot.reply_to(message, f"❌ Ошибка: {str(e)}")
-    except Exception as e:
-        logger.error(f"Error in /compensate: {e}")
-        bot.reply_to(message, f"⚠️ Произошла ошибка: {str(e)}")
+    c, h = support_stats.summary(STATS_PERIODS[period])
+    conversations = c["conversations"]
+    escalated = c["escalated_conversations"]
+    resolved = max(conversations - escalated, 0)
+    closed = c["tickets_closed"]
+
+    def pct(part, whole):
+        return f"{part / whole:.0%}" if whole else "—"
+
+    def pcts(hist, *ps):
+        return " / ".join(format_duration(hist.percentile(p)) for p in ps)
+
+    text = (
+        f"📊 <b>Статистика за {period}</b>\n\n"
+        f"<b>💬 Диалоги с ИИ:</b> {conversations}\n"
+        f"  Решено ИИ: {resolved} ({pct(resolved, conversations)})\n"
+        f"  Эскалировано: {escalated} ({pct(escalated, conversations)})\n"
+        f"  Ответов бота: {c['bot_answers']}\n\n"
+        f"<b>🙋 Эскалации:</b> {c['tickets_opened']}\n"
+        f"  Юзер попросил оператора: {c['esc_user_phrase']}\n"
+        f"  ИИ передал оператору: {c['esc_ai_trigger']}\n"
+        f"  ИИ недоступен: {c['esc_ai_unavailable']}\n"
+        f"  Другое (веб, reply): {c['esc_other']}\n\n"
+        f"<b>🎫 Тикеты:</b> закрыто {closed}, авто {c['tickets_auto_closed']} "
+        f"({pct(c['tickets_auto_closed'], closed)})\n"
+        f"  Первый ответ оператора p50/p90: {pcts(h['first_response'], 50, 90)}\n"
+        f"  Длительность тикета p50/p90: {pcts(h['ticket_duration'], 50, 90)}\n\n"
+        f"<b>🤖 Задержка ИИ</b> ({h['ai_latency'].count} вызовов, ошибок {c['ai_errors']})\n"
+        f"  p50/p90/p99: {pcts(h['ai_latency'], 50, 90, 99)}"
+    )
+    bot.reply_to(message, text, parse_mode="HTML")
 
 
 # ===== МОНИТОРИНГ ЧАТОВ =====
@@ -1201,49 +4178,109 @@ def format_time_ago(dt):
     return f"{days} дн"
 
 
-@bot.message_handler(commands=['chats'], func=lambda message: message.from_user.id in ADMIN_IDS)
-def show_active_chats(message):
-    """Показывает всех юзеров с диалогами — загружает из БД."""
-    logger.info(f"Admin {message.from_user.id} requested /chats")
+CHATS_PAGE_SIZE = 20
+CHATS_CACHE_TTL = 15  # сек — общий кэш страниц /chats для всех админов
+CHATS_ACTIVE_SECONDS = 600
+CHAT_FILTERS = {
+    "all": "Все",
+    "tickets": "🎫 Тикеты",
+    "active": "🟢 Активные",
+}
+_chats_cache = {}  # (filter, offset) -> (fetched_at, page)
+_chats_cache_lock = threading.Lock()
 
-    # Load chats from DB API instead of in-memory chat_log
+
+def parse_chat_time(last_time_str):
+    """Парсит last_time из /admin/chats в naive datetime (или None)."""
     try:
-        resp = requests.get(f"{SUPPORT_API_URL}/admin/chats", headers=admin_headers(), timeout=10)
-        if resp.status_code != 200:
-            bot.reply_to(message, "Ошибка загрузки чатов.")
-            return
-        db_chats = resp.json()
-    except Exception as e:
-        logger.error(f"Failed to load chats from DB: {e}")
-        bot.reply_to(message, "Ошибка соединения с API.")
-        return
+        return datetime.fromisoformat(last_time_str.replace("+00:00", "").replace("Z", ""))
+    except Exception:
+        return None
+
+
+def chat_matches_filter(chat: dict, flt: str) -> bool:
+    if flt == "tickets":
+        return chat.get("telegram_id") in active_tickets
+    if flt == "active":
+        last_time = parse_chat_time(chat.get("last_time") or "")
+        return bool(last_time) and (datetime.now() - last_time).total_seconds() < CHATS_ACTIVE_SECONDS
+    return True
+
+
+def fetch_chats_page(flt: str, offset: int):
+    """Страница /admin/chats: {"chats": [...], "total": int|None, "has_more": bool}.
+
+    Просит у API limit/offset и фильтр. Если API отдал весь список
+    (старый бэкенд без пагинации) — фильтруем и режем локально, а полный
+    список кэшируем, чтобы листание не перекачивало его заново.
+    """
+    now = time.monotonic()
+    with _chats_cache_lock:
+        for key in ((flt, offset), (flt, None)):
+            cached = _chats_cache.get(key)
+            if cached and now - cached[0] < CHATS_CACHE_TTL:
+                page = cached[1]
+                if key[1] is None:
+                    rows = page[offset:offset + CHATS_PAGE_SIZE]
+                    return {"chats": rows, "total": len(page), "has_more": offset + CHATS_PAGE_SIZE < len(page)}
+                return page
+
+    params = {"limit": CHATS_PAGE_SIZE, "offset": offset}
+    if flt == "tickets":
+        params["tickets_only"] = "true"
+    elif flt == "active":
+        params["active_minutes"] = CHATS_ACTIVE_SECONDS // 60
+    resp = http_get(f"{SUPPORT_API_URL}/admin/chats", params=params, headers=admin_headers(), timeout=10)
+    if resp.status_code != 200:
+        return None
+    data = resp.json()
+
+    if isinstance(data, dict):
+        rows = data.get("chats", [])
+        total = data.get("total")
+        has_more = offset + len(rows) < total if total is not None else len(rows) >= CHATS_PAGE_SIZE
+        page = {"chats": rows, "total": total, "has_more": has_more}
+        key = (flt, offset)
+    elif len(data) > CHATS_PAGE_SIZE or offset:
+        full = [c for c in data if chat_matches_filter(c, flt)]
+        with _chats_cache_lock:
+            _chats_cache[(flt, None)] = (now, full)
+        rows = full[offset:offset + CHATS_PAGE_SIZE]
+        return {"chats": rows, "total": len(full), "has_more": offset + CHATS_PAGE_SIZE < len(full)}
+    else:
+        rows = [c for c in data if chat_matches_filter(c, flt)]
+        page = {"chats": rows, "total": len(rows), "has_more": False}
+        key = (flt, offset)
+
+    with _chats_cache_lock:
+        _chats_cache[key] = (now, page)
+    return page
 
-    if not db_chats:
-        bot.reply_to(message, "Нет активных диалогов.")
-        return
 
-    # Sync active tickets
-    sync_active_tickets()
+def render_chats_page(flt: str, offset: int):
+    """Текст и клавиатура страницы /chats. Бросает исключение при ошибке API."""
+    page = fetch_chats_page(flt, offset)
+    if page is None:
+        return None, None
 
     markup = types.InlineKeyboardMarkup()
-    for chat in db_chats[:20]:
+    markup.row(*[
+        types.InlineKeyboardButton(text=("• " if key == flt else "") + title, callback_data=f"chats_{key}_0")
+        for key, title in CHAT_FILTERS.items()
+    ])
+    for chat in page["chats"]:
         user_id = chat.get("telegram_id")
         username = chat.get("username", f"id{user_id}")
         msg_count = chat.get("message_count", 0)
-        last_time_str = chat.get("last_time", "")
 
         # Parse time for status
-        try:
-            last_time = datetime.fromisoformat(last_time_str.replace("+00:00", "").replace("Z", ""))
-            time_str = format_time_ago(last_time)
-        except Exception:
-            time_str = "?"
-            last_time = None
+        last_time = parse_chat_time(chat.get("last_time", ""))
+        time_str = format_time_ago(last_time) if last_time else "?"
 
         # Статус
         if user_id in active_tickets:
             status = "🎫"
-        elif last_time and (datetime.now() - last_time).total_seconds() < 600:
+        elif last_time and (datetime.now() - last_time).total_seconds() < CHATS_ACTIVE_SECONDS:
             status = "🟢"
         elif last_time and (datetime.now() - last_time).total_seconds() < 3600:
             status = "🟡"
@@ -1258,71 +4295,466 @@ def show_active_chats(message):
             callback_data=f"peek_{user_id}",
         ))
 
+    nav = []
+    if offset > 0:
+        nav.append(types.InlineKeyboardButton(
+            text="◀️", callback_data=f"chats_{flt}_{max(offset - CHATS_PAGE_SIZE, 0)}"))
+    if page["has_more"]:
+        nav.append(types.InlineKeyboardButton(
+            text="▶️", callback_data=f"chats_{flt}_{offset + CHATS_PAGE_SIZE}"))
+    if nav:
+        markup.row(*nav)
+
+    shown = f"{offset + 1}–{offset + len(page['chats'])}" if page["chats"] else "0"
+    total = f" из {page['total']}" if page["total"] is not None else ""
     legend = (
-        "💬 <b>Диалоги с ИИ:</b>\n\n"
+        f"💬 <b>Диалоги с ИИ</b> ({CHAT_FILTERS[flt]}: {shown}{total})\n\n"
         "🟢 активен (&lt; 10 мин)\n"
         "🟡 недавно (&lt; 1 ч)\n"
         "⚪ давно\n"
         "🎫 есть тикет"
     )
-    bot.send_message(message.chat.id, legend, reply_markup=markup, parse_mode="HTML")
+    return legend, markup
 
 
-# ===== ТИКЕТЫ =====
+@router.command('chats')
+@update_handler
+def show_active_chats(message):
+    """Показывает диалоги юзеров постранично: /chats [tickets|active]."""
+    logger.info("Admin %s requested /chats", message.from_user.id)
+    parts = message.text.split()
+    flt = parts[1] if len(parts) > 1 and parts[1] in CHAT_FILTERS else "all"
 
-@bot.message_handler(commands=['reply'], func=lambda message: message.from_user.id in ADMIN_IDS)
-def show_active_tickets(message):
-    logger.info(f"Admin {message.from_user.id} requested /reply")
-    if not active_tickets:
-        bot.reply_to(message, "Нет активных тикетов.")
+    # Sync active tickets (не чаще раза в CHATS_CACHE_TTL)
+    sync_active_tickets(max_age=CHATS_CACHE_TTL)
+
+    try:
+        text, markup = render_chats_page(flt, 0)
+    except Exception as e:
+        logger.error("Failed to load chats from DB: %s", e)
+        bot.reply_to(message, "Ошибка соединения с API.")
+        return
+    if text is None:
+        bot.reply_to(message, "Ошибка загрузки чатов.")
+        return
+    bot.send_message(message.chat.id, text, reply_markup=markup, parse_mode="HTML")
+
+
+# ===== ПОИСК ПО ПЕРЕПИСКАМ =====
+
+SEARCH_DB = os.getenv('SEARCH_DB', '/data/search.db')
+SEARCH_RESULTS = 10
+SEARCH_TOKEN_RE = re.compile(r"\w+")
+
+
+class SearchIndex:
+    """Полнотекстовый индекс сообщений (SQLite FTS5), пополняется в фоне.
+
+    append_chat_log кладёт запись в очередь, фоновый поток пишет пачками
+    в одной транзакции. Поиск — по префиксам слов, ранжирование bm25,
+    результаты группируются по диалогам.
+    """
+
+    def __init__(self, path: str):
+        self._path = path
+        self._lock = threading.Lock()
+        self._queue = queue.Queue()
+        self._conn = None
+        self._worker = None
+        self.available = True
+
+    def _connect(self):
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self._path), exist_ok=True)
+            conn = sqlite3.connect(self._path, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS messages USING fts5("
+                "content, user_id UNINDEXED, role UNINDEXED, ts UNINDEXED, "
+                "tokenize='unicode61 remove_diacritics 2')")
+            conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+            self._conn = conn
+        return self._conn
+
+    def add(self, user_id: int, record):
+        if not self.available or not record.text or record.text.startswith("[SYSTEM]"):
+            return
+        self._queue.put((record.text, user_id, record.role, record.ts))
+        if self._worker is None:
+            with self._lock:
+                if self._worker is None:
+                    self._worker = threading.Thread(target=self._run, daemon=True, name="search-index")
+                    self._worker.start()
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < 500:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                with self._lock:
+                    conn = self._connect()
+                    conn.executemany("INSERT INTO messages (content, user_id, role, ts) VALUES (?, ?, ?, ?)", batch)
+                    conn.commit()
+            except Exception as e:
+                logger.error("Search index disabled: %s", e)
+                self.available = False
+                return
+
+    def backfill(self, log: dict):
+        """Однократно индексирует восстановленный chat_log (при первом запуске с индексом)."""
+        try:
+            with self._lock:
+                conn = self._connect()
+                if conn.execute("SELECT 1 FROM meta WHERE key = 'backfilled'").fetchone():
+                    return
+                rows = [(m.text, uid, m.role, m.ts) for uid, msgs in log.items() for m in msgs
+                        if m.text and not m.text.startswith("[SYSTEM]")]
+                conn.executemany("INSERT INTO messages (content, user_id, role, ts) VALUES (?, ?, ?, ?)", rows)
+                conn.execute("INSERT INTO meta (key, value) VALUES ('backfilled', ?)", (str(int(time.time())),))
+                conn.commit()
+            logger.info("Search index backfilled with %s messages", len(rows))
+        except Exception as e:
+            logger.error("Search index backfill failed: %s", e)
+            self.available = False
+
+    def search(self, query: str, limit: int = SEARCH_RESULTS):
+        """Диалоги по запросу: [{"user_id", "snippet", "matches", "ts"}], лучшие первыми."""
+        terms = SEARCH_TOKEN_RE.findall(query.lower())
+        if not terms:
+            return []
+        match = " ".join('"' + t.replace('"', '') + '"*' for t in terms)
+        with self._lock:
+            rows = self._connect().execute(
+                "SELECT user_id, snippet(messages, 0, char(2), char(3), '…', 12), ts "
+                "FROM messages WHERE messages MATCH ? ORDER BY bm25(messages) LIMIT 500",
+                (match,)).fetchall()
+        results = OrderedDict()
+        for user_id, snippet, ts in rows:
+            hit = results.get(user_id)
+            if hit is None:
+                if len(results) >= limit:
+                    continue
+                results[user_id] = {"user_id": user_id, "snippet": snippet, "matches": 1, "ts": ts}
+            else:
+                hit["matches"] += 1
+        return list(results.values())
+
+
+search_index = SearchIndex(SEARCH_DB)
+
+
+@router.command('search')
+@update_handler
+def handle_search(message):
+    """Поиск по перепискам: /search QUERY."""
+    query = message.text.partition(' ')[2].strip()
+    if not query:
+        bot.reply_to(message, "Использование: /search QUERY\nПример: /search не подключается айфон")
+        return
+    if not search_index.available:
+        bot.reply_to(message, "Поисковый индекс недоступен.")
+        return
+
+    started = time.perf_counter()
+    try:
+        results = search_index.search(query)
+    except Exception as e:
+        logger.error("Error in /search: %s", e)
+        bot.reply_to(message, f"⚠️ Ошибка поиска: {e}")
+        return
+    elapsed_ms = (time.perf_counter() - started) * 1000
+
+    if not results:
+        bot.reply_to(message, f"Ничего не найдено ({elapsed_ms:.0f} мс).")
+        return
+
+    lines = [f"🔎 <b>{html.escape(query)}</b> — {len(results)} диалогов ({elapsed_ms:.0f} мс)\n"]
+    markup = types.InlineKeyboardMarkup()
+    for i, hit in enumerate(results, 1):
+        user_id = hit["user_id"]
+        username = user_data_cache.get(user_id, f"id{user_id}")
+        when = datetime.fromtimestamp(hit["ts"]).strftime("%d.%m.%Y") if hit["ts"] else "—"
+        snippet = html.escape(hit["snippet"]).replace("\x02", "<b>").replace("\x03", "</b>")
+        line = f"{i}. @{username} (<code>{user_id}</code>) · {when} · совпадений: {hit['matches']}\n<i>{snippet}</i>"
+        if sum(len(x) + 1 for x in lines) + len(line) > 4000:
+            break
+        lines.append(line)
+        markup.add(types.InlineKeyboardButton(text=f"{i}. @{username}", callback_data=f"peek_{user_id}"))
+
+    bot.send_message(message.chat.id, "\n".join(lines), reply_markup=markup, parse_mode="HTML")
+
+
+# ===== ЭКСПОРТ ПЕРЕПИСОК =====
+
+EXPORT_PAGE_SIZE = 200
+EXPORT_PROGRESS_SECONDS = 5
+EXPORT_MAX_BYTES = 49 * 1024 * 1024  # лимит Bot API на отправку файла — 50 МБ
+DATE_ARG_RE = re.compile(r"^\d{4}-\d{2}-\d{2}$")
+_exports_running = set()  # admin chat_id с запущенным экспортом
+
+
+def iter_admin_chats():
+    """Постранично обходит /admin/chats (limit/offset), отдаёт диалоги по одному."""
+    offset = 0
+    while True:
+        resp = http_get(f"{SUPPORT_API_URL}/admin/chats",
+                        params={"limit": EXPORT_PAGE_SIZE, "offset": offset},
+                        headers=admin_headers(), timeout=30)
+        if resp.status_code != 200:
+            raise RuntimeError(f"/admin/chats: {resp.status_code}")
+        data = resp.json()
+        rows = data.get("chats", []) if isinstance(data, dict) else data
+        yield from rows
+        # Старый бэкенд без пагинации отдаёт весь список сразу, на любой offset
+        if isinstance(data, list) or len(rows) < EXPORT_PAGE_SIZE:
+            return
+        offset += len(rows)
+
+
+def iter_chat_messages(user_id: int):
+    """Сообщения одного диалога из /admin/chats/{user_id}."""
+    resp = http_get(f"{SUPPORT_API_URL}/admin/chats/{user_id}", headers=admin_headers(), timeout=30)
+    if resp.status_code != 200:
+        logger.warning("Export: failed to load chat %s: %s", user_id, resp.status_code)
         return
+    yield from resp.json().get("messages", [])
+
+
+def parse_export_args(args):
+    """/export [FROM [TO]] [TG_ID] -> (date_from, date_to, user_id); даты включительно."""
+    dates = [datetime.strptime(a, "%Y-%m-%d") for a in args if DATE_ARG_RE.match(a)]
+    ids = [int(a) for a in args if a.lstrip('-').isdigit() and not DATE_ARG_RE.match(a)]
+    if len(dates) + len(ids) != len(args) or len(dates) > 2 or len(ids) > 1:
+        raise ValueError("неверные аргументы")
+    date_from = dates[0] if dates else None
+    date_to = dates[1] + timedelta(days=1) if len(dates) > 1 else None
+    return date_from, date_to, (ids[0] if ids else None)
+
+
+def run_export(chat_id: int, status_message_id: int, date_from, date_to, user_id):
+    """Выгружает переписки в gzip JSONL потоково и отправляет файлом."""
+    chats = 0
+    written = 0
+    last_progress = time.monotonic()
+    fd, path = tempfile.mkstemp(suffix=".jsonl.gz")
+    os.close(fd)
+    try:
+        if user_id:
+            targets = iter([{"telegram_id": user_id, "username": user_data_cache.get(user_id, "")}])
+        else:
+            targets = iter_admin_chats()
+
+        with gzip.open(path, "wt", encoding="utf-8") as out:
+            for chat in targets:
+                tg_id = chat.get("telegram_id")
+                last_time = parse_chat_time(chat.get("last_time") or "")
+                if date_from and last_time and last_time < date_from:
+                    continue
+                chats += 1
+                for m in iter_chat_messages(tg_id):
+                    created = parse_chat_time(str(m.get("created_at") or ""))
+                    if created and ((date_from and created < date_from) or (date_to and created >= date_to)):
+                        continue
+                    out.write(json.dumps({
+                        "telegram_id": tg_id,
+                        "username": chat.get("username"),
+                        "role": m.get("role"),
+                        "content": m.get("content", m.get("text")),
+                        "created_at": m.get("created_at"),
+                    }, ensure_ascii=False) + "\n")
+                    written += 1
+
+                if time.monotonic() - last_progress >= EXPORT_PROGRESS_SECONDS:
+                    last_progress = time.monotonic()
+                    try:
+                        bot.edit_message_text(f"⏳ Экспорт: {chats} диалогов, {written} сообщений...",
+                                              chat_id, status_message_id)
+                    except Exception:
+                        pass
+
+        size = os.path.getsize(path)
+        summary = f"✅ Экспорт готов: {chats} диалогов, {written} сообщений, {format_bytes(size)}"
+        if size > EXPORT_MAX_BYTES:
+            bot.edit_message_text(summary + "\n❌ Файл больше 50 МБ — сузьте период или выберите юзера.",
+                                  chat_id, status_message_id)
+            return
+        bot.edit_message_text(summary, chat_id, status_message_id)
+        name = f"chats_{datetime.now().strftime('%Y%m%d_%H%M')}.jsonl.gz"
+        with open(path, "rb") as f:
+            bot.send_document(chat_id, f, visible_file_name=name)
+        logger.info("Export done for admin chat %s: %s chats, %s messages, %s bytes", chat_id, chats, written, size)
+    except Exception as e:
+        logger.error("Export failed: %s", e)
+        try:
+            bot.edit_message_text(f"❌ Экспорт прервался: {e}", chat_id, status_message_id)
+        except Exception:
+            pass
+    finally:
+        _exports_running.discard(chat_id)
+        try:
+            os.unlink(path)
+        except Exception:
+            pass
+
+
+@router.command('export')
+@update_handler
+def handle_export(message):
+    """Экспорт переписок: /export [FROM [TO]] [TG_ID], даты в формате YYYY-MM-DD."""
+    try:
+        date_from, date_to, user_id = parse_export_args(message.text.split()[1:])
+    except ValueError:
+        bot.reply_to(message,
+                     "Использование: /export [FROM [TO]] [TG_ID]\n"
+                     "Примеры:\n"
+                     "  /export — все переписки\n"
+                     "  /export 2024-05-01 2024-05-31 — за период\n"
+                     "  /export 123456789 — один юзер")
+        return
+
+    if message.chat.id in _exports_running:
+        bot.reply_to(message, "Экспорт уже выполняется.")
+        return
+    _exports_running.add(message.chat.id)
+
+    logger.info("Admin %s started export: from=%s to=%s user=%s", message.from_user.id, date_from, date_to, user_id)
+    started = False
+    try:
+        status = bot.reply_to(message, "⏳ Экспорт запущен...")
+        threading.Thread(target=run_export, args=(message.chat.id, status.message_id, date_from, date_to, user_id),
+                         daemon=True, name="export").start()
+        started = True
+    finally:
+        # Дальше флаг снимает run_export; если не дошли до него — снимаем здесь
+        if not started:
+            _exports_running.discard(message.chat.id)
+
+
+# ===== ТИКЕТЫ =====
+
+def render_tickets_page(page: int = 0):
+    """Текст и клавиатура страницы очереди тикетов (сначала ближайший дедлайн SLA)."""
+    total = len(ticket_queue)
+    pages = max((total + TICKETS_PAGE_SIZE - 1) // TICKETS_PAGE_SIZE, 1)
+    page = min(max(page, 0), pages - 1)
+    now = time.time()
+    breached = ticket_queue.breached(now)
 
     markup = types.InlineKeyboardMarkup()
-    for user_id in active_tickets:
+    for user_id, entry, deadline in ticket_queue.page(page):
         username = user_data_cache.get(user_id, f"id{user_id}")
+        if entry["answered"]:
+            status = "✉️"
+        elif deadline <= now:
+            status = "🔥"
+        else:
+            status = "⏳"
+        waited = format_time_ago(datetime.fromtimestamp(entry["waiting_since"]))
         markup.add(types.InlineKeyboardButton(
-            text=f"@{username} (ID: {user_id})",
+            text=f"{status} @{username} · {waited}",
             callback_data=f"view_ticket_{user_id}",
         ))
 
-    bot.send_message(message.chat.id, "🎫 Активные тикеты:", reply_markup=markup)
+    nav = []
+    if page > 0:
+        nav.append(types.InlineKeyboardButton(text="◀️", callback_data=f"tickets_page_{page - 1}"))
+    nav.append(types.InlineKeyboardButton(text="▶️ Следующий", callback_data="next_ticket"))
+    if page < pages - 1:
+        nav.append(types.InlineKeyboardButton(text="▶️", callback_data=f"tickets_page_{page + 1}"))
+    markup.row(*nav)
+
+    text = f"🎫 <b>Активные тикеты:</b> {total} (стр. {page + 1}/{pages})"
+    if breached:
+        text += f"\n🔥 Просрочен SLA: {len(breached)}"
+    text += "\n\n🔥 просрочен · ⏳ ждёт ответа · ✉️ отвечен"
+    return text, markup
+
+
+@router.command('reply')
+@update_handler
+def show_active_tickets(message):
+    logger.info("Admin %s requested /reply", message.from_user.id)
+    if not active_tickets:
+        bot.reply_to(message, "Нет активных тикетов.")
+        return
+
+    text, markup = render_tickets_page(0)
+    bot.send_message(message.chat.id, text, reply_markup=markup, parse_mode="HTML")
+
+
+@router.command('next')
+@update_handler
+def handle_next_ticket(message):
+    """Открывает тикет с ближайшим дедлайном SLA."""
+    user_id = ticket_queue.next()
+    if user_id is None:
+        bot.reply_to(message, "Нет активных тикетов.")
+        return
+    logger.info("Admin %s took next ticket: %s", message.from_user.id, user_id)
+    open_ticket_conversation(message.chat.id, user_id)
 
 
 # ===== ОБРАБОТКА СООБЩЕНИЙ ПОЛЬЗОВАТЕЛЕЙ =====
 
-@bot.message_handler(func=lambda message: message.from_user.id not in ADMIN_IDS,
-                     content_types=['text'])
+def forward_to_admins(message, user_id: int, username: str, preview: str):
+    """Сообщение юзера в открытом тикете: копия в тему тикета, иначе forward каждому админу или в сводку."""
+    topic = ticket_topics.ensure(user_id, username) if ADMIN_GROUP_ID else None
+    if topic:
+        try:
+            bot.copy_message(ADMIN_GROUP_ID, message.chat.id, message.message_id, message_thread_id=topic)
+        except Exception as e:
+            logger.error("Error copying to topic %s: %s", topic, e, extra={"rate_key": "forward_to_admin"})
+        return
+    if admin_digest.absorb("message", user_id, username, preview):
+        return
+    for admin_id in ADMIN_IDS:
+        try:
+            bot.forward_message(admin_id, message.chat.id, message.message_id)
+        except Exception as e:
+            logger.error("Error forwarding to admin %s: %s", admin_id, e, extra={"rate_key": "forward_to_admin"})
+
+
+@router.message(['text'])
+@update_handler
 def handle_user_text_message(message):
     user_id = message.from_user.id
     username = message.from_user.username or f"id{user_id}"
     user_data_cache[user_id] = username
 
-    logger.info(f"User @{username} ({user_id}) sent text: {message.text[:50]}...")
+    logger.info("User @%s (%s) sent text: %s...", username, user_id, message.text[:50])
+    admitted = admission.allow(user_id)
 
     # Sync tickets from DB (catches tickets opened from web admin)
-    sync_active_tickets()
+    if admitted:
+        sync_active_tickets()
 
     # Сохраняем сообщение юзера для пересылки в тикете
     user_conversation[user_id].append((message.chat.id, message.message_id))
-    chat_log[user_id].append({"role": "user", "text": message.text, "time": datetime.now().strftime("%H:%M")})
+    append_chat_log(user_id, "user", message.text)
     user_last_activity[user_id] = datetime.now()
-    save_state()
+    if admitted:
+        save_state()
 
     # Сохраняем сообщение пользователя в БД (для веб-админки)
-    try:
-        requests.post(f"{SUPPORT_API_URL}/admin/chats/{user_id}/save",
-                      json={"role": "user", "content": message.text}, headers=admin_headers(), timeout=5)
-    except Exception:
-        pass
+    save_chat_message(user_id, "user", message.text)
 
-    # If ticket is open, forward to admin and remind user to wait
+    # If ticket is open, forward to admin and remind user to wait.
+    # Лимит не мешает пересылке — оператор должен видеть все сообщения тикета
     if user_id in active_tickets:
-        for admin_id in ADMIN_IDS:
-            try:
-                bot.forward_message(admin_id, message.chat.id, message.message_id)
-            except Exception as e:
-                logger.error(f"Error forwarding to admin {admin_id}: {e}")
-        bot.send_message(message.chat.id, "⏳ Ваш вопрос уже у оператора. Пожалуйста, ожидайте ответа.")
+        ticket_queue.touch_user(user_id)
+        forward_to_admins(message, user_id, username, message.text)
+        if admitted:
+            bot.send_message(message.chat.id, "⏳ Ваш вопрос уже у оператора. Пожалуйста, ожидайте ответа.")
+        else:
+            shed_user_message(message.chat.id, user_id, "rate_limited")
+        return
+
+    if not admitted:
+        shed_user_message(message.chat.id, user_id, "rate_limited")
         return
 
     # Проверяем, просит ли пользователь оператора напрямую
@@ -1334,176 +4766,364 @@ def handle_user_text_message(message):
     process_ai_response(message.chat.id, user_id, message.text)
 
 
-@bot.message_handler(func=lambda message: message.from_user.id not in ADMIN_IDS,
-                     content_types=['voice'])
+@router.message(['voice'])
+@update_handler
 def handle_user_voice_message(message):
     """Обработка голосовых сообщений: транскрибируем и отправляем в AI."""
     user_id = message.from_user.id
     username = message.from_user.username or f"id{user_id}"
     user_data_cache[user_id] = username
 
-    logger.info(f"User @{username} ({user_id}) sent voice message")
+    logger.info("User @%s (%s) sent voice message", username, user_id)
 
     # Сохраняем голосовое для пересылки в тикете
     user_conversation[user_id].append((message.chat.id, message.message_id))
-    save_state()
+    admitted = admission.allow(user_id)
+    if admitted:
+        save_state()
 
-    # If ticket is open, forward to admin and remind user to wait
+    # If ticket is open, forward to admin and remind user to wait (даже сверх лимита)
     if user_id in active_tickets:
-        for admin_id in ADMIN_IDS:
-            try:
-                bot.forward_message(admin_id, message.chat.id, message.message_id)
-            except Exception as e:
-                logger.error(f"Error forwarding to admin {admin_id}: {e}")
-        bot.send_message(message.chat.id, "⏳ Ваш вопрос уже у оператора. Пожалуйста, ожидайте ответа.")
+        ticket_queue.touch_user(user_id)
+        forward_to_admins(message, user_id, username, "🎤 голосовое")
+        if admitted:
+            bot.send_message(message.chat.id, "⏳ Ваш вопрос уже у оператора. Пожалуйста, ожидайте ответа.")
+        else:
+            shed_user_message(message.chat.id, user_id, "rate_limited")
         return
 
-    bot.send_chat_action(message.chat.id, 'typing')
+    if not admitted:
+        shed_user_message(message.chat.id, user_id, "rate_limited")
+        return
 
     try:
-        # Скачиваем голосовое сообщение
-        file_info = bot.get_file(message.voice.file_id)
-        downloaded = bot.download_file(file_info.file_path)
-
-        with tempfile.NamedTemporaryFile(suffix='.ogg', delete=False) as tmp:
-            tmp.write(downloaded)
-            tmp_path = tmp.name
+        escalate = False
+        # "печатает…" — пока качаем, распознаём и ждём ИИ; эскалация уже без него
+        with chat_actions.keep(message.chat.id, 'typing'):
+            # Скачиваем голосовое сообщение
+            file_info = bot.get_file(message.voice.file_id)
+            downloaded = bot.download_file(file_info.file_path)
 
-        # Транскрибируем
-        transcription = transcribe_voice(tmp_path)
+            with tempfile.NamedTemporaryFile(suffix='.ogg', delete=False) as tmp:
+                tmp.write(downloaded)
+                tmp_path = tmp.name
 
-        # Удаляем временный файл
-        try:
-            os.unlink(tmp_path)
-        except Exception:
-            pass
+            # Транскрибируем
+            transcription = transcribe_voice(tmp_path)
 
-        if transcription:
-            logger.info(f"Voice transcribed for {user_id}: {transcription[:50]}...")
+            # Удаляем временный файл
+            try:
+                os.unlink(tmp_path)
+            except Exception:
+                pass
 
-            # Проверяем эскалацию
-            if check_user_wants_escalation(transcription):
-                handle_escalation(message.chat.id, user_id, reason="Пользователь попросил оператора (голосовое)")
-                return
+            if transcription:
+                logger.info("Voice transcribed for %s: %s...", user_id, transcription[:50])
+                escalate = check_user_wants_escalation(transcription)
+                if not escalate:
+                    # Отправляем транскрипцию в AI
+                    process_ai_response(message.chat.id, user_id, transcription)
 
-            # Отправляем транскрипцию в AI
-            process_ai_response(message.chat.id, user_id, transcription)
-        else:
+        if escalate:
+            handle_escalation(message.chat.id, user_id, reason="Пользователь попросил оператора (голосовое)")
+        elif not transcription:
             bot.send_message(
                 message.chat.id,
                 "Не удалось распознать голосовое сообщение. Пожалуйста, напишите текстом."
             )
 
     except Exception as e:
-        logger.error(f"Voice processing error for {user_id}: {e}")
+        logger.error("Voice processing error for %s: %s", user_id, e)
         bot.send_message(
             message.chat.id,
             "Не удалось обработать голосовое сообщение. Пожалуйста, напишите текстом."
         )
 
 
-@bot.message_handler(func=lambda message: message.from_user.id not in ADMIN_IDS,
-                     content_types=['photo', 'document', 'audio', 'video', 'sticker'])
+@router.message(['photo', 'document', 'audio', 'video', 'sticker'])
+@update_handler
 def handle_user_media_message(message):
-    user_id = message.from_user.id
-    username = message.from_user.username or f"id{user_id}"
+    # Альбом приходит отдельными сообщениями — собираем и обрабатываем разом
+    if message.media_group_id:
+        media_groups.add(message)
+        return
+    process_user_media([message])
+
+
+MEDIA_GROUP_WINDOW = 1.5  # сек тишины, после которых альбом считается полным
+
+
+class MediaGroupBuffer:
+    """Собирает сообщения одного media_group_id и отдаёт их пачкой после паузы."""
+
+    def __init__(self, window: float, on_flush):
+        self._lock = threading.Lock()
+        self._window = window
+        self._on_flush = on_flush
+        self._groups = {}  # media_group_id -> {"messages": [...], "timer": Timer}
+
+    def add(self, message):
+        group_id = message.media_group_id
+        with self._lock:
+            group = self._groups.setdefault(group_id, {"messages": [], "timer": None})
+            group["messages"].append(message)
+            # До _flush альбом не обработан — после рестарта Telegram должен доставить его снова
+            update_tracker.hold(update_key(message))
+            if group["timer"]:
+                group["timer"].cancel()
+            timer = threading.Timer(self._window, self._flush, args=(group_id,))
+            timer.daemon = True
+            group["timer"] = timer
+        timer.start()
+
+    def _flush(self, group_id):
+        with self._lock:
+            group = self._groups.pop(group_id, None)
+        if not group:
+            return
+        messages = sorted(group["messages"], key=lambda m: m.message_id)
+        first = messages[0]
+        # Таймер живёт вне хендлера — открываем контекст апдейта вручную
+        update_context.key = update_key(first)
+        update_context.user_id = first.from_user.id
+        tracer.start("media_group", first.from_user.id)
+        try:
+            self._on_flush(messages)
+        except Exception as e:
+            logger.error("Error processing media group %s: %s", group_id, e)
+        finally:
+            tracer.finish()
+            update_context.key = None
+            update_context.user_id = None
+            update_tracker.release([update_key(m) for m in messages])
+
+
+def media_record_text(message) -> str:
+    """Текст для лога: маркер медиа ([photo:...] / [file:...]) или тип сообщения."""
+    if message.content_type == 'photo' and message.photo:
+        return f"[photo:{message.photo[-1].file_id}]"  # Largest photo
+    if message.content_type == 'document' and message.document:
+        return f"[file:{message.document.file_id}:{message.document.file_name or 'file'}]"
+    return f"[{message.content_type}]"
+
+
+def input_media_for(message, caption=None):
+    """InputMedia для пересылки элемента альбома через send_media_group."""
+    if message.content_type == 'photo':
+        return types.InputMediaPhoto(message.photo[-1].file_id, caption=caption)
+    if message.content_type == 'video':
+        return types.InputMediaVideo(message.video.file_id, caption=caption)
+    if message.content_type == 'audio':
+        return types.InputMediaAudio(message.audio.file_id, caption=caption)
+    if message.content_type == 'document':
+        return types.InputMediaDocument(message.document.file_id, caption=caption)
+    return None
+
+
+def forward_media_to_admins(messages, user_id: int, username: str):
+    """Пересылает медиа админам: одиночное — forward, альбом — одним send_media_group."""
+    first = messages[0]
+    captions = [m.caption for m in messages if m.caption]
+    media = []
+    if len(messages) > 1:
+        header = f"📎 Альбом от @{username} (ID: {user_id})"
+        caption = header + (f"\n{captions[0]}" if captions else "")
+        media = [input_media_for(m, caption if i == 0 else None) for i, m in enumerate(messages)]
+        media = [item for item in media if item is not None]
+
+    topic = ticket_topics.ensure(user_id, username) if ADMIN_GROUP_ID else None
+    if topic:
+        try:
+            if media:
+                bot.send_media_group(ADMIN_GROUP_ID, media, message_thread_id=topic)
+            else:
+                bot.copy_message(ADMIN_GROUP_ID, first.chat.id, first.message_id, message_thread_id=topic)
+        except Exception as e:
+            logger.error("Error copying media to topic %s: %s", topic, e, extra={"rate_key": "forward_to_admin"})
+        return
+
+    if captions:
+        preview = captions[0]
+    else:
+        preview = f"[альбом: {len(messages)}]" if len(messages) > 1 else f"[{first.content_type}]"
+    if admin_digest.absorb("message", user_id, username, preview):
+        return
+
+    for admin_id in ADMIN_IDS:
+        try:
+            if media:
+                for sent in bot.send_media_group(admin_id, media):
+                    ticket_message_to_user[sent.message_id] = user_id
+            else:
+                bot.forward_message(admin_id, first.chat.id, first.message_id)
+        except Exception as e:
+            logger.error("Error forwarding to admin %s: %s", admin_id, e, extra={"rate_key": "forward_to_admin"})
+
+
+def process_user_media(messages):
+    """Обрабатывает одно медиа или целый альбом как одно обращение."""
+    first = messages[0]
+    chat_id = first.chat.id
+    user_id = first.from_user.id
+    username = first.from_user.username or f"id{user_id}"
     user_data_cache[user_id] = username
 
-    logger.info(f"User @{username} ({user_id}) sent {message.content_type}")
+    if len(messages) > 1:
+        logger.info("User @%s (%s) sent album of %s items", username, user_id, len(messages))
+    else:
+        logger.info("User @%s (%s) sent %s", username, user_id, first.content_type)
 
-    # Сохраняем сообщение для пересылки в тикете
-    user_conversation[user_id].append((message.chat.id, message.message_id))
+    # Сохраняем сообщения для пересылки в тикете
+    for message in messages:
+        user_conversation[user_id].append((chat_id, message.message_id))
 
-    # Save photo file_id for later display
-    if message.content_type == 'photo' and message.photo:
-        file_id = message.photo[-1].file_id  # Largest photo
-        media_text = f"[photo:{file_id}]"
-        if message.caption:
-            media_text += f" {message.caption}"
-    elif message.content_type == 'document' and message.document:
-        media_text = f"[file:{message.document.file_id}:{message.document.file_name or 'file'}]"
+    # Одна запись на всё обращение: маркеры медиа (для фото — file_id) + подпись
+    caption = next((m.caption for m in messages if m.caption), None)
+    markers = [media_record_text(m) for m in messages]
+    if len(markers) > 1 or markers[0].startswith(("[photo:", "[file:")):
+        media_text = " ".join(markers) + (f" {caption}" if caption else "")
     else:
-        media_text = message.caption or f"[{message.content_type}]"
+        media_text = caption or markers[0]
 
-    chat_log[user_id].append({"role": "user", "text": media_text, "time": datetime.now().strftime("%H:%M")})
+    admitted = admission.allow(user_id)
+    append_chat_log(user_id, "user", media_text)
     user_last_activity[user_id] = datetime.now()
-    save_state()
+    if admitted:
+        save_state()
 
     # Save media message to DB via admin reply endpoint (as user role)
-    try:
-        requests.post(f"{SUPPORT_API_URL}/admin/chats/{user_id}/save",
-                      json={"role": "user", "content": media_text}, headers=admin_headers(), timeout=5)
-    except Exception:
-        pass
+    save_chat_message(user_id, "user", media_text)
 
-    # If ticket is open, forward to admin and remind user to wait
+    # If ticket is open, forward to admin and remind user to wait (даже сверх лимита)
     if user_id in active_tickets:
-        for admin_id in ADMIN_IDS:
-            try:
-                bot.forward_message(admin_id, message.chat.id, message.message_id)
-            except Exception as e:
-                logger.error(f"Error forwarding to admin {admin_id}: {e}")
-        bot.send_message(message.chat.id, "⏳ Ваш вопрос уже у оператора. Пожалуйста, ожидайте ответа.")
+        ticket_queue.touch_user(user_id)
+        forward_media_to_admins(messages, user_id, username)
+        if admitted:
+            bot.send_message(chat_id, "⏳ Ваш вопрос уже у оператора. Пожалуйста, ожидайте ответа.")
+        else:
+            shed_user_message(chat_id, user_id, "rate_limited")
+        return
+
+    if not admitted:
+        shed_user_message(chat_id, user_id, "rate_limited")
         return
 
     # Фото с подписью — отправляем только подпись в AI
-    if message.caption:
-        process_ai_response(message.chat.id, user_id, message.caption)
+    if caption:
+        process_ai_response(chat_id, user_id, caption)
         return
 
     bot.send_message(
-        message.chat.id,
+        chat_id,
         "Опишите проблему текстом — ИИ-ассистент сможет помочь быстрее 😊"
     )
 
 
+media_groups = MediaGroupBuffer(MEDIA_GROUP_WINDOW, process_user_media)
+
+
 # ===== CALLBACKS =====
 
 @bot.callback_query_handler(func=lambda call: True)
+@update_handler
 def callback_handler(call):
-    if call.data == 'peek_done':
-        bot.answer_callback_query(call.id, text="👍")
-        try:
-            bot.delete_message(call.message.chat.id, call.message.message_id)
-        except Exception:
-            pass
+    router.dispatch_callback(call)
+
+
+@router.callback('peek_done')
+def cb_peek_done(call):
+    bot.answer_callback_query(call.id, text="👍")
+    try:
+        bot.delete_message(call.message.chat.id, call.message.message_id)
+    except Exception:
+        pass
+
+
+@router.callback('peek_page_', int, int)
+def cb_peek_page(call, user_id, end):
+    bot.answer_callback_query(call.id, text="Загружаю переписку...")
+    peek_conversation(call.message.chat.id, user_id, end, topic_thread(call.message))
+
+
+@router.callback('peek_', int)
+def cb_peek(call, user_id):
+    bot.answer_callback_query(call.id, text="Загружаю переписку...")
+    peek_conversation(call.message.chat.id, user_id, thread_id=topic_thread(call.message))
+
+
+@router.callback('open_ticket_', int)
+def cb_open_ticket(call, user_id):
+    bot.answer_callback_query(call.id, text="Загружаю переписку...")
+    open_ticket_conversation(call.message.chat.id, user_id, topic_thread(call.message))
+
+
+@router.callback('view_ticket_', int)
+def cb_view_ticket(call, user_id):
+    bot.answer_callback_query(call.id, text="Загружаю...")
+    open_ticket_conversation(call.message.chat.id, user_id)
+
+
+@router.callback('chats_', str, int)
+def cb_chats_page(call, flt, offset):
+    bot.answer_callback_query(call.id)
+    try:
+        text, markup = render_chats_page(flt if flt in CHAT_FILTERS else "all", offset)
+    except Exception as e:
+        logger.error("Failed to load chats from DB: %s", e)
+        text = None
+    if text is None:
+        bot.send_message(call.message.chat.id, "Ошибка загрузки чатов.")
         return
-    elif call.data.startswith('peek_'):
-        try:
-            user_id = int(call.data.split('_')[-1])
-        except ValueError:
-            bot.answer_callback_query(call.id, text="Ошибка")
-            return
-        bot.answer_callback_query(call.id, text="Загружаю переписку...")
-        peek_conversation(call.message.chat.id, user_id)
-    elif call.data.startswith('open_ticket_'):
-        user_id = int(call.data.split('_')[-1])
-        bot.answer_callback_query(call.id, text="Загружаю переписку...")
-        open_ticket_conversation(call.message.chat.id, user_id)
-    elif call.data.startswith('view_ticket_'):
-        user_id = int(call.data.split('_')[-1])
-        bot.answer_callback_query(call.id, text="Загружаю...")
-        open_ticket_conversation(call.message.chat.id, user_id)
-    elif call.data.startswith('reply_to_'):
-        user_id = int(call.data.split('_')[-1])
-        bot.answer_callback_query(call.id, text="Ответьте на это сообщение")
-        # Create a reply anchor so admin can reply
-        if user_id not in active_tickets:
-            db_open_ticket(user_id, user_data_cache.get(user_id, str(user_id)), "reply_to")
-            save_state()
-        sent = bot.send_message(
-            call.message.chat.id,
-            f"✍️ <b>Ответьте (reply) на это сообщение, чтобы написать @{user_data_cache.get(user_id, str(user_id))}:</b>",
-            parse_mode="HTML"
-        )
-        ticket_message_to_user[sent.message_id] = user_id
-    elif call.data.startswith('close_ticket_'):
-        user_id = int(call.data.split('_')[-1])
-        close_ticket(call.message.chat.id, user_id)
-        bot.answer_callback_query(call.id, text="Тикет закрыт")
+    try:
+        bot.edit_message_text(text, call.message.chat.id, call.message.message_id,
+                              reply_markup=markup, parse_mode="HTML")
+    except Exception as e:
+        logger.error("Error editing chats page: %s", e)
+
+
+@router.callback('tickets_page_', int)
+def cb_tickets_page(call, page):
+    bot.answer_callback_query(call.id)
+    text, markup = render_tickets_page(page)
+    try:
+        bot.edit_message_text(text, call.message.chat.id, call.message.message_id,
+                              reply_markup=markup, parse_mode="HTML")
+    except Exception as e:
+        logger.error("Error editing tickets page: %s", e)
+
+
+@router.callback('next_ticket')
+def cb_next_ticket(call):
+    user_id = ticket_queue.next()
+    if user_id is None:
+        bot.answer_callback_query(call.id, text="Нет активных тикетов")
+        return
+    bot.answer_callback_query(call.id, text="Загружаю...")
+    open_ticket_conversation(call.message.chat.id, user_id)
+
 
+@router.callback('reply_to_', int)
+def cb_reply_to(call, user_id):
+    bot.answer_callback_query(call.id, text="Ответьте на это сообщение")
+    # Create a reply anchor so admin can reply
+    if user_id not in active_tickets:
+        db_open_ticket(user_id, user_data_cache.get(user_id, str(user_id)), "reply_to")
+        support_stats.ticket_opened(user_id, "reply_to")
+        save_state()
+    sent = bot.send_message(
+        call.message.chat.id,
+        f"✍️ <b>Ответьте (reply) на это сообщение, чтобы написать @{user_data_cache.get(user_id, str(user_id))}:</b>",
+        parse_mode="HTML",
+        message_thread_id=topic_thread(call.message)
+    )
+    ticket_message_to_user[sent.message_id] = user_id
 
 
+@router.callback('close_ticket_', int)
+def cb_close_ticket(call, user_id):
+    close_ticket(call.message.chat.id, user_id)
+    bot.answer_callback_query(call.id, text="Тикет закрыт")
+
 
 def close_ticket(admin_chat_id, user_id, auto=False):
     if user_id in active_tickets:
@@ -1512,6 +5132,7 @@ def close_ticket(admin_chat_id, user_id, auto=False):
         timer = auto_close_timers.pop(user_id, None)
         if timer:
             timer.cancel()
+        support_stats.ticket_closed(user_id, auto)
         # Set cooldown to prevent instant re-escalation
         recently_closed[user_id] = datetime.now()
         save_state()
@@ -1527,10 +5148,13 @@ def close_ticket(admin_chat_id, user_id, auto=False):
             try:
                 bot.send_message(user_id, "✅ Всего доброго! Если появятся вопросы — обращайтесь, всегда рады помочь! 😊")
             except Exception as e:
-                logger.error(f"Error notifying user {user_id} about ticket close: {e}")
-        logger.info(f"Ticket closed for user {user_id} (auto={auto})")
-        if admin_chat_id:
+                logger.error("Error notifying user %s about ticket close: %s", user_id, e)
+        logger.info("Ticket closed for user %s (auto=%s)", user_id, auto)
+        # Закрыли кнопкой из темы — закрытая тема и есть подтверждение
+        if admin_chat_id and admin_chat_id != ADMIN_GROUP_ID:
             bot.send_message(admin_chat_id, f"✅ Тикет для {user_id} закрыт{' (автоматически)' if auto else ''}.")
+        if ADMIN_GROUP_ID:
+            ticket_topics.close(user_id)
     else:
         if admin_chat_id:
             bot.send_message(admin_chat_id, "Тикет уже закрыт или не существует.")
@@ -1538,9 +5162,8 @@ def close_ticket(admin_chat_id, user_id, auto=False):
 
 # ===== ОТВЕТ АДМИНА =====
 
-@bot.message_handler(func=lambda message: message.reply_to_message is not None and
-                                          message.from_user.id in ADMIN_IDS,
-                     content_types=['text', 'photo', 'document', 'audio', 'video', 'voice', 'sticker'])
+@router.message(['text', 'photo', 'document', 'audio', 'video', 'voice', 'sticker'], role="admin", reply=True)
+@update_handler
 def handle_admin_reply(message):
     """Админ отвечает на тикет — reply на сообщение тикета."""
     replied_msg_id = message.reply_to_message.message_id
@@ -1564,7 +5187,31 @@ def handle_admin_reply(message):
 
     if not user_id:
         return  # Не тикетное сообщение — игнорируем
+    send_admin_reply(message, user_id)
+
+
+@router.group_message(['text', 'photo', 'document', 'audio', 'video', 'voice', 'sticker'])
+@update_handler
+def handle_topic_message(message):
+    """Сообщение админа в теме тикета (ADMIN_GROUP_ID) — уходит юзеру этой темы.
 
+    Об успехе в тему не пишем — одна отправка на событие; ошибка — reply.
+    В закрытой теме (тикет закрыт) юзеру ничего не уходит.
+    """
+    if not message.is_topic_message:
+        return  # General и прочие сообщения группы
+    user_id = ticket_topics.user_for(message.message_thread_id)
+    if not user_id:
+        return
+    if user_id not in active_tickets or not ticket_topics.is_open(user_id):
+        bot.reply_to(message, "❌ Тикет закрыт — ответ не отправлен.")
+        return
+    send_admin_reply(message, user_id, confirm=False)
+
+
+def send_admin_reply(message, user_id: int, confirm: bool = True):
+    """Отправляет ответ админа юзеру, пишет его в лог и продлевает тикет."""
+    tracer.add_user(user_id)
     username = user_data_cache.get(user_id, f"id{user_id}")
 
     try:
@@ -1587,23 +5234,22 @@ def handle_admin_reply(message):
 
         # Record admin reply in chat log and DB (do NOT call AI — ticket is active)
         if message.content_type == 'text':
-            chat_log[user_id].append({"role": "admin", "text": message.text, "time": datetime.now().strftime("%H:%M")})
-            try:
-                requests.post(f"{SUPPORT_API_URL}/admin/chats/{user_id}/save",
-                              json={"role": "admin", "content": message.text}, headers=admin_headers(), timeout=5)
-            except Exception:
-                pass
+            append_chat_log(user_id, "admin", message.text)
+            save_chat_message(user_id, "admin", message.text)
         else:
-            chat_log[user_id].append({"role": "admin", "text": f"[{message.content_type}]", "time": datetime.now().strftime("%H:%M")})
+            append_chat_log(user_id, "admin", f"[{message.content_type}]")
 
         # Reset auto-close timer on admin activity
         if user_id in active_tickets:
             schedule_auto_close(user_id)
+            ticket_queue.mark_answered(user_id)
+            support_stats.admin_replied(user_id)
 
-        logger.info(f"Admin {message.from_user.id} replied to user {user_id}")
-        bot.reply_to(message, f"✅ Ответ отправлен пользователю @{username}.")
+        logger.info("Admin %s replied to user %s", message.from_user.id, user_id)
+        if confirm:
+            bot.reply_to(message, f"✅ Ответ отправлен пользователю @{username}.")
     except Exception as e:
-        logger.error(f"Error sending reply to user {user_id}: {e}")
+        logger.error("Error sending reply to user %s: %s", user_id, e)
         bot.reply_to(message, f"❌ Ошибка при отправке ответа: {e}")
 
 
@@ -1613,6 +5259,7 @@ if __name__ == '__main__':
     for tid in active_tickets:
         schedule_auto_close(tid)
     if active_tickets:
-        logger.info(f"Scheduled auto-close for {len(active_tickets)} existing tickets")
+        logger.info("Scheduled auto-close for %s existing tickets", len(active_tickets))
+    search_index.backfill(chat_log)
     logger.info("Tech support bot starting...")
     bot.infinity_polling(timeout=60, long_polling_timeout=30)
@@ -0,0 +1,284 @@
+"""
+Replay of recorded production updates through main.py's handlers.
+
+Reads a JSONL file written by UpdateRecorder (RECORD_UPDATES_FILE), starts
+local fake Telegram Bot API and vpn-api servers, points main.py at them and
+feeds the updates through bot.process_new_updates at the recorded pace
+multiplied by --speed, or as fast as possible with --max. Prints per-handler
+latency (from the update traces) and upstream call counts; --json saves the
+same report so two releases can be compared on the same traffic.
+
+Unlike the tests, this needs the real dependencies from requirements.txt.
+
+Run: python3 replay_updates.py updates.jsonl [--speed N | --max] [--workers N]
+                               [--ai-latency SEC] [--json report.json]
+"""
+import argparse
+import json
+import os
+import re
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+ID_IN_PATH_RE = re.compile(r"/-?\d+(?=/|$)")
+
+
+class FakeServer:
+    """HTTP-сервер в фоновом потоке; respond(method, url, body) -> (status, payload, key).
+
+    Вызовы считаются по key — так отчёт группирует их по эндпоинтам.
+    """
+
+    def __init__(self, respond):
+        self.calls = Counter()
+        self._lock = threading.Lock()
+        self._respond = respond
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def _handle(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                body = self.rfile.read(length) if length else b""
+                status, payload, key = server._respond(self.command, urlparse(self.path), body)
+                with server._lock:
+                    server.calls[key] += 1
+                data = payload if isinstance(payload, bytes) else json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/octet-stream" if isinstance(payload, bytes)
+                                 else "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            do_GET = do_POST = do_PATCH = _handle
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.httpd.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.httpd.server_address[1]}"
+        threading.Thread(target=self.httpd.serve_forever, daemon=True, name="fake-server").start()
+
+
+class FakeTelegram:
+    """Bot API: send*/forward/edit возвращают сообщение, getFile — путь, файлы — байты."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._message_id = 1_000_000
+        self.server = FakeServer(self.respond)
+
+    def _message(self, params):
+        with self._lock:
+            self._message_id += 1
+            message_id = self._message_id
+        chat_id = int(params.get("chat_id", 0) or 0)
+        return {"message_id": message_id, "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"},
+                "from": {"id": 1, "is_bot": True, "first_name": "replay"},
+                "text": params.get("text", "")}
+
+    def respond(self, method, url, body):
+        if url.path.startswith("/file/"):
+            return 200, b"OggS replay", "file"
+        name = url.path.rsplit("/", 1)[-1]
+        params = {k: v[0] for k, v in parse_qs(url.query).items()}
+        if name == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "replay", "username": "replay_bot"}
+        elif name == "getFile":
+            result = {"file_id": params.get("file_id", ""), "file_unique_id": "replay",
+                      "file_size": 11, "file_path": "replay/file.ogg"}
+        elif name == "sendMediaGroup":
+            media = json.loads(params.get("media", "[]"))
+            result = [self._message(params) for _ in media]
+        elif name == "copyMessage":
+            result = {"message_id": self._message(params)["message_id"]}
+        elif name.startswith(("send", "forward", "edit")) and name != "sendChatAction":
+            result = self._message(params)
+        else:
+            result = True
+        return 200, {"ok": True, "result": result}, name
+
+
+class FakeVpnApi:
+    """vpn-api: ИИ отвечает с задержкой --ai-latency, тикеты хранятся в памяти."""
+
+    def __init__(self, ai_latency: float):
+        self.ai_latency = ai_latency
+        self._lock = threading.Lock()
+        self.active = set()
+        self.server = FakeServer(self.respond)
+
+    def respond(self, method, url, body):
+        key = f"{method} {ID_IN_PATH_RE.sub('/:id', url.path)}"
+        data = json.loads(body) if body.startswith(b"{") else {}
+        path = url.path
+        if path == "/internal/support/chat":
+            time.sleep(self.ai_latency)
+            return 200, {"response": "Попробуйте обновить подписку в приложении и выбрать другой сервер."}, key
+        if path == "/admin/tickets/active":
+            with self._lock:
+                return 200, [{"telegram_id": uid} for uid in self.active], key
+        if path in ("/admin/tickets/open", "/admin/tickets/close"):
+            with self._lock:
+                (self.active.add if path.endswith("open") else self.active.discard)(data.get("telegram_id"))
+            return 200, {"ok": True}, key
+        if path.startswith("/admin/chats/") and method == "GET":
+            return 200, {"messages": []}, key
+        if path == "/admin/chats":
+            return 200, {"chats": [], "total": 0}, key
+        if path.startswith("/internal/user-email/"):
+            return 200, {"email": "user@example.com"}, key
+        if path.startswith("/users/") and path.endswith("/info"):
+            return 200, {"plan": "base", "is_active": 1, "subscription_end": "2030-01-01T00:00:00Z",
+                         "device_limit": 3, "auto_renew": 1}, key
+        return 200, {}, key
+
+
+def load_recording(path):
+    admins, records = set(), []
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            record = json.loads(line)
+            if "admins" in record:
+                admins.update(record["admins"])
+            else:
+                records.append(record)
+    records.sort(key=lambda r: r["ts"])
+    return admins, records
+
+
+def percentiles(values):
+    if not values:
+        return {"count": 0}
+    ordered = sorted(values)
+
+    def pick(p):
+        return round(ordered[min(int(len(ordered) * p / 100), len(ordered) - 1)], 1)
+
+    return {"count": len(ordered), "p50_ms": pick(50), "p90_ms": pick(90), "p99_ms": pick(99),
+            "max_ms": round(ordered[-1], 1)}
+
+
+def main_replay(args):
+    admins, records = load_recording(args.file)
+    if not records:
+        sys.exit(f"No updates in {args.file}")
+
+    telegram = FakeTelegram()
+    vpn_api = FakeVpnApi(args.ai_latency)
+    workdir = tempfile.mkdtemp(prefix="replay-")
+    os.environ.update({
+        "BOT_TOKEN_SUPPORT": "1:replay",
+        "ADMIN_IDS": ",".join(str(a) for a in sorted(admins)) or "1",
+        "API_URL_SUPPORT": f"{vpn_api.server.url}/users",
+        "SUPPORT_API_URL": vpn_api.server.url,
+        "PROXYAPI_KEY": "",
+        "RECORD_UPDATES_FILE": "",
+        "LOG_LEVEL": os.getenv("LOG_LEVEL", "WARNING"),
+        "STATE_FILE": os.path.join(workdir, "bot_state.json"),
+        "UPDATES_STATE_FILE": os.path.join(workdir, "processed_updates.json"),
+        "STATS_FILE": os.path.join(workdir, "support_stats.json"),
+        "TRACE_FILE": os.path.join(workdir, "traces.jsonl"),
+        "SEARCH_DB": os.path.join(workdir, "search.db"),
+    })
+
+    from telebot import apihelper, types
+    apihelper.API_URL = telegram.server.url + "/bot{0}/{1}"
+    apihelper.FILE_URL = telegram.server.url + "/file/bot{0}/{1}"
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import main
+
+    # Хендлеры выполняем в своём пуле, чтобы мерить апдейт целиком
+    main.bot.threaded = False
+    traces = []
+    main.tracer._export = traces.append
+    # Вызовы при импорте main (синк тикетов и т.п.) в отчёт не идут
+    telegram.server.calls.clear()
+    vpn_api.server.calls.clear()
+
+    latencies, errors = [], Counter()
+    lock = threading.Lock()
+
+    def run(update):
+        started = time.perf_counter()
+        try:
+            main.bot.process_new_updates([update])
+        except Exception as e:
+            with lock:
+                errors[type(e).__name__] += 1
+        with lock:
+            latencies.append((time.perf_counter() - started) * 1000)
+
+    speed = 0 if args.max else args.speed
+    first_ts = records[0]["ts"]
+    t0 = time.monotonic()
+    with ThreadPoolExecutor(max_workers=args.workers) as pool:
+        for record in records:
+            if speed:
+                delay = (record["ts"] - first_ts) / speed - (time.monotonic() - t0)
+                if delay > 0:
+                    time.sleep(delay)
+            pool.submit(run, types.Update.de_json(record["update"]))
+    # Альбомы обрабатываются по таймеру после паузы
+    time.sleep(main.MEDIA_GROUP_WINDOW + 0.5)
+    wall = time.monotonic() - t0
+
+    by_handler = defaultdict(list)
+    for trace in traces:
+        by_handler[trace["handler"]].append(trace["duration_ms"])
+
+    report = {
+        "file": args.file,
+        "updates": len(records),
+        "speed": speed or "max",
+        "wall_seconds": round(wall, 2),
+        "errors": dict(errors),
+        "update_latency": percentiles(latencies),
+        "handlers": {name: percentiles(values) for name, values in sorted(by_handler.items())},
+        "upstream": {
+            "telegram": dict(telegram.server.calls.most_common()),
+            "vpn_api": dict(vpn_api.server.calls.most_common()),
+        },
+        "upstream_per_update": round((sum(telegram.server.calls.values()) + sum(vpn_api.server.calls.values()))
+                                     / len(records), 2),
+    }
+
+    print(f"updates: {report['updates']}  speed: {report['speed']}  wall: {report['wall_seconds']} s  "
+          f"errors: {sum(errors.values())}")
+    lat = report["update_latency"]
+    print(f"update latency ms  p50 {lat['p50_ms']}  p90 {lat['p90_ms']}  p99 {lat['p99_ms']}  max {lat['max_ms']}")
+    print(f"\n{'handler':<32}{'count':>7}{'p50':>9}{'p90':>9}{'p99':>9}{'max':>9}")
+    for name, st in report["handlers"].items():
+        print(f"{name:<32}{st['count']:>7}{st['p50_ms']:>9}{st['p90_ms']:>9}{st['p99_ms']:>9}{st['max_ms']:>9}")
+    for side in ("telegram", "vpn_api"):
+        print(f"\n{side} calls:")
+        for key, n in report["upstream"][side].items():
+            print(f"  {n:>7}  {key}")
+    print(f"\nupstream calls per update: {report['upstream_per_update']}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Replay recorded updates against fake upstreams")
+    parser.add_argument("file", help="JSONL written by RECORD_UPDATES_FILE")
+    parser.add_argument("--speed", type=float, default=1.0, help="multiplier of the recorded pace")
+    parser.add_argument("--max", action="store_true", help="feed updates without pauses")
+    parser.add_argument("--workers", type=int, default=4, help="handler threads (telebot default is 2)")
+    parser.add_argument("--ai-latency", type=float, default=1.0, help="fake AI answer delay, seconds")
+    parser.add_argument("--json", help="also write the report to this file")
+    main_replay(parser.parse_args())
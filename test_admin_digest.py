@@ -0,0 +1,144 @@
+"""
+Tests for the adaptive admin notification digest.
+
+Runs without installing real telebot/requests/dotenv (see tests_support.py).
+
+Run: python3 test_admin_digest.py
+"""
+import time
+import unittest
+import unittest.mock
+from unittest.mock import MagicMock
+
+import tests_support  # noqa: F401  (окружение и заглушки — до импорта main)
+import main
+
+
+def make_message(user_id, text):
+    msg = MagicMock()
+    msg.from_user.id = user_id
+    msg.from_user.username = f"u{user_id}"
+    msg.chat.id = user_id
+    msg.message_id = 1
+    msg.content_type = 'text'
+    msg.text = text
+    msg.media_group_id = None
+    return msg
+
+
+class TestAdminDigest(unittest.TestCase):
+
+    def setUp(self):
+        main.bot.reset_mock()
+        main.bot.send_message.return_value = MagicMock(message_id=500)
+        # Порог 3 уведомления за 0.2 с; фоновый поток спит час — tick() зовём сами
+        self.digest = main.AdminDigest(3, 1, 0.2, 3600)
+
+    def test_real_time_below_threshold(self):
+        self.assertFalse(self.digest.absorb("message", 1, "u1", "привет"))
+        self.assertFalse(self.digest.absorb("message", 2, "u2", "привет"))
+        self.assertFalse(self.digest.active)
+        main.bot.send_message.assert_not_called()
+
+    def test_disabled_with_zero_threshold(self):
+        digest = main.AdminDigest(0, 0, 60, 30)
+        self.assertFalse(any([digest.absorb("message", 1, "u1") for _ in range(100)]))
+
+    def test_switches_to_digest_and_edits_in_place(self):
+        self.digest.absorb("message", 1, "u1", "первое")
+        self.digest.absorb("message", 2, "u2", "второе")
+        self.assertTrue(self.digest.absorb("ticket", 3, "u3", "Пользователь попросил оператора"))
+        self.assertTrue(self.digest.active)
+        # Сводка сразу уходит каждому админу одним сообщением
+        self.assertEqual(main.bot.send_message.call_count, len(main.ADMIN_IDS))
+        text = main.bot.send_message.call_args.args[1]
+        self.assertIn("<b>Новых тикетов:</b> 1", text)
+        self.assertIn("@u3", text)
+
+        self.assertTrue(self.digest.absorb("message", 3, "u3", "<b>тест</b>"))
+        self.assertTrue(self.digest.tick())
+        self.assertEqual(main.bot.send_message.call_count, len(main.ADMIN_IDS))
+        self.assertEqual(main.bot.edit_message_text.call_count, len(main.ADMIN_IDS))
+        args = main.bot.edit_message_text.call_args
+        self.assertEqual(args.args[2], 500)
+        self.assertIn("&lt;b&gt;тест&lt;/b&gt;", args.args[0])
+        self.assertIn("<b>Сообщений в тикетах:</b> 1", args.args[0])
+
+        # Без новых уведомлений сводку не трогаем
+        main.bot.edit_message_text.reset_mock()
+        self.assertTrue(self.digest.tick())
+        main.bot.edit_message_text.assert_not_called()
+
+    def test_peek_buttons_for_newest_tickets(self):
+        # Первые два уведомления ушли в реальном времени, в сводке — остальные
+        for user_id in range(main.ADMIN_DIGEST_SHOW + 7):
+            self.digest.absorb("message", user_id, f"u{user_id}", "текст")
+        text, _ = self.digest.render()
+        self.assertIn("и ещё 5", text)
+        buttons = [c.kwargs["callback_data"] for c in main.types.InlineKeyboardButton.call_args_list[-10:]]
+        self.assertEqual(buttons[0], f"peek_{main.ADMIN_DIGEST_SHOW + 6}")
+
+    def test_reverts_to_real_time_when_load_drops(self):
+        for user_id in range(3):
+            self.digest.absorb("message", user_id, f"u{user_id}", "текст")
+        self.assertTrue(self.digest.active)
+        time.sleep(0.25)
+        self.assertFalse(self.digest.tick())
+        self.assertFalse(self.digest.active)
+        self.assertIn("снова приходят сразу", main.bot.edit_message_text.call_args.args[0])
+        self.assertFalse(self.digest.absorb("message", 1, "u1", "текст"))
+
+    def test_edit_rate_limited_waits_for_next_tick(self):
+        for user_id in range(3):
+            self.digest.absorb("message", user_id, f"u{user_id}", "текст")
+        self.digest.absorb("message", 1, "u1", "ещё")
+        main.bot.reset_mock()
+        main.bot.edit_message_text.side_effect = Exception("Error code: 429. Too Many Requests: retry after 5")
+        self.assertTrue(self.digest.tick())
+        main.bot.send_message.assert_not_called()
+        main.bot.edit_message_text.side_effect = None
+        main.bot.edit_message_text.reset_mock()
+        self.assertTrue(self.digest.tick())
+        self.assertEqual(main.bot.edit_message_text.call_count, len(main.ADMIN_IDS))
+
+    def test_reposts_when_digest_message_gone(self):
+        for user_id in range(3):
+            self.digest.absorb("message", user_id, f"u{user_id}", "текст")
+        self.digest.absorb("message", 1, "u1", "ещё")
+        main.bot.reset_mock()
+        main.bot.edit_message_text.side_effect = Exception("Bad Request: message to edit not found")
+        self.addCleanup(setattr, main.bot.edit_message_text, "side_effect", None)
+        self.assertTrue(self.digest.tick())
+        self.assertEqual(main.bot.send_message.call_count, len(main.ADMIN_IDS))
+
+    def test_absorbed_ticket_cards_sent_when_episode_ends(self):
+        with unittest.mock.patch.object(main, "active_tickets", {801}), \
+                unittest.mock.patch.object(main, "profile_prefetcher", MagicMock(get=MagicMock(return_value=None))), \
+                unittest.mock.patch.dict(main.ticket_message_to_user, clear=True):
+            self.digest.absorb("message", 1, "u1", "текст")
+            self.digest.absorb("message", 2, "u2", "текст")
+            self.digest.absorb("ticket", 801, "u801", "Пользователь попросил оператора")
+            self.digest.absorb("ticket", 802, "u802", "Пользователь попросил оператора")  # уже закрыт
+            time.sleep(0.25)
+            main.bot.reset_mock()
+            self.assertFalse(self.digest.tick())
+            self.assertEqual(main.bot.send_message.call_count, len(main.ADMIN_IDS))
+            self.assertIn("801", main.bot.send_message.call_args.args[1])
+            self.assertEqual(set(main.ticket_message_to_user.values()), {801})
+
+    def test_ticket_message_not_forwarded_in_digest_mode(self):
+        with unittest.mock.patch.object(main, "admin_digest", self.digest), \
+                unittest.mock.patch.object(main, "active_tickets", {701}), \
+                unittest.mock.patch.object(main, "save_state"), \
+                unittest.mock.patch.object(main, "sync_active_tickets"), \
+                unittest.mock.patch.object(main, "save_chat_message"):
+            for _ in range(2):
+                self.digest.absorb("message", 700, "u700")
+            main.bot.reset_mock()
+            main.handle_user_text_message(make_message(701, "когда ответите?"))
+        main.bot.forward_message.assert_not_called()
+        self.assertEqual(self.digest.counters["absorbed_message"], 1)
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
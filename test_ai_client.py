@@ -0,0 +1,99 @@
+"""
+Tests for the AI chat client: hedged attempts, retries and the retry budget.
+
+Runs without installing real telebot/requests/dotenv (see tests_support.py).
+
+Run: python3 test_ai_client.py
+"""
+import os
+import tempfile
+import time
+import unittest
+import unittest.mock
+from unittest.mock import MagicMock
+
+import tests_support  # noqa: F401  (окружение и заглушки — до импорта main)
+import main
+
+
+def response(status, text="answer"):
+    resp = MagicMock(status_code=status, text=text)
+    resp.json.return_value = {"response": text}
+    return resp
+
+
+class TestAiClient(unittest.TestCase):
+
+    def setUp(self):
+        self.client = main.AiClient()
+        self.calls = []
+        patcher = unittest.mock.patch.multiple(main, AI_TIMEOUT_MAX=3, AI_TIMEOUT_MIN=0.5, AI_HEDGE_MIN_DELAY=0.05,
+                                               AI_RETRY_BACKOFF=0.01)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def post(self, *responses, slow_first=0):
+        def fake_post(url, json=None, headers=None, timeout=None):
+            self.calls.append(headers["Idempotency-Key"])
+            n = len(self.calls)
+            if n == 1 and slow_first:
+                time.sleep(slow_first)
+            return responses[min(n, len(responses)) - 1]
+        return unittest.mock.patch.object(main, "http_post", side_effect=fake_post)
+
+    def test_hedge_after_p95_wins_with_same_idempotency_key(self):
+        for _ in range(main.AI_LATENCY_MIN_SAMPLES):
+            self.client._latencies.append(0.1)
+        with self.post(response(200, "slow"), response(200, "fast"), slow_first=0.5):
+            self.assertEqual(self.client.chat(1, "привет"), "fast")
+        self.assertEqual(len(set(self.calls)), 1)
+        self.assertEqual(self.client.counters["hedge_wins"], 1)
+
+    def test_idempotency_key_per_call_within_update(self):
+        main.update_context.key = "501:7"
+        self.addCleanup(setattr, main.update_context, "key", None)
+        with self.post(response(503), response(200, "ok"), response(200, "notice")):
+            self.client.chat(501, "не работает впн")
+            self.client.chat(501, "[SYSTEM] Пользователь был переведён на оператора.")
+        # Повтор первого вызова — с тем же ключом, [SYSTEM] — со своим
+        self.assertEqual(self.calls[0], self.calls[1])
+        self.assertNotEqual(self.calls[1], self.calls[2])
+        self.assertTrue(all(key.startswith("501:7:ai_chat:") for key in self.calls))
+
+    def test_no_hedge_without_latency_history(self):
+        with self.post(response(200, "ok"), slow_first=0.2):
+            self.assertEqual(self.client.chat(1, "привет"), "ok")
+        self.assertEqual(len(self.calls), 1)
+
+    def test_server_error_retried_within_budget(self):
+        with self.post(response(503), response(200, "ok")):
+            self.assertEqual(self.client.chat(1, "привет"), "ok")
+        self.assertEqual(self.client.attempts[("retry", "ok")], 1)
+
+    def test_client_error_not_retried(self):
+        with self.post(response(400)):
+            with self.assertRaises(main.AiUnavailable) as ctx:
+                self.client.chat(1, "привет")
+        self.assertEqual(ctx.exception.outcome, "http_4xx")
+        self.assertEqual(len(self.calls), 1)
+
+    def test_exhausted_budget_stops_retries(self):
+        self.client._budget = 0
+        with self.post(response(503)):
+            with self.assertRaises(main.AiUnavailable):
+                self.client.chat(1, "привет")
+        self.assertEqual(len(self.calls), 1)
+        self.assertEqual(self.client.counters["retry_denied"], 1)
+
+    def test_system_notice_not_counted_in_ai_latency(self):
+        stats = main.SupportStats(os.path.join(tempfile.mkdtemp(), "stats.json"))
+        with unittest.mock.patch.object(main, "support_stats", stats), \
+                unittest.mock.patch.object(main.ai_client, "chat", return_value="ok"):
+            main.get_ai_response(1, "привет")
+            main.get_ai_response(1, "[SYSTEM] Оператор завершил диалог и закрыл тикет.")
+        _, hists = stats.summary(1)
+        self.assertEqual(hists["ai_latency"].count, 1)
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
@@ -0,0 +1,72 @@
+"""
+Tests for the chat action keepalive (typing indicator timer wheel).
+
+Runs without installing real telebot/requests/dotenv (see tests_support.py).
+
+Run: python3 test_chat_action.py
+"""
+import time
+import unittest
+
+import tests_support  # noqa: F401  (окружение и заглушки — до импорта main)
+import main
+
+
+class TestChatActionKeepalive(unittest.TestCase):
+
+    def setUp(self):
+        main.bot.reset_mock()
+        # 4 слота по 20 мс — полный оборот колеса 80 мс
+        self.keepalive = main.ChatActionKeepalive(0.08, 0.02, max_age=0.3)
+
+    def actions(self):
+        return [c.args for c in main.bot.send_chat_action.call_args_list]
+
+    def test_sends_immediately_and_stops_on_exit(self):
+        with self.keepalive.keep(1, 'typing'):
+            self.assertEqual(self.actions(), [(1, 'typing')])
+        self.assertEqual(len(self.keepalive), 0)
+        time.sleep(0.15)
+        self.assertEqual(self.actions(), [(1, 'typing')])
+
+    def test_refreshes_while_request_in_flight(self):
+        with self.keepalive.keep(1, 'typing'), self.keepalive.keep(2, 'record_voice'):
+            time.sleep(0.25)
+        sent = self.actions()
+        self.assertGreaterEqual(sent.count((1, 'typing')), 3)
+        self.assertGreaterEqual(sent.count((2, 'record_voice')), 3)
+
+    def test_nested_keep_does_not_resend(self):
+        with self.keepalive.keep(1, 'typing'):
+            with self.keepalive.keep(1, 'typing'):
+                pass
+            self.assertEqual(len(self.keepalive), 1)
+        self.assertEqual(self.actions(), [(1, 'typing')])
+        self.assertEqual(len(self.keepalive), 0)
+
+    def test_stops_on_error(self):
+        with self.assertRaises(RuntimeError):
+            with self.keepalive.keep(1, 'typing'):
+                raise RuntimeError("upstream failed")
+        self.assertEqual(len(self.keepalive), 0)
+
+    def test_slow_sends_skipped_to_keep_schedule(self):
+        keepalive = main.ChatActionKeepalive(0.02, 0.02, max_age=1)
+        main.bot.send_chat_action.side_effect = lambda *args: time.sleep(0.015)
+        self.addCleanup(setattr, main.bot.send_chat_action, "side_effect", None)
+        with keepalive.keep(1), keepalive.keep(2), keepalive.keep(3):
+            time.sleep(0.1)
+        self.assertGreater(keepalive.counters["skipped"], 0)
+
+    def test_expires_after_max_age(self):
+        with self.keepalive.keep(1, 'typing'):
+            time.sleep(0.45)
+            self.assertEqual(len(self.keepalive), 0)
+            sent = len(self.actions())
+            time.sleep(0.1)
+            self.assertEqual(len(self.actions()), sent)
+        self.assertEqual(self.keepalive.counters["expired"], 1)
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
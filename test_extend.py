@@ -3,43 +3,16 @@ Tests for /extend command in tech-support-bot.
 
 Verifies that the admin can subtract subscription time by passing negative
 days (e.g. /extend 681325220 base -30) while preserving the original positive-
-days flow. Runs without installing real telebot/requests/dotenv via sys.modules
-injection.
+days flow. Runs without installing real telebot/requests/dotenv (see
+tests_support.py).
 
 Run: python3 test_extend.py
 """
-import os
-import sys
 import unittest
 from unittest.mock import MagicMock
 
-# --- Required env BEFORE importing main ---
-os.environ['BOT_TOKEN_SUPPORT'] = 'test_token'
-os.environ['ADMIN_IDS'] = '111,222'
-os.environ['API_URL_SUPPORT'] = 'http://test/api'
-os.environ['SUPPORT_API_URL'] = 'http://test/support'
-
-# --- Mock third-party libs that aren't installed in this venv ---
-def _identity_decorator(*args, **kwargs):
-    def wrapper(fn):
-        return fn
-    return wrapper
-
-_bot_instance = MagicMock()
-_bot_instance.message_handler = _identity_decorator
-_bot_instance.callback_query_handler = _identity_decorator
-
-_telebot_mock = MagicMock()
-_telebot_mock.TeleBot.return_value = _bot_instance
-sys.modules['telebot'] = _telebot_mock
-sys.modules['telebot.types'] = MagicMock()
-
-sys.modules['dotenv'] = MagicMock()
-sys.modules['requests'] = MagicMock()
-
-# Now safe to import main
-sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
-import main  # noqa: E402
+import tests_support  # noqa: F401  (окружение и заглушки — до импорта main)
+import main
 
 
 def make_message(text, user_id=111):
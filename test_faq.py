@@ -0,0 +1,134 @@
+"""
+Tests for the offline FAQ engine used as AI pre-filter and fallback.
+
+Runs without installing real telebot/requests/dotenv (see tests_support.py).
+
+Run: python3 test_faq.py
+"""
+import unittest
+import unittest.mock
+from unittest.mock import MagicMock
+
+import tests_support  # noqa: F401  (окружение и заглушки — до импорта main)
+import main
+
+
+FAQ = [
+    {"id": "connect", "questions": ["как подключить впн", "как настроить vpn на телефоне"],
+     "answer": "connect-answer"},
+    {"id": "renew", "questions": ["как продлить подписку"], "answer": "renew-answer", "personal": True},
+]
+
+
+def make_message(text, user_id=555):
+    msg = MagicMock()
+    msg.text = text
+    msg.from_user.id = user_id
+    msg.from_user.username = "user"
+    msg.chat.id = user_id
+    return msg
+
+
+class TestFaqEngine(unittest.TestCase):
+
+    def setUp(self):
+        self.engine = main.FaqEngine(FAQ)
+
+    def test_exact_question_full_confidence(self):
+        match = self.engine.match("Как подключить VPN?")
+        self.assertEqual(match["id"], "connect")
+        self.assertAlmostEqual(match["confidence"], 1.0)
+
+    def test_word_forms_match_via_stemming(self):
+        match = self.engine.match("подскажите, как продлить мою подписку")
+        self.assertEqual(match["id"], "renew")
+        self.assertGreaterEqual(match["confidence"], main.FAQ_CONFIDENCE)
+
+    def test_unrelated_question_low_confidence(self):
+        match = self.engine.match("списали деньги дважды, верните")
+        self.assertTrue(match is None or match["confidence"] < main.FAQ_FALLBACK_CONFIDENCE)
+
+    def test_empty_faq_returns_none(self):
+        self.assertIsNone(main.FaqEngine([]).match("как подключить впн"))
+
+
+class TestFaqInProcessAiResponse(unittest.TestCase):
+
+    def setUp(self):
+        main.bot.reset_mock()
+        main.requests.reset_mock()
+        self._engine = main.faq_engine
+        main.faq_engine = main.FaqEngine(FAQ)
+        main.faq_stats.clear()
+
+    def tearDown(self):
+        main.faq_engine = self._engine
+
+    def test_confident_match_skips_ai_call(self):
+        main.process_ai_response(555, 555, "как подключить впн")
+        main.requests.post.assert_called_once()  # только сохранение ответа в БД
+        self.assertIn("/admin/chats/555/save", main.requests.post.call_args.args[0])
+        self.assertEqual(main.bot.send_message.call_args.args[1], "connect-answer")
+        self.assertEqual(main.faq_stats["prefilter_hits"], 1)
+        # Ответ из FAQ записан в локальную историю
+        self.assertEqual(main.chat_log[555][-1].text, "connect-answer")
+
+    def test_ai_unavailable_short_replies_escalate(self):
+        main.faq_engine = main.FaqEngine.from_file(main.FAQ_FILE)
+        for text in ("нет", "работает", "впн работает, спасибо"):
+            with unittest.mock.patch.object(main, "get_ai_response", return_value=None), \
+                    unittest.mock.patch.object(main, "handle_escalation") as escalate:
+                main.process_ai_response(555, 555, text)
+            escalate.assert_called_once()
+        self.assertEqual(main.faq_stats["fallback_hits"], 0)
+
+    def test_ai_unavailable_falls_back_to_faq_without_escalation(self):
+        with unittest.mock.patch.object(main, "get_ai_response", return_value=None), \
+                unittest.mock.patch.object(main, "handle_escalation") as escalate:
+            main.process_ai_response(555, 555, "как подключить впн на айфоне")
+        escalate.assert_not_called()
+        self.assertTrue(main.bot.send_message.call_args.args[1].startswith("connect-answer"))
+        self.assertEqual(main.faq_stats["fallback_hits"], 1)
+
+
+    def test_ai_busy_answered_from_faq_instead_of_shed(self):
+        with unittest.mock.patch.object(main, "admission", main.AdmissionControl(12, 5, 1, 0)), \
+                unittest.mock.patch.object(main, "get_ai_response") as ai:
+            main.process_ai_response(555, 555, "как подключить впн на айфоне")
+        ai.assert_not_called()
+        self.assertTrue(main.bot.send_message.call_args.args[1].startswith("connect-answer"))
+        self.assertEqual(main.faq_stats["busy_hits"], 1)
+        self.assertEqual(main.admission.counters["shed_ai_busy"], 0)
+
+
+class TestAiResponseCache(unittest.TestCase):
+
+    def setUp(self):
+        self.engine = main.FaqEngine(FAQ)
+        self.cache = main.AiResponseCache(True, 3600, 10)
+
+    def test_general_topic_shared_between_users(self):
+        text = "как подключить впн на телефоне"
+        key = self.cache.key_for(1, text, self.engine.match(text))
+        self.cache.put(key, "ai-answer", 2.0)
+        self.assertEqual(self.cache.get(self.cache.key_for(2, text, self.engine.match(text))), "ai-answer")
+
+    def test_personal_or_unknown_topic_not_cached(self):
+        for text in ("как продлить подписку", "списали деньги дважды, верните"):
+            self.assertIsNone(self.cache.key_for(1, text, self.engine.match(text)))
+
+    def test_cache_hit_answered_without_ai_call(self):
+        text = "как подключить впн на телефоне"
+        self.cache.put(self.cache.key_for(1, text, self.engine.match(text)), "ai-answer", 2.0)
+        with unittest.mock.patch.object(main, "ai_cache", self.cache), \
+                unittest.mock.patch.object(main, "faq_engine", self.engine), \
+                unittest.mock.patch.object(main, "FAQ_CONFIDENCE", 1.01), \
+                unittest.mock.patch.object(main, "deliver_bot_answer") as deliver, \
+                unittest.mock.patch.object(main, "get_ai_response") as ai:
+            main.process_ai_response(7, 7, text)
+        deliver.assert_called_once_with(7, 7, "ai-answer")
+        ai.assert_not_called()
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
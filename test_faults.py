@@ -0,0 +1,64 @@
+"""
+Tests for the upstream fault and latency injection layer.
+
+Runs without installing real telebot/requests/dotenv (see tests_support.py).
+
+Run: python3 test_faults.py
+"""
+import unittest
+import unittest.mock
+
+import tests_support  # noqa: F401  (окружение и заглушки — до импорта main)
+import main
+
+
+class InjectedTimeout(Exception):
+    pass
+
+
+class TestFaultInjection(unittest.TestCase):
+
+    def setUp(self):
+        main.requests.reset_mock()
+        self.addCleanup(main.fault_injector.set_rules, [])
+
+    def test_parse_rule(self):
+        rule = main.parse_fault_rule("*proxyapi* error=0.2 status=502 latency=1.5")
+        self.assertEqual((rule["pattern"], rule["error"], rule["status"], rule["latency"]),
+                         ("*proxyapi*", 0.2, 502, 1.5))
+        with self.assertRaises(ValueError):
+            main.parse_fault_rule("* explode=1")
+
+    def test_error_rule_replaces_matching_call_only(self):
+        main.fault_injector.set_rules([main.parse_fault_rule("POST:*/internal/support/chat error=1 status=502")])
+        resp = main.http_post("http://test/support/internal/support/chat", json={}, timeout=5)
+        self.assertEqual(resp.status_code, 502)
+        main.requests.post.assert_not_called()
+        main.http_get("http://test/support/admin/tickets/active", timeout=5)
+        main.requests.get.assert_called_once()
+        self.assertEqual(main.fault_injector.injected[("POST:*/internal/support/chat", "error")], 1)
+
+    def test_latency_beyond_client_timeout_becomes_timeout(self):
+        main.fault_injector.set_rules([main.parse_fault_rule("GET:*/users/:id/info latency=10")])
+        with unittest.mock.patch.object(main.requests, "Timeout", InjectedTimeout), \
+                unittest.mock.patch.object(main.time, "sleep") as sleep:
+            with self.assertRaises(InjectedTimeout):
+                main.http_get("http://test/api/users/42/info", timeout=2)
+        sleep.assert_called_once_with(2)
+
+    def test_telegram_rule_with_connect_read_timeout_tuple(self):
+        main.fault_injector.set_rules([main.parse_fault_rule("tg.send* latency=1 latency_rate=0")])
+        url = "https://api.telegram.org/bottoken/sendMessage"
+        main.telegram_request_sender("post", url, params={}, timeout=(15, 25))
+        main.apihelper._get_req_session().request.assert_called()
+
+        main.fault_injector.set_rules([main.parse_fault_rule("tg.send* latency=30")])
+        with unittest.mock.patch.object(main.requests, "Timeout", InjectedTimeout), \
+                unittest.mock.patch.object(main.time, "sleep") as sleep:
+            with self.assertRaises(InjectedTimeout):
+                main.telegram_request_sender("post", url, params={}, timeout=(15, 25))
+        sleep.assert_called_once_with(25)
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
@@ -0,0 +1,50 @@
+"""
+Tests for the structured logging pipeline: context fields and rate limiting.
+
+Runs without installing real telebot/requests/dotenv (see tests_support.py).
+
+Run: python3 test_logging.py
+"""
+import json
+import logging
+import time
+import unittest
+import unittest.mock
+
+import tests_support  # noqa: F401  (окружение и заглушки — до импорта main)
+import main
+
+
+def make_record(msg="boom %s", args=(1,), level=logging.ERROR, lineno=10):
+    return logging.LogRecord("main", level, "main.py", lineno, msg, args, None)
+
+
+class TestLogging(unittest.TestCase):
+
+    def test_rate_limit_per_call_site_reports_suppressed(self):
+        flt = main.RateLimitFilter()
+        passed = [flt.filter(make_record()) for _ in range(main.LOG_RATE_LIMIT + 3)]
+        self.assertEqual(passed.count(True), main.LOG_RATE_LIMIT)
+        self.assertTrue(flt.filter(make_record(lineno=11)))  # другое место — свой лимит
+        with unittest.mock.patch.object(main.time, "monotonic", return_value=time.monotonic() + main.LOG_RATE_WINDOW):
+            record = make_record()
+            self.assertTrue(flt.filter(record))
+        self.assertEqual(record.suppressed, 3)
+
+    def test_info_not_rate_limited(self):
+        flt = main.RateLimitFilter()
+        self.assertTrue(all(flt.filter(make_record(level=logging.INFO)) for _ in range(20)))
+
+    def test_json_record_carries_update_context(self):
+        main.update_context.key, main.update_context.user_id = "5:42", 5
+        try:
+            record = make_record()
+            main.UpdateContextFilter().filter(record)
+        finally:
+            main.update_context.key = main.update_context.user_id = None
+        entry = json.loads(main.JsonLogFormatter().format(main.LogQueueHandler(None).prepare(record)))
+        self.assertEqual((entry["msg"], entry["user_id"], entry["update_id"]), ("boom 1", 5, "5:42"))
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
@@ -0,0 +1,247 @@
+"""
+Performance contract tests: upstream call budgets per user/admin flow.
+
+Each flow runs against mocked requests/telebot and counts HTTP requests
+(by method), Telegram Bot API calls and writes to STATE_FILE. A change that
+adds a call or a state rewrite to a flow fails here — raise the budget in
+FLOW_BUDGETS only together with the change that justifies it.
+Runs without installing real telebot/requests/dotenv (see tests_support.py).
+
+Run: python3 test_perf_contracts.py
+"""
+import os
+import tempfile
+import threading
+import unittest
+import unittest.mock
+from unittest.mock import MagicMock
+
+import tests_support  # noqa: F401  (окружение и заглушки — до импорта main)
+import main
+
+# flow -> {"get"/"post"/"patch": HTTP-запросов, "telegram": вызовов Bot API,
+#          "state_writes": перезаписей STATE_FILE, "state_bytes": записано байт}
+FLOW_BUDGETS = {
+    # синк тикетов, сохранение вопроса, AI, сохранение ответа
+    "user_text": {"get": 1, "post": 3, "patch": 0, "telegram": 2, "state_writes": 1, "state_bytes": 450},
+    # транскрипция Whisper + AI; typing один на весь флоу (ChatActionKeepalive)
+    "user_voice": {"get": 0, "post": 3, "patch": 0, "telegram": 4, "state_writes": 1, "state_bytes": 200},
+    # сверх лимита в открытом тикете: пересылка 2 админам + уведомление о лимите, без синка и записи
+    "user_text_shed_in_ticket": {"get": 0, "post": 1, "patch": 0, "telegram": 3, "state_writes": 0,
+                                 "state_bytes": 0},
+    # ответ из FAQ: синк тикетов, сохранение вопроса и ответа, без вызова AI
+    "user_text_faq": {"get": 1, "post": 2, "patch": 0, "telegram": 1, "state_writes": 1, "state_bytes": 450},
+    # ответ из кэша AI: то же, что FAQ — без вызова AI
+    "user_text_cached": {"get": 1, "post": 2, "patch": 0, "telegram": 1, "state_writes": 1, "state_bytes": 450},
+    "user_media": {"get": 0, "post": 1, "patch": 0, "telegram": 1, "state_writes": 1, "state_bytes": 350},
+    # /info + email в фоне, карточка 2 админам и её дозаполнение, [SYSTEM] в AI
+    "escalation": {"get": 2, "post": 2, "patch": 0, "telegram": 5, "state_writes": 1, "state_bytes": 450},
+    "admin_reply": {"get": 0, "post": 1, "patch": 0, "telegram": 2, "state_writes": 0, "state_bytes": 0},
+    "close_ticket": {"get": 0, "post": 2, "patch": 0, "telegram": 2, "state_writes": 1, "state_bytes": 175},
+    "chats": {"get": 2, "post": 0, "patch": 0, "telegram": 1, "state_writes": 0, "state_bytes": 0},
+    "info": {"get": 2, "post": 0, "patch": 0, "telegram": 1, "state_writes": 0, "state_bytes": 0},
+    # 1 GET списка + по PATCH на платного юзера (в COMPENSATE_USERS их 3)
+    "compensate": {"get": 1, "post": 0, "patch": 3, "telegram": 2, "state_writes": 0, "state_bytes": 0},
+}
+
+USER_INFO = {"plan": "base", "is_active": 1, "subscription_end": "2030-01-01T00:00:00Z", "device_limit": 3}
+COMPENSATE_USERS = [{"telegram_id": 900 + i, "plan": plan}
+                    for i, plan in enumerate(["base", "family", "trial", "free", "base"])]
+
+
+def fake_response(url):
+    resp = MagicMock(status_code=200, text="ok")
+    if url.endswith("/internal/support/chat"):
+        payload = {"response": "Попробуйте выбрать другой сервер в приложении."}
+    elif url.endswith("/admin/tickets/active"):
+        payload = []
+    elif url.endswith("/users/active"):
+        payload = COMPENSATE_USERS
+    elif url.endswith("/info"):
+        payload = USER_INFO
+    elif "/internal/user-email/" in url:
+        payload = {"email": "user@example.com"}
+    elif url.endswith("/admin/chats"):
+        payload = {"chats": [{"telegram_id": 700, "username": "u700", "message_count": 3,
+                              "last_time": "2026-01-01T10:00:00"}], "total": 1}
+    elif "/audio/transcriptions" in url:
+        payload = {"text": "у меня странная проблема с приложением"}
+    else:
+        payload = {}
+    resp.json.return_value = payload
+    return resp
+
+
+def make_message(user_id, text=None, content_type='text', message_id=1):
+    msg = MagicMock()
+    msg.from_user.id = user_id
+    msg.from_user.username = f"u{user_id}"
+    msg.chat.id = user_id
+    msg.message_id = message_id
+    msg.content_type = content_type
+    msg.text = text
+    msg.caption = None
+    msg.media_group_id = None
+    return msg
+
+
+class FlowBudgetTestCase(unittest.TestCase):
+
+    def setUp(self):
+        tmp = tempfile.mkdtemp()
+        main.bot.reset_mock()
+        main.requests.reset_mock()
+        main.bot.download_file.return_value = b"OggS"
+        self.http = []
+        for method in ("get", "post", "patch"):
+            getattr(main.requests, method).side_effect = (
+                lambda url, _method=method, **kwargs: self.http.append((_method, url)) or fake_response(url))
+
+        self.state_writes = []
+        save_state = main._save_state
+
+        def counting_save_state():
+            save_state()
+            self.state_writes.append(os.path.getsize(main.STATE_FILE))
+
+        for patcher in (
+            unittest.mock.patch.object(main, "_save_state", counting_save_state),
+            unittest.mock.patch.object(main, "STATE_FILE", os.path.join(tmp, "bot_state.json")),
+            unittest.mock.patch.object(main, "PROXYAPI_KEY", "test"),
+            unittest.mock.patch.object(main, "active_tickets", set()),
+            unittest.mock.patch.object(main, "ticket_queue", main.TicketQueue()),
+            unittest.mock.patch.object(main, "_last_ticket_sync", 0.0),
+            unittest.mock.patch.object(main, "profile_prefetcher", main.ProfilePrefetcher()),
+            unittest.mock.patch.object(main, "admin_digest", main.AdminDigest(
+                main.ADMIN_DIGEST_ENTER, main.ADMIN_DIGEST_EXIT, main.ADMIN_DIGEST_WINDOW, main.ADMIN_DIGEST_INTERVAL)),
+            unittest.mock.patch.object(main, "support_stats", main.SupportStats(os.path.join(tmp, "stats.json"))),
+            unittest.mock.patch.object(main.tracer, "_path", os.path.join(tmp, "traces.jsonl")),
+            unittest.mock.patch.dict(main.chat_log, clear=True),
+            unittest.mock.patch.dict(main.user_data_cache, clear=True),
+            unittest.mock.patch.dict(main.user_conversation, clear=True),
+            unittest.mock.patch.dict(main.user_last_activity, clear=True),
+            unittest.mock.patch.dict(main.ticket_message_to_user, clear=True),
+            unittest.mock.patch.dict(main.recently_closed, clear=True),
+            unittest.mock.patch.dict(main.auto_close_timers, clear=True),
+            unittest.mock.patch.dict(main._chats_cache, clear=True),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.addCleanup(self._cancel_timers)
+
+    def _cancel_timers(self):
+        for timer in main.auto_close_timers.values():
+            timer.cancel()
+
+    def open_ticket(self, user_id):
+        main.active_tickets.add(user_id)
+        main.ticket_queue.push(user_id)
+
+    def reset_counters(self):
+        main.bot.reset_mock()
+        main.bot.download_file.return_value = b"OggS"
+        self.http.clear()
+        self.state_writes.clear()
+
+    def wait_background(self):
+        for thread in threading.enumerate():
+            if thread.name in ("profile-prefetch", "ai-attempt"):
+                thread.join(5)
+
+    def assertWithinBudget(self, flow):
+        # Фоновые загрузки (прогрев профиля, попытки AI) тоже считаются
+        self.wait_background()
+        used = {method: sum(1 for m, _ in self.http if m == method) for method in ("get", "post", "patch")}
+        used["telegram"] = len(main.bot.method_calls)
+        used["state_writes"] = len(self.state_writes)
+        used["state_bytes"] = sum(self.state_writes)
+        budget = FLOW_BUDGETS[flow]
+        over = {k: f"{used[k]} > {budget[k]}" for k in budget if used[k] > budget[k]}
+        self.assertFalse(over, f"{flow} over budget: {over}\nHTTP: {self.http}\n"
+                               f"Telegram: {[c[0] for c in main.bot.method_calls]}")
+
+
+class TestUserFlowBudgets(FlowBudgetTestCase):
+
+    def test_user_text_answered_by_ai(self):
+        main.handle_user_text_message(make_message(501, "у меня странная проблема с приложением"))
+        self.assertWithinBudget("user_text")
+
+    def test_user_text_answered_from_faq(self):
+        main.handle_user_text_message(make_message(506, "как подключить впн"))
+        self.assertFalse([url for _, url in self.http if url.endswith("/internal/support/chat")])
+        self.assertWithinBudget("user_text_faq")
+
+    def test_user_text_answered_from_ai_cache(self):
+        text = "как подключить впн на телефоне"
+        cache = main.AiResponseCache(True, 3600, 10)
+        cache.put(cache.key_for(507, text, main.faq_engine.match(text)), "Скачайте приложение.", 2.0)
+        with unittest.mock.patch.object(main, "ai_cache", cache), \
+                unittest.mock.patch.object(main, "FAQ_CONFIDENCE", 1.01):
+            main.handle_user_text_message(make_message(508, text))
+        self.assertEqual(main.bot.send_message.call_args.args[1], "Скачайте приложение.")
+        self.assertFalse([url for _, url in self.http if url.endswith("/internal/support/chat")])
+        self.assertWithinBudget("user_text_cached")
+
+    def test_user_voice_transcribed_and_answered(self):
+        main.handle_user_voice_message(make_message(502, content_type='voice'))
+        self.assertWithinBudget("user_voice")
+
+    def test_rate_limited_message_in_open_ticket_still_forwarded(self):
+        self.open_ticket(505)
+        with unittest.mock.patch.object(main, "admission", main.AdmissionControl(12, 1, 8, 16)):
+            main.admission.allow(505)  # бакет на 1 сообщение уже исчерпан
+            main.handle_user_text_message(make_message(505, "второе", message_id=2))
+        self.assertEqual(main.bot.forward_message.call_count, len(main.ADMIN_IDS))
+        self.assertWithinBudget("user_text_shed_in_ticket")
+
+    def test_user_photo_without_caption(self):
+        main.handle_user_media_message(make_message(503, content_type='photo'))
+        self.assertWithinBudget("user_media")
+
+    def test_escalation_opens_ticket(self):
+        main.handle_escalation(504, 504, reason="Пользователь попросил оператора")
+        self.assertWithinBudget("escalation")
+
+    def test_failed_profile_fetch_not_repeated_per_message(self):
+        # Пока ИИ лежит, warm зовётся на каждое сообщение юзера
+        main.requests.get.side_effect = lambda url, **kwargs: self.http.append(("get", url)) or MagicMock(
+            status_code=503)
+        for _ in range(3):
+            main.profile_prefetcher.warm(507, "ai_unavailable")
+            self.wait_background()
+        self.assertEqual(len(self.http), 1)
+
+
+class TestAdminFlowBudgets(FlowBudgetTestCase):
+
+    def test_admin_reply_to_ticket(self):
+        self.open_ticket(601)
+        main.ticket_message_to_user[10] = 601
+        msg = make_message(111, "Здравствуйте, уже смотрим")
+        msg.reply_to_message.message_id = 10
+        self.reset_counters()
+        main.handle_admin_reply(msg)
+        self.assertWithinBudget("admin_reply")
+
+    def test_close_ticket(self):
+        self.open_ticket(602)
+        self.reset_counters()
+        main.close_ticket(111, 602)
+        self.assertWithinBudget("close_ticket")
+
+    def test_chats_first_page(self):
+        main.show_active_chats(make_message(111, "/chats"))
+        self.assertWithinBudget("chats")
+
+    def test_info(self):
+        main.handle_info(make_message(111, "/info 700"))
+        self.assertWithinBudget("info")
+
+    def test_compensate(self):
+        main.handle_compensate(make_message(111, "/compensate 3"))
+        self.assertWithinBudget("compensate")
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
@@ -0,0 +1,50 @@
+"""
+Tests for the table-driven update router (commands, messages, callbacks).
+
+Runs without installing real telebot/requests/dotenv (see tests_support.py).
+
+Run: python3 test_router.py
+"""
+import unittest
+from types import SimpleNamespace
+
+import tests_support  # noqa: F401  (окружение и заглушки — до импорта main)
+import main
+
+
+def make_message(user_id, text=None, content_type='text', reply=False):
+    return SimpleNamespace(from_user=SimpleNamespace(id=user_id), content_type=content_type, text=text,
+                           reply_to_message=SimpleNamespace(message_id=1) if reply else None)
+
+
+class TestUpdateRouter(unittest.TestCase):
+
+    def test_admin_command_resolves_to_handler(self):
+        self.assertIs(main.router.resolve_message(make_message(111, "/stats 7d")), main.handle_stats)
+        self.assertIs(main.router.resolve_message(make_message(111, "/next@support_bot")), main.handle_next_ticket)
+
+    def test_user_command_falls_through_to_text_handler(self):
+        self.assertIs(main.router.resolve_message(make_message(5, "/stats")), main.handle_user_text_message)
+        self.assertIs(main.router.resolve_message(make_message(5, "/start")), main.send_welcome)
+
+    def test_content_type_and_reply_tables(self):
+        self.assertIs(main.router.resolve_message(make_message(5, content_type='voice')),
+                      main.handle_user_voice_message)
+        self.assertIs(main.router.resolve_message(make_message(111, content_type='photo', reply=True)),
+                      main.handle_admin_reply)
+        self.assertIsNone(main.router.resolve_message(make_message(111, "привет")))
+
+    def test_callback_longest_prefix_with_typed_args(self):
+        self.assertEqual(main.router.resolve_callback("peek_page_42_80"), (main.cb_peek_page, (42, 80)))
+        self.assertEqual(main.router.resolve_callback("peek_42"), (main.cb_peek, (42,)))
+        self.assertEqual(main.router.resolve_callback("chats_tickets_15"), (main.cb_chats_page, ("tickets", 15)))
+        self.assertEqual(main.router.resolve_callback("peek_done"), (main.cb_peek_done, ()))
+
+    def test_callback_bad_payload_and_unknown_prefix(self):
+        self.assertEqual(main.router.resolve_callback("close_ticket_abc"), (main.cb_close_ticket, None))
+        self.assertEqual(main.router.resolve_callback("peek_page_1"), (main.cb_peek_page, None))
+        self.assertEqual(main.router.resolve_callback("unknown"), (None, None))
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
@@ -0,0 +1,72 @@
+"""
+Tests for the SLA-ordered ticket queue behind /reply and /next.
+
+Runs without installing real telebot/requests/dotenv (see tests_support.py).
+
+Run: python3 test_ticket_queue.py
+"""
+import time
+import unittest
+
+import tests_support  # noqa: F401  (окружение и заглушки — до импорта main)
+import main
+
+
+class TestTicketQueue(unittest.TestCase):
+
+    def setUp(self):
+        self.q = main.TicketQueue()
+
+    def test_paid_plan_overtakes_free_with_same_wait(self):
+        now = time.time()
+        self.q.push(1, plan="free", since=now)
+        self.q.push(2, plan="family", since=now)
+        self.assertEqual(self.q.next(), 2)
+
+    def test_long_wait_beats_plan_priority(self):
+        now = time.time()
+        self.q.push(1, plan="free", since=now - 3 * 3600)
+        self.q.push(2, plan="family", since=now)
+        self.assertEqual(self.q.next(), 1)
+
+    def test_answered_ticket_moves_to_back_until_user_writes(self):
+        now = time.time()
+        self.q.push(1, plan="base", since=now - 600)
+        self.q.push(2, plan="base", since=now)
+        self.q.mark_answered(1)
+        self.assertEqual(self.q.next(), 2)
+        self.q.touch_user(1)
+        self.assertEqual([uid for uid, _, _ in self.q.page(0)], [2, 1])
+
+    def test_breached_only_reports_overdue_unanswered(self):
+        now = time.time()
+        self.q.push(1, plan="base", since=now - 3600)
+        self.q.push(2, plan="base", since=now)
+        self.q.push(3, plan="base", since=now - 7200)
+        self.q.mark_answered(3)
+        self.assertEqual(self.q.breached(now), [1])
+
+    def test_pagination_slices_in_order(self):
+        now = time.time()
+        for uid in range(25):
+            self.q.push(uid, since=now - uid)
+        first = [uid for uid, _, _ in self.q.page(0, size=10)]
+        last = [uid for uid, _, _ in self.q.page(2, size=10)]
+        self.assertEqual(first, list(range(24, 14, -1)))
+        self.assertEqual(last, [4, 3, 2, 1, 0])
+
+    def test_sync_drops_closed_and_adds_new(self):
+        self.q.push(1)
+        self.q.push(2)
+        self.q.sync({2, 3})
+        self.assertEqual(sorted(uid for uid, _, _ in self.q.page(0)), [2, 3])
+
+    def test_state_roundtrip(self):
+        self.q.push(5, plan="family", reason="AI недоступен", since=1000.0)
+        other = main.TicketQueue()
+        other.load_state(self.q.to_state())
+        self.assertEqual(other.page(0), self.q.page(0))
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
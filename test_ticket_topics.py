@@ -0,0 +1,142 @@
+"""
+Tests for ticket topics in the admin supergroup (ADMIN_GROUP_ID).
+
+Runs without installing real telebot/requests/dotenv (see tests_support.py).
+
+Run: python3 test_ticket_topics.py
+"""
+import unittest
+import unittest.mock
+from unittest.mock import MagicMock
+
+import tests_support  # noqa: F401  (окружение и заглушки — до импорта main)
+import main
+
+GROUP_ID = -1001234567890
+
+
+def make_message(user_id, text="текст", chat_id=None, thread_id=None, content_type='text'):
+    msg = MagicMock()
+    msg.from_user.id = user_id
+    msg.from_user.username = f"u{user_id}"
+    msg.chat.id = chat_id or user_id
+    msg.message_id = 5
+    msg.content_type = content_type
+    msg.text = text
+    msg.caption = None
+    msg.media_group_id = None
+    msg.is_topic_message = thread_id is not None
+    msg.message_thread_id = thread_id
+    msg.reply_to_message = None
+    return msg
+
+
+class TestTicketTopics(unittest.TestCase):
+
+    def setUp(self):
+        main.bot.reset_mock()
+        main.bot.create_forum_topic.return_value = MagicMock(message_thread_id=77)
+        main.bot.send_message.return_value = MagicMock(message_id=900)
+        self.topics = main.TicketTopics()
+        for patcher in (
+            unittest.mock.patch.object(main, "ADMIN_GROUP_ID", GROUP_ID),
+            unittest.mock.patch.object(main.router, "_admin_chat_id", GROUP_ID),
+            unittest.mock.patch.object(main, "ticket_topics", self.topics),
+            unittest.mock.patch.object(main, "save_state"),
+            unittest.mock.patch.object(main, "save_chat_message"),
+            unittest.mock.patch.object(main, "schedule_auto_close"),
+            unittest.mock.patch.object(main, "profile_prefetcher", MagicMock(get=MagicMock(return_value={}))),
+            unittest.mock.patch.object(main, "active_tickets", set()),
+            unittest.mock.patch.object(main, "ticket_queue", main.TicketQueue()),
+            unittest.mock.patch.dict(main.ticket_message_to_user, clear=True),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_ticket_card_posted_once_into_new_topic(self):
+        main.create_admin_ticket(501, "u501", "Пользователь попросил оператора")
+        main.bot.create_forum_topic.assert_called_once_with(GROUP_ID, "u501 · 501")
+        main.bot.send_message.assert_called_once()
+        args = main.bot.send_message.call_args
+        self.assertEqual(args.args[0], GROUP_ID)
+        self.assertEqual(args.kwargs["message_thread_id"], 77)
+        self.assertEqual(self.topics.user_for(77), 501)
+
+    def test_user_message_copied_once_to_topic(self):
+        main.active_tickets.add(502)
+        main.forward_to_admins(make_message(502), 502, "u502", "текст")
+        main.forward_to_admins(make_message(502), 502, "u502", "ещё")
+        main.bot.create_forum_topic.assert_called_once()
+        self.assertEqual(main.bot.copy_message.call_count, 2)
+        main.bot.copy_message.assert_called_with(GROUP_ID, 502, 5, message_thread_id=77)
+        main.bot.forward_message.assert_not_called()
+
+    def test_admin_message_in_topic_routed_to_user(self):
+        self.topics.ensure(503, "u503")
+        main.active_tickets.add(503)
+        message = make_message(111, "Уже смотрим", chat_id=GROUP_ID, thread_id=77)
+        self.assertIs(main.router.resolve_message(message), main.handle_topic_message)
+        main.handle_topic_message(message)
+        main.bot.send_message.assert_called_once_with(503, "✉️ Ответ поддержки:\nУже смотрим")
+        main.bot.reply_to.assert_not_called()
+
+    def test_admin_message_in_closed_topic_not_sent(self):
+        main.create_admin_ticket(506, "u506")
+        with unittest.mock.patch.object(main, "get_ai_response"):
+            main.close_ticket(GROUP_ID, 506)
+        main.bot.reset_mock()
+        main.handle_topic_message(make_message(111, "Ещё вопрос?", chat_id=GROUP_ID, thread_id=77))
+        main.bot.send_message.assert_not_called()
+        main.bot.reply_to.assert_called_once()
+
+    def test_callbacks_answer_into_topic(self):
+        self.topics.ensure(507, "u507")
+        call = MagicMock(message=make_message(111, chat_id=GROUP_ID, thread_id=77))
+        with unittest.mock.patch.object(main.conversation_viewer, "page", return_value=([], 0, 0, 0)):
+            main.cb_open_ticket(call, 507)
+            main.cb_peek(call, 507)
+        main.cb_reply_to(call, 507)
+        self.assertEqual(main.bot.send_message.call_count, 3)
+        for args in main.bot.send_message.call_args_list:
+            self.assertEqual(args.kwargs["message_thread_id"], 77)
+
+    def test_group_messages_outside_topics_ignored(self):
+        self.assertIsNone(main.router.resolve_message(make_message(5, "привет", chat_id=GROUP_ID, thread_id=77)))
+        main.handle_topic_message(make_message(111, "привет", chat_id=GROUP_ID))
+        main.handle_topic_message(make_message(111, "привет", chat_id=GROUP_ID, thread_id=12))
+        main.bot.send_message.assert_not_called()
+        # Команды админов в группе работают как в личке
+        self.assertIs(main.router.resolve_message(make_message(111, "/next", chat_id=GROUP_ID, thread_id=77)),
+                      main.handle_next_ticket)
+
+    def test_close_and_reopen_reuses_topic(self):
+        main.create_admin_ticket(504, "u504")
+        with unittest.mock.patch.object(main, "get_ai_response"):
+            main.close_ticket(GROUP_ID, 504)
+        main.bot.close_forum_topic.assert_called_once_with(GROUP_ID, 77)
+        main.create_admin_ticket(504, "u504")
+        main.bot.reopen_forum_topic.assert_called_once_with(GROUP_ID, 77)
+        main.bot.create_forum_topic.assert_called_once()
+
+    def test_close_and_reopen_saved(self):
+        self.topics.ensure(508, "u508")
+        main.save_state.reset_mock()
+        self.topics.close(508)
+        main.save_state.assert_called_once()
+        self.topics.ensure(508, "u508")
+        self.assertEqual(main.save_state.call_count, 2)
+        self.assertTrue(self.topics.is_open(508))
+
+    def test_state_round_trip(self):
+        self.topics.ensure(505, "u505")
+        self.topics.close(505)
+        restored = main.TicketTopics()
+        restored.load_state(self.topics.to_state())
+        self.assertEqual(restored.user_for(77), 505)
+        self.assertEqual(restored.topic_for(505), 77)
+        restored.ensure(505, "u505")
+        main.bot.reopen_forum_topic.assert_called_once_with(GROUP_ID, 77)
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
@@ -0,0 +1,128 @@
+"""
+Tests for update recording: anonymization and the JSONL format read by replay_updates.py.
+
+Runs without installing real telebot/requests/dotenv (see tests_support.py).
+
+Run: python3 test_update_recorder.py
+"""
+import os
+import json
+import tempfile
+import threading
+import time
+import unittest
+import unittest.mock
+from types import SimpleNamespace
+
+import tests_support  # noqa: F401  (окружение и заглушки — до импорта main)
+import main
+
+
+class TestUpdateRecorder(unittest.TestCase):
+
+    def setUp(self):
+        self.path = os.path.join(tempfile.mkdtemp(), "updates.jsonl")
+        self.recorder = main.UpdateRecorder(self.path, "salt")
+
+    def test_ids_and_texts_anonymized_stably(self):
+        message = {"message_id": 5, "from": {"id": 123456, "username": "ivan"}, "chat": {"id": 123456},
+                   "text": "позовите оператора, мой номер 987654321"}
+        anon = self.recorder.anonymize(message, "message")
+        self.assertEqual(anon["from"]["id"], anon["chat"]["id"])
+        self.assertNotEqual(anon["from"]["id"], 123456)
+        self.assertNotIn("ivan", json.dumps(anon))
+        self.assertTrue(anon["text"].startswith("позовите оператора, "))
+        self.assertNotIn("987654321", anon["text"])
+        self.assertEqual(anon, self.recorder.anonymize(message, "message"))
+
+    def test_callback_data_ids_match_user_ids(self):
+        query = {"id": "1", "from": {"id": 111}, "data": "close_ticket_123456"}
+        anon = self.recorder.anonymize(query, "callback_query")
+        self.assertEqual(anon["data"], f"close_ticket_{self.recorder.anon_id(123456)}")
+
+    def test_forwarded_message_and_contact_leave_no_personal_data(self):
+        message = {"message_id": 6, "from": {"id": 123456, "is_bot": False, "first_name": "Иван"},
+                   "chat": {"id": 123456, "type": "private"}, "date": 1700000000,
+                   "forward_origin": {"type": "user", "date": 1699999999,
+                                      "sender_user": {"id": 654321, "first_name": "Пётр", "username": "petr"}},
+                   "forward_sender_name": "Пётр Петров",
+                   "contact": {"user_id": 654321, "phone_number": "+79990001122", "first_name": "Пётр"},
+                   "location": {"latitude": 55.75, "longitude": 37.61}}
+        anon = self.recorder.anonymize(message, "message")
+        dumped = json.dumps(anon, ensure_ascii=False)
+        for secret in ("654321", "123456", "Пётр", "petr", "79990001122", "55.75"):
+            self.assertNotIn(secret, dumped)
+        self.assertEqual(anon["forward_origin"]["sender_user"]["id"], anon["contact"]["user_id"])
+        self.assertEqual((anon["message_id"], anon["date"], anon["chat"]["type"], anon["from"]["is_bot"]),
+                         (6, 1700000000, "private", False))
+
+    def test_reply_to_ticket_card_hides_user_id_in_buttons(self):
+        card = {"message_id": 40, "from": {"id": 1, "is_bot": True, "first_name": "bot"},
+                "chat": {"id": 111, "type": "private"},
+                "text": "🎫 НОВЫЙ ТИКЕТ\nID: 123456",
+                "reply_markup": {"inline_keyboard": [[
+                    {"text": "✅ Закрыть тикет", "callback_data": "close_ticket_123456"}]]}}
+        message = {"message_id": 41, "from": {"id": 111}, "chat": {"id": 111}, "text": "Уже смотрим",
+                   "reply_to_message": card}
+        anon = self.recorder.anonymize(message, "message")
+        self.assertNotIn("123456", json.dumps(anon))
+        button = anon["reply_to_message"]["reply_markup"]["inline_keyboard"][0][0]
+        self.assertEqual(button["callback_data"], f"close_ticket_{self.recorder.anon_id(123456)}")
+
+    def test_record_writes_admin_header_and_updates(self):
+        update = SimpleNamespace(update_id=7, message=SimpleNamespace(json={"message_id": 1, "text": "/start"}),
+                                 edited_message=None, callback_query=None)
+        self.recorder.record([update])
+        with open(self.path) as f:
+            header, record = [json.loads(line) for line in f]
+        self.assertEqual(sorted(header["admins"]), sorted(self.recorder.anon_id(a) for a in main.ADMIN_IDS))
+        self.assertEqual(record["update"], {"update_id": 7, "message": {"message_id": 1, "text": "/start"}})
+
+
+
+class TestUpdateTracker(unittest.TestCase):
+
+    def setUp(self):
+        self.path = os.path.join(tempfile.mkdtemp(), "processed_updates.json")
+
+    def restarted(self):
+        tracker = main.UpdateTracker(self.path)
+        tracker.load()
+        return tracker
+
+    def test_update_saved_only_after_handler_done(self):
+        tracker = main.UpdateTracker(self.path)
+        for update_id in (10, 11):
+            self.assertTrue(tracker.claim(update_id))
+        tracker.start("1:5", 11)
+        tracker.save()
+        # Упали посреди хендлера апдейта 11 — после рестарта он обрабатывается снова
+        self.assertFalse(self.restarted().claim(10))
+        self.assertTrue(self.restarted().claim(11))
+        tracker.done("1:5")
+        self.assertFalse(self.restarted().claim(11))
+
+    def test_buffered_album_saved_only_after_flush(self):
+        tracker = main.UpdateTracker(self.path)
+        messages = []
+        for update_id, message_id in ((20, 7), (21, 8)):
+            tracker.claim(update_id)
+            tracker.start(f"1:{message_id}", update_id)
+            messages.append(SimpleNamespace(chat=SimpleNamespace(id=1), message_id=message_id,
+                                            media_group_id="album", from_user=SimpleNamespace(id=1)))
+        flushed = threading.Event()
+        buffer = main.MediaGroupBuffer(0.05, lambda items: flushed.set())
+        with unittest.mock.patch.object(main, "update_tracker", tracker):
+            for message in messages:
+                buffer.add(message)
+                tracker.done(main.update_key(message))  # хендлер вернулся сразу после add()
+            # Упали до _flush — альбом после рестарта доставляется снова
+            self.assertTrue(self.restarted().claim(20))
+            self.assertTrue(flushed.wait(1))
+            time.sleep(0.05)
+        self.assertFalse(self.restarted().claim(20))
+        self.assertFalse(self.restarted().claim(21))
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
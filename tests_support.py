@@ -0,0 +1,50 @@
+"""
+Common setup for the test modules: imported before main.
+
+Sets the environment main.py reads at import time, points the bot's files
+at a temporary directory instead of /data, and injects sys.modules mocks
+for telebot/requests/dotenv, so the tests run without the real
+dependencies installed.
+
+Usage, at the top of a test module:
+
+    import tests_support  # noqa: F401
+    import main
+"""
+import os
+import sys
+import tempfile
+from unittest.mock import MagicMock
+
+os.environ['BOT_TOKEN_SUPPORT'] = 'test_token'
+os.environ['ADMIN_IDS'] = '111,222'
+os.environ['API_URL_SUPPORT'] = 'http://test/api'
+os.environ['SUPPORT_API_URL'] = 'http://test/support'
+# Все файлы бота — во временную папку: import main читает и пишет их сразу
+tmp_dir = tempfile.mkdtemp()
+os.environ['STATE_FILE'] = os.path.join(tmp_dir, 'bot_state.json')
+os.environ['UPDATES_STATE_FILE'] = os.path.join(tmp_dir, 'processed_updates.json')
+os.environ['STATS_FILE'] = os.path.join(tmp_dir, 'support_stats.json')
+os.environ['TRACE_FILE'] = os.path.join(tmp_dir, 'traces.jsonl')
+os.environ['SEARCH_DB'] = os.path.join(tmp_dir, 'search.db')
+os.environ['RECORD_UPDATES_FILE'] = ''
+
+
+def _identity_decorator(*args, **kwargs):
+    def wrapper(fn):
+        return fn
+    return wrapper
+
+
+_bot_instance = MagicMock()
+_bot_instance.message_handler = _identity_decorator
+_bot_instance.callback_query_handler = _identity_decorator
+
+_telebot_mock = MagicMock()
+_telebot_mock.TeleBot.return_value = _bot_instance
+sys.modules.setdefault('telebot', _telebot_mock)
+sys.modules.setdefault('telebot.types', MagicMock())
+sys.modules.setdefault('dotenv', MagicMock())
+sys.modules.setdefault('requests', MagicMock())
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))